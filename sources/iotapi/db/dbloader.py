@@ -23,6 +23,7 @@ from iotapp.params import *
 
 from pony.orm import *
 from schema.dbschema import *
+from schema.dbmigrate import migrate_schema
 
 # This is needed to import utilities from a common parent folder.
 #
@@ -59,39 +60,42 @@ if DB_DEBUG:
 # NOTE: the database password comes out of secrets manager and will be rotated by KMS so
 # we have to get the latest one each time we run this.
 #
-def create_database(config, ssh_tunnel):
+def bind_database(config, ssh_tunnel):
     print("--Connecting via Postgres Engine")
-    try:
-        db_user = config.get('db_username', None)
-        db_password_key = config.get("db_password_key")
-        raw_db_secret = get_secret(config, db_password_key)
-        if not raw_db_secret:
-            print(f"ERROR: database credentials for key {db_password_key} not found in SecretsManager")
-            exit(1)
+    db_user = config.get('db_username', None)
+    db_password_key = config.get("db_password_key")
+    raw_db_secret = get_secret(config, db_password_key)
+    if not raw_db_secret:
+        print(f"ERROR: database credentials for key {db_password_key} not found in SecretsManager")
+        exit(1)
 
-        db_password = raw_db_secret.get('password', None)
-        if not db_password:
-            print(f"ERROR: password for key {db_password_key} not found in SecretsManager")
-            exit(1)
+    db_password = raw_db_secret.get('password', None)
+    if not db_password:
+        print(f"ERROR: password for key {db_password_key} not found in SecretsManager")
+        exit(1)
 
-        # In case database needs passwords to be processed
-        # db_password = urllib.parse.quote_plus(db_password)
+    # In case database needs passwords to be processed
+    # db_password = urllib.parse.quote_plus(db_password)
 
-        db_name = config.get('db_name', None)
-        db_type = config.get("db_type", None)
+    db_name = config.get('db_name', None)
+    db_type = config.get("db_type", None)
 
-        # pony.options.CUT_TRACEBACK = False
-        db.bind(db_type,
-                user=db_user,
-                password=db_password,
-                port=ssh_tunnel.local_bind_port,
-                host=ssh_tunnel.local_bind_host,
-                database=db_name)
+    # pony.options.CUT_TRACEBACK = False
+    db.bind(db_type,
+            user=db_user,
+            password=db_password,
+            port=ssh_tunnel.local_bind_port,
+            host=ssh_tunnel.local_bind_host,
+            database=db_name)
+
+    print("--Connected to database via SSH tunnel")
+    db.generate_mapping(create_tables=False, check_tables=False)
 
-        print("--Connected to database via SSH tunnel")
-        print("--Deleting existing tables and re-creating new ones")
 
-        db.generate_mapping(create_tables=False, check_tables=False)
+def create_database(config, ssh_tunnel):
+    try:
+        bind_database(config, ssh_tunnel)
+        print("--Deleting existing tables and re-creating new ones")
         db.drop_all_tables(with_all_data=True)
         db.create_tables()
     except Exception as e:
@@ -99,6 +103,27 @@ def create_database(config, ssh_tunnel):
         exit(1)
 
 
+#
+# Upgrades the schema of an existing database in place, without touching the data.
+# Returns False if any of the changes couldn't be made.
+#
+def migrate_database(config, ssh_tunnel):
+    try:
+        bind_database(config, ssh_tunnel)
+        print("--Migrating database schema")
+        changes, problems = migrate_schema(db)
+        for change in changes:
+            print(f"   {change}")
+        if not changes:
+            print("   Schema is up to date")
+        for problem in problems:
+            print(f"ERROR: {problem}")
+        return len(problems) == 0
+    except Exception as e:
+        print(f"ERROR: could not migrate database: {str(e)}")
+        exit(1)
+
+
 @db_session
 def populate_database(config):
     print("--Loading mock data")
@@ -288,6 +313,8 @@ def load_device_data_types(data, models):
             data_normal = type.get("data_normal", "")
             label_template = type.get("label_template", "")
             ranges = type.get("ranges", "")
+            short_key = model.next_short_key or 0
+            model.next_short_key = short_key + 1
 
             one = DataType(model=model,
                                  name=type_name,
@@ -298,7 +325,8 @@ def load_device_data_types(data, models):
                                  data_position=data_position,
                                  data_normal=data_normal,
                                  label_template=label_template,
-                                 ranges=ranges)
+                                 ranges=ranges,
+                                 short_key=short_key)
             type_list[type_name] = one
 
     return type_list
@@ -838,7 +866,17 @@ def stop_tunnel(ssh_tunnel):
 if __name__ == '__main__':
     team = None
 
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2 and sys.argv[2] == "--migrate":
+        team = str(sys.argv[1])
+        print(f"Migrating database schema with Team '{team}'")
+        config = load_config(team)
+        tunnel = start_tunnel(config, team)
+        migrated = migrate_database(config, tunnel)
+        stop_tunnel(tunnel)
+        print("--All Done!")
+        if not migrated:
+            exit(1)
+    elif len(sys.argv) > 1:
         team = str(sys.argv[1])
         print(f"Initializing database with Team '{team}'")
         config = load_config(team)
@@ -848,4 +886,4 @@ if __name__ == '__main__':
         stop_tunnel(tunnel)
         print("--All Done!")
     else:
-        print(f"USAGE: python3 ./dbloader.py {team}")
+        print(f"USAGE: python3 ./dbloader.py {team} [--migrate]")
@@ -0,0 +1,145 @@
+/*
+ * © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+ *
+ * Compact binary (CBOR) encoder for SimpleIOT data. Instead of sending each value as
+ * a JSON message with the names spelled out, all the values can be packed into a single
+ * CBOR map keyed by the short key of each DataType, and published to IOT_BINARY_TOPIC.
+ * This is generated from the DataTypes defined for the model, so if they change, the
+ * firmware needs to be generated again.
+ *
+ * Example:
+ *
+ *   SimpleIOTCbor cbor;
+ *   cbor.begin();
+ *   cbor.addFloat(SIMPLEIOT_KEY_TEMPERATURE, temperature);
+ *   cbor.addFloat(SIMPLEIOT_KEY_HUMIDITY, humidity);
+ *   cbor.addLocation(last_lat, last_lng);
+ *   cbor.end();
+ *   mqttClient.publish(IOT_BINARY_TOPIC, cbor.data(), cbor.length());
+ */
+
+#ifndef __SIMPLEIOT_CBOR__
+#define __SIMPLEIOT_CBOR__
+
+#include <Arduino.h>
+
+#define IOT_BINARY_TOPIC "simpleiot_v1/app/bin/set/{{ project }}/{{ device }}"
+
+// Short keys for the DataTypes of model {{ model }}
+//
+{% for data in data_list %}
+#define SIMPLEIOT_KEY_{{ data.name | upper | replace('-', '_') | replace(' ', '_') | replace('.', '_') }} {{ data.key }}
+{% endfor %}
+
+// Reserved keys for values that apply to the whole message.
+//
+#define SIMPLEIOT_KEY_TIMESTAMP -1
+#define SIMPLEIOT_KEY_GEO_LAT   -2
+#define SIMPLEIOT_KEY_GEO_LNG   -3
+#define SIMPLEIOT_KEY_GEO_ALT   -4
+
+#ifndef SIMPLEIOT_CBOR_BUFFER_SIZE
+#define SIMPLEIOT_CBOR_BUFFER_SIZE 256
+#endif
+
+class SimpleIOTCbor {
+  public:
+    // Starts an indefinite-length map, so the number of values doesn't have to be known.
+    void begin() {
+      _length = 0;
+      _overflow = false;
+      writeByte(0xBF);
+    }
+
+    void end() {
+      writeByte(0xFF);
+    }
+
+    void addInt(int key, long value) {
+      writeKey(key);
+      writeInt(value);
+    }
+
+    void addFloat(int key, float value) {
+      writeKey(key);
+      union { float f; uint32_t i; } bits;
+      bits.f = value;
+      writeByte(0xFA);
+      for (int shift = 24; shift >= 0; shift -= 8) {
+        writeByte((bits.i >> shift) & 0xFF);
+      }
+    }
+
+    void addBool(int key, bool value) {
+      writeKey(key);
+      writeByte(value ? 0xF5 : 0xF4);
+    }
+
+    void addString(int key, const char* value) {
+      writeKey(key);
+      size_t len = strlen(value);
+      writeHead(3, len);
+      for (size_t i = 0; i < len; i++) {
+        writeByte(value[i]);
+      }
+    }
+
+    void addTimestamp(unsigned long epochSecs) {
+      addInt(SIMPLEIOT_KEY_TIMESTAMP, (long) epochSecs);
+    }
+
+    void addLocation(float lat, float lng) {
+      addFloat(SIMPLEIOT_KEY_GEO_LAT, lat);
+      addFloat(SIMPLEIOT_KEY_GEO_LNG, lng);
+    }
+
+    const uint8_t* data() { return _buffer; }
+    size_t length() { return _length; }
+    bool overflow() { return _overflow; }
+
+  private:
+    uint8_t _buffer[SIMPLEIOT_CBOR_BUFFER_SIZE];
+    size_t _length = 0;
+    bool _overflow = false;
+
+    void writeByte(uint8_t b) {
+      if (_length < SIMPLEIOT_CBOR_BUFFER_SIZE) {
+        _buffer[_length++] = b;
+      } else {
+        _overflow = true;
+      }
+    }
+
+    void writeHead(uint8_t major, uint32_t value) {
+      major <<= 5;
+      if (value < 24) {
+        writeByte(major | value);
+      } else if (value < 0x100) {
+        writeByte(major | 24);
+        writeByte(value);
+      } else if (value < 0x10000) {
+        writeByte(major | 25);
+        writeByte(value >> 8);
+        writeByte(value & 0xFF);
+      } else {
+        writeByte(major | 26);
+        for (int shift = 24; shift >= 0; shift -= 8) {
+          writeByte((value >> shift) & 0xFF);
+        }
+      }
+    }
+
+    void writeInt(long value) {
+      if (value >= 0) {
+        writeHead(0, (uint32_t) value);
+      } else {
+        writeHead(1, (uint32_t) (-1 - value));
+      }
+    }
+
+    void writeKey(int key) {
+      writeInt(key);
+    }
+};
+
+#endif /* __SIMPLEIOT_CBOR__ */
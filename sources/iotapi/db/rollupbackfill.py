@@ -0,0 +1,116 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# Rebuilds the 1-minute and 1-hour rollups in the DynamoDB data table from the raw history.
+# Rollups are normally kept up to date as values come in, so this is only needed for history
+# recorded before rollups were added, or if they need to be recomputed.
+#
+# Usage:
+#   python3 rollupbackfill.py {team} [--project P] [--serial S] [--name N] [--start T] [--end T]
+#
+# Without a project, serial, or name, all the history in the table is processed. This scans
+# the whole table to find the history keys, so on a large table, narrow it down.
+# Start and end times can be epoch seconds or ISO dates.
+#
+import argparse
+import boto3
+from datetime import datetime
+import os
+import sys
+
+# This is needed to import utilities from a common parent folder.
+#
+SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
+PACKAGE_PARENT = '..'
+sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
+
+from util.config import *   # Shared config routines between subsystems
+from iotapp.historywriter import DynamoDBHistoryWriter
+from iotapp.rollup import *
+
+
+# Keys of items that aren't raw history.
+#
+NON_HISTORY_PREFIXES = [f"{ROLLUP_KEY_PREFIX}:", "heartbeat:", "lastvalue:", "dedup:", "simpleiot:"]
+
+
+def parse_time_ns(value):
+    if not value:
+        return None
+    try:
+        return int(float(value) * NANOSECS_PER_SEC)
+    except ValueError:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return int(dt.timestamp() * 1e6) * 1000
+
+
+def find_history_keys(client, table_name, prefix):
+    scan = {
+        "TableName": table_name,
+        "ProjectionExpression": "#id",
+        "ExpressionAttributeNames": {"#id": "id"}
+    }
+    if prefix:
+        scan["FilterExpression"] = "begins_with(#id, :prefix)"
+        scan["ExpressionAttributeValues"] = {":prefix": {"S": prefix}}
+
+    keys = set()
+    for page in client.get_paginator("scan").paginate(**scan):
+        for item in page.get("Items", []):
+            key = item["id"]["S"]
+            if not any(key.startswith(p) for p in NON_HISTORY_PREFIXES):
+                keys.add(key)
+    return sorted(keys)
+
+
+def backfill(config, project, serial, name, start, end):
+    aws_profile = config.get("aws_profile", None)
+    if aws_profile:
+        boto3.setup_default_session(profile_name=aws_profile)
+
+    table_name = config.get("dynamoDBTable", None)
+    if not table_name:
+        print("ERROR: DynamoDB table name not found in configuration")
+        exit(1)
+
+    client = boto3.client("dynamodb", region_name=config.get("region", None))
+    writer = DynamoDBHistoryWriter(client, table_name)
+
+    prefix = ""
+    if project:
+        prefix = f"{project}:"
+        if serial:
+            prefix += f"{serial}:"
+            if name:
+                prefix += name
+
+    start_ns = parse_time_ns(start)
+    end_ns = parse_time_ns(end)
+
+    keys = find_history_keys(client, table_name, prefix)
+    if name:
+        keys = [k for k in keys if k.split(":", 2)[-1] == name]
+    print(f"--Rebuilding rollups for {len(keys)} history keys")
+
+    for key in keys:
+        count = rebuild_rollups(client, table_name, writer, key, start_ns, end_ns)
+        print(f"  {key}: {count} rollup items")
+
+    print(f"--Rollup items written: {writer.items_written}, failed: {writer.items_failed}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild history rollups from raw DynamoDB history")
+    parser.add_argument("team")
+    parser.add_argument("--project", default=None)
+    parser.add_argument("--serial", default=None)
+    parser.add_argument("--name", default=None)
+    parser.add_argument("--start", default=None)
+    parser.add_argument("--end", default=None)
+    args = parser.parse_args()
+
+    print(f"Rebuilding rollups for Team '{args.team}'")
+    backfill(load_config(args.team), args.project, args.serial, args.name, args.start, args.end)
+    print("--All Done!")
@@ -0,0 +1,239 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: Database Schema Migration
+# dbmigrate.py
+#
+# Brings an existing database up to date with dbschema.py without dropping anything.
+# A normal dbsetup drops all the tables and re-creates them, which is fine for a new install
+# but loses all the data on one that's been running for a while. This compares the tables
+# PonyORM would create with what's in the database and only adds what's missing:
+#
+# - columns added to existing tables. They're added as nullable, then set to the attribute
+#   default (or empty for strings) on the existing rows. On PostgreSQL, columns Pony declares
+#   NOT NULL are then marked as such.
+# - new tables, and indexes and foreign keys missing from existing tables.
+# - composite keys (unique indexes) missing from existing tables. If the table has rows that
+#   would break the key, it is not added and the duplicates are reported, so they can be
+#   cleaned up by hand and the migration re-run.
+# - the IOT settings and certificates of Devices, Models, and Projects are moved from the
+#   columns they used to be in to Credential records, and the old columns are dropped.
+# - DataTypes without a short key are given one. They're numbered in the order they were
+#   created (by name for ones created at the same time), after any keys already given out by
+#   their model, which is how compact payloads numbered them before the keys were stored.
+#
+# Columns and tables that are no longer in the schema are left alone. Running it again on a
+# database that's up to date doesn't do anything.
+#
+# The database has to be bound and mapped without creating tables before this is called:
+#
+#   db.bind(...)
+#   db.generate_mapping(create_tables=False, check_tables=False)
+#   migrate_schema(db)
+#
+from pony.orm import db_session
+
+
+def _existing_columns(connection, provider, table_name):
+    cursor = connection.cursor()
+    provider.execute(cursor, f"SELECT * FROM {provider.quote_name(table_name)} WHERE 1 = 0")
+    return set([d[0].lower() for d in cursor.description])
+
+
+def _column_attrs(db):
+    attrs = {}
+    for entity in db.entities.values():
+        for attr in entity._new_attrs_:
+            for column in attr.columns or []:
+                attrs[(entity._table_, column)] = attr
+    return attrs
+
+
+def _column_default(attr):
+    if attr is None:
+        return None
+    default = attr.default
+    if callable(default):
+        default = default()
+    if default is None and attr.py_type is str:
+        default = ""
+    return default
+
+
+def _add_columns(db, connection, report):
+    provider = db.provider
+    quote_name = provider.quote_name
+    attrs = _column_attrs(db)
+    for table in db.schema.order_tables_to_create():
+        if not provider.table_exists(connection, table.name, case_sensitive=False):
+            continue
+        existing = _existing_columns(connection, provider, table.name)
+        for column in table.column_list:
+            if column.name.lower() in existing:
+                continue
+            table_sql = quote_name(table.name)
+            column_sql = quote_name(column.name)
+            report.append(f"Add column {table.name}.{column.name}")
+            db.execute(f"ALTER TABLE {table_sql} ADD COLUMN {column_sql} {column.sql_type}")
+
+            default = _column_default(attrs.get((table.name, column.name), None))
+            if default is not None:
+                db.execute(f"UPDATE {table_sql} SET {column_sql} = $default WHERE {column_sql} IS NULL",
+                           {"default": default})
+            if column.is_not_null and provider.dialect == "PostgreSQL":
+                db.execute(f"ALTER TABLE {table_sql} ALTER COLUMN {column_sql} SET NOT NULL")
+
+
+def _create_missing_objects(db, connection, report):
+    provider = db.provider
+    created_tables = set()
+    for table in db.schema.order_tables_to_create():
+        for db_object in table.get_objects_to_create(created_tables):
+            if db_object.exists(provider, connection, case_sensitive=False) is None:
+                report.append(f"Create {db_object.typename.lower()} {db_object.name}")
+                db_object.create(provider, connection)
+
+
+# The columns the IOT settings and certificates used to be kept in, in the same order as
+# CREDENTIAL_FIELDS. The prefix is also the name of the Credential attribute for the owner.
+#
+CREDENTIAL_FIELDS = ["iot_config_data", "ca_data", "cert_data", "public_key_data", "private_key_data"]
+CREDENTIAL_OWNERS = [("Device", "device"), ("Model", "model"), ("Project", "project")]
+
+
+def _old_credential_columns(prefix):
+    return ["iot_config_data"] + [f"{prefix}_{field}" for field in CREDENTIAL_FIELDS[1:]]
+
+
+#
+# Each Credential gets the id of the record it's moved from, so a record that has already
+# been moved is easy to skip. They're all UUID4s, so they can't clash.
+#
+def _move_credentials(db, connection, report):
+    if "Credential" not in db.entities:
+        return
+    provider = db.provider
+    quote_name = provider.quote_name
+    credential = db.entities["Credential"]
+    credential_table = quote_name(credential._table_)
+
+    for entity_name, prefix in CREDENTIAL_OWNERS:
+        table_name = db.entities[entity_name]._table_
+        old_columns = _old_credential_columns(prefix)
+        existing = _existing_columns(connection, provider, table_name)
+        if not all(c in existing for c in old_columns):
+            continue
+
+        owner_column = quote_name(credential._adict_[prefix].columns[0])
+        table = quote_name(table_name)
+        has_data = " OR ".join(f"COALESCE({quote_name(c)}, '') <> ''" for c in old_columns)
+        new_columns = ", ".join(quote_name(c) for c in CREDENTIAL_FIELDS)
+        copied = ", ".join(f"COALESCE({quote_name(c)}, '')" for c in old_columns)
+        id_column = quote_name("id")
+        dates = f"{quote_name('date_created')}, {quote_name('last_modified')}"
+        db.execute(f"INSERT INTO {credential_table} ({id_column}, {owner_column}, {new_columns}, {dates}) "
+                   f"SELECT {id_column}, {id_column}, {copied}, {dates} FROM {table} "
+                   f"WHERE ({has_data}) AND {id_column} NOT IN (SELECT {id_column} FROM {credential_table})")
+        report.append(f"Move {table_name} certificates to {credential._table_}")
+        for column in old_columns:
+            db.execute(f"ALTER TABLE {table} DROP COLUMN {quote_name(column)}")
+            report.append(f"Drop column {table_name}.{column}")
+
+
+def _assign_short_keys(db, report):
+    if "short_key" not in db.entities["DataType"]._adict_:
+        return
+    quote_name = db.provider.quote_name
+    data_type = db.entities["DataType"]
+    model = db.entities["Model"]
+    type_table = quote_name(data_type._table_)
+    model_table = quote_name(model._table_)
+    id_column = quote_name("id")
+    model_column = quote_name(data_type._adict_["model"].columns[0])
+    key_column = quote_name(data_type._adict_["short_key"].columns[0])
+    next_column = quote_name(model._adict_["next_short_key"].columns[0])
+
+    rows = db.select(f"SELECT {id_column}, {model_column}, {key_column} FROM {type_table} "
+                     f"WHERE {model_column} IS NOT NULL "
+                     f"ORDER BY {model_column}, {quote_name('date_created')}, {quote_name('name')}")
+    by_model = {}
+    for type_id, model_id, short_key in rows:
+        by_model.setdefault(model_id, []).append((type_id, short_key))
+
+    assigned = 0
+    for model_id, types in by_model.items():
+        missing = [type_id for type_id, short_key in types if short_key is None]
+        if not missing:
+            continue
+        next_key = db.select(f"SELECT {next_column} FROM {model_table} WHERE {id_column} = $model_id",
+                             {"model_id": model_id})[0] or 0
+        next_key = max([next_key] + [short_key + 1 for _, short_key in types if short_key is not None])
+        for type_id in missing:
+            db.execute(f"UPDATE {type_table} SET {key_column} = $short_key WHERE {id_column} = $type_id",
+                       {"short_key": next_key, "type_id": type_id})
+            next_key += 1
+        db.execute(f"UPDATE {model_table} SET {next_column} = $next_key WHERE {id_column} = $model_id",
+                   {"next_key": next_key, "model_id": model_id})
+        assigned += len(missing)
+    if assigned:
+        report.append(f"Assign short keys to {assigned} DataTypes")
+
+
+def _find_duplicates(db, table, columns):
+    quote_name = db.provider.quote_name
+    column_list = ", ".join(quote_name(c.name) for c in columns)
+    return db.select(f"SELECT {column_list}, COUNT(*) FROM {quote_name(table.name)} "
+                     f"GROUP BY {column_list} HAVING COUNT(*) > 1")
+
+
+def _has_unique_index(db, connection, index):
+    # SQLite doesn't keep the names of the UNIQUE constraints in a CREATE TABLE, so their
+    # indexes are found by their columns.
+    #
+    if db.provider.dialect == "SQLite":
+        quote_name = db.provider.quote_name
+        columns = [c.name for c in index.columns]
+        cursor = connection.cursor()
+        for _, name, unique, *_ in cursor.execute(f"PRAGMA index_list({quote_name(index.table.name)})").fetchall():
+            info = cursor.execute(f"PRAGMA index_info({quote_name(name)})").fetchall()
+            if unique and [r[2] for r in info] == columns:
+                return True
+        return False
+    return index.exists(db.provider, connection, case_sensitive=False) is not None
+
+
+def _add_composite_keys(db, connection, report, problems):
+    for table in db.schema.order_tables_to_create():
+        for index in sorted(table.indexes.values(), key=lambda i: i.name or ""):
+            if index.is_pk or not index.is_unique or len(index.columns) < 2:
+                continue
+            if _has_unique_index(db, connection, index):
+                continue
+            duplicates = _find_duplicates(db, table, index.columns)
+            if duplicates:
+                problems.append(f"Composite key {index.name} not added: {len(duplicates)} duplicate "
+                                f"({', '.join(c.name for c in index.columns)}) values in {table.name}")
+                continue
+            report.append(f"Create composite key {index.name}")
+            db.execute(index.get_create_command())
+
+
+@db_session(ddl=True)
+def migrate_schema(db):
+    """
+    Adds the columns, tables, indexes, and keys in the schema that are missing from the
+    database. Everything is done in a single transaction.
+
+    :return: (list of changes made, list of changes that couldn't be made)
+    """
+    connection = db.get_connection()
+    report = []
+    problems = []
+    _add_columns(db, connection, report)
+    _create_missing_objects(db, connection, report)
+    _move_credentials(db, connection, report)
+    _assign_short_keys(db, report)
+    _add_composite_keys(db, connection, report, problems)
+    return report, problems
@@ -9,6 +9,7 @@
 
 from pony.orm import *
 from datetime import datetime
+from decimal import Decimal
 import uuid
 from enum import Enum, unique, IntFlag
 from .dbutil import *
@@ -41,6 +42,41 @@ class BuildTool(db.Entity):
     def __repr__(self):
         return f"{self.__class__.__name__}: {self.name}"
 
+#############################################################################
+# The AWS IOT settings and certificates of a Device, Model, or Project, if it
+# has any (see ModelSecurity). They used to be columns of those records, so
+# every query for devices pulled all the PEM text along with them. Now they're
+# only loaded when they're actually needed, i.e. when a device is created,
+# when certs are shown, or when firmware is generated.
+#
+# iot_config_data is the JSON returned by AWS IOT when the thing (or
+# Greengrass group) was created. It's used to delete them along with the
+# record they belong to (see the before_delete hooks).
+#
+class Credential(db.Entity):
+    id = PrimaryKey(uuid.UUID, default=uuid.uuid4)
+    device = Optional("Device", reverse="credential", column="device")
+    model = Optional("Model", reverse="credential", column="model")
+    project = Optional("Project", reverse="credential", column="project")
+    iot_config_data = Optional(LongStr, default="")
+    ca_data = Optional(LongStr, default="")
+    cert_data = Optional(LongStr, default="")
+    public_key_data = Optional(LongStr, default="")
+    private_key_data = Optional(LongStr, default="")
+
+    date_created = Required(datetime, default=datetime.utcnow)
+    last_modified = Optional(datetime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}: {self.id}"
+
+    # Called by the before_delete hooks of the record the credential belongs to, while
+    # it can still be loaded, so none of the fields have to be loaded eagerly.
+    #
+    def delete_iot(self, is_gateway):
+        if self.iot_config_data:
+            delete_iot_if_needed(self.iot_config_data, is_gateway)
+
 #############################################################################
 #
 class Customer(db.Entity):
@@ -66,6 +102,10 @@ class Customer(db.Entity):
 # only the latest value stored. Essentially the same as a device shadow,
 # except maitained in the database.
 #
+# There is only one Data record per device and type. The composite key
+# enforces that so the ingest path can upsert values in a single statement
+# (see datastore.py) without racing to create duplicates.
+#
 class Data(db.Entity):
     id = PrimaryKey(uuid.UUID, default=uuid.uuid4)
     udi = Optional(str, unique=True)
@@ -76,9 +116,53 @@ class Data(db.Entity):
     device = Required("Device")
     timestamp = Required(datetime, default=datetime.utcnow)
 
+    # The value is also stored as a number or boolean, according to the DataType, so values
+    # can be filtered and compared across devices in the database. Pony won't index a float
+    # column, so the number is stored as a Decimal.
+    #
+    number_value = Optional(Decimal, 24, 8)
+    bool_value = Optional(bool)
+
+    # Running statistics of the numeric values received (see seriesstats.py): count, mean,
+    # and sum of squared differences from the mean (Welford), and exponentially weighted
+    # moving average.
+    #
+    stats_count = Optional(int)
+    stats_mean = Optional(float)
+    stats_m2 = Optional(float)
+    stats_ewma = Optional(float)
+
+    composite_key(device, type)
+    composite_index(type, number_value)
+
     def __repr__(self):
         return f"{self.__class__.__name__}: {self.name}"
 
+#############################################################################
+# An Alarm is recorded when a value of a device moves from one of the ranges
+# defined for its DataType (see DataType.ranges) to another, or in or out of
+# all of them. Readings that stay in the same range don't create new records.
+#
+# range_name is the range the value moved into (empty if it's outside all
+# of them) and previous_range the one it was in before. 'actions' has the names
+# of the when_in/when_below/when_above functions triggered by the change.
+#
+class Alarm(db.Entity):
+    id = PrimaryKey(uuid.UUID, default=uuid.uuid4)
+    device = Required("Device", reverse="alarms")
+    type = Required("DataType", reverse="alarms")
+    value = Optional(str)
+    range_name = Optional(str)
+    previous_range = Optional(str)
+    color = Optional(str)
+    actions = Optional(Json)
+    timestamp = Required(datetime, default=datetime.utcnow)
+    acknowledged = Optional(bool, default=False)
+    composite_index(device, timestamp)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}: {self.range_name}"
+
 #############################################################################
 # This is used to define each sensor or value type. An optional set of
 # co-ordinates can be specified that would be mapped onto the Digital Twin
@@ -98,6 +182,7 @@ class DataType(db.Entity):
     #
     model = Optional("Model", reverse="data_types", volatile=True)
     device_data = Set("Data", reverse="type", cascade_delete=True)
+    alarms = Set("Alarm", reverse="type", cascade_delete=True)
 
     # Values can be string or list of valid options.
     #
@@ -181,9 +266,35 @@ class DataType(db.Entity):
     #
     ranges = Optional(LongStr)
 
+    # Deadband filtering for noisy values. If a new numeric value is within the deadband
+    # of the last one stored (an absolute amount, or a percentage of the last value if
+    # deadband_percent is set) it is dropped instead of being stored and sent out. Only a
+    # heartbeat is recorded, so we still know the device is reporting.
+    #
+    # Values inside the deadband are still stored at least once every min_report_secs.
+    # If zero, they are dropped for as long as they stay inside the deadband.
+    # With a deadband of zero, only repeats of the same value are dropped. Setting just
+    # min_report_secs stores an unchanged value at most once per interval. If all three are
+    # unset, filtering is off.
+    #
+    deadband = Optional(float, default=0)
+    deadband_percent = Optional(bool, default=False)
+    min_report_secs = Optional(int, default=0)
+
+    # Number a device can use instead of the name in compact (binary) payloads. It's given out
+    # by the model when the DataType is created (see Model.next_short_key) and never changes,
+    # so keys of deleted DataTypes aren't reused.
+    #
+    short_key = Optional(int)
+
     date_created = Required(datetime, default=datetime.utcnow)
     last_modified = Optional(datetime, default=datetime.utcnow)
 
+    # DataTypes are looked up by model and name on every value received.
+    #
+    composite_index(model, name)
+    composite_key(model, short_key)
+
     def __repr__(self):
         return f"{self.__class__.__name__}: {self.name}"
 
@@ -199,20 +310,16 @@ class Device(db.Entity):
     desc = Optional(str)
     status = Optional(str)	# device-specific, including power-up, OK, etc.
 
-    # These will be populated if the Model indicates that this is either an
-    # IOT Thing or an IOT Greengrass device
+    # This will be populated if the Model indicates that this is either an
+    # IOT Thing or an IOT Greengrass device. See Credential.
     #
-    # settings for IOT Things and Greengrass json (note: LongStr > 255 chars)
-    iot_config_data = Optional(LongStr, default="", lazy=False) # If set to lazy, before_delete fails
-    device_ca_data = Optional(LongStr, default="")
-    device_cert_data = Optional(LongStr, default="")
-    device_public_key_data = Optional(LongStr, default="")
-    device_private_key_data = Optional(LongStr, default="")
+    credential = Optional("Credential", reverse="device", cascade_delete=True)
 
     error_message = Optional(str)   # last error message
     date_manufactured = Optional(datetime, default=datetime.utcnow)
     manufacturer_extra_data = Optional(str)
     data = Set("Data", reverse="device")
+    alarms = Set("Alarm", reverse="device", cascade_delete=True)
     installed = Optional(bool, default=False)
     location = Optional("Location")
     position = Optional(str)      	# position string, ie: Floor 3, Office 200, or Front Bedroom.
@@ -241,6 +348,11 @@ class Device(db.Entity):
     date_created = Required(datetime, default=datetime.utcnow)
     last_modified = Optional(datetime, default=datetime.utcnow)
 
+    # Serial numbers only need to be unique within a project, which the Device API checks
+    # (see the note on Model). This index is for looking devices up by serial number.
+    #
+    composite_index(device_project, serial_number)
+
     def __repr__(self):
         return f"{self.__class__.__name__}: {self.name}"
 
@@ -251,9 +363,9 @@ class Device(db.Entity):
     #
     def before_delete(self):
         print("Start Device before_delete")
-        if self.iot_config_data:
+        if self.credential:
             print(f"Deleting Device iot")
-            delete_iot_if_needed(self.iot_config_data, self.is_gateway)
+            self.credential.delete_iot(self.is_gateway)
             print(f"Device iot deleted")
 
         print(f"End Device before_delete")
@@ -484,6 +596,7 @@ class Model(db.Entity):
     # Devices are manually deleted in case they have attached certificates and IOT Things
     devices = Set("Device", reverse="model", cascade_delete=True)
     data_types = Set("DataType", reverse="model", volatile=True, cascade_delete=True)
+    next_short_key = Optional(int, default=0)   # short_key of the next DataType added to the model
     revision = Optional(str)
     display_name = Optional(str)
     display_order = Optional(int)
@@ -504,11 +617,7 @@ class Model(db.Entity):
     # type is created. When deleting a Model, we must be careful to delete the certs
     # and policies to clean up after ourselves.
     #
-    iot_config_data = Optional(LongStr, default="", lazy=False) # If set to lazy, before_delete fails
-    model_ca_data = Optional(LongStr, default="")
-    model_cert_data = Optional(LongStr, default="")
-    model_public_key_data = Optional(LongStr, default="")
-    model_private_key_data = Optional(LongStr, default="")
+    credential = Optional("Credential", reverse="model", cascade_delete=True)
 
     # These attributes indicate whether a device is installed in a fixed spot or can be moved.
     # If movable, the Data attributes will be (if available) tagged with GPS location data
@@ -556,10 +665,10 @@ class Model(db.Entity):
     #
     def before_delete(self):
         #print("Start Model before_delete")
-        if self.iot_config_data:
+        if self.credential:
             #print(f"Deleting Model iot")
             is_gateway = self.model_type is ModelType.GATEWAY
-            delete_iot_if_needed(self.iot_config_data, is_gateway)
+            self.credential.delete_iot(is_gateway)
             #print(f"Model iot deleted")
 
         #print(f"End Model before_delete")
@@ -806,6 +915,8 @@ class Firmware(db.Entity):
     date_created = Required(datetime, default=datetime.utcnow)
     last_modified = Optional(datetime, default=datetime.utcnow)
 
+    composite_index(model, version)
+
     def __repr__(self):
         return f"{self.__class__.__name__}: {self.name}"
 
@@ -985,11 +1096,7 @@ class Project(db.Entity):
     # data and work on the same devices.
     #
     is_gateway = Optional(bool, default=False)  # copy of Model type field. Here so cascading deletes work.
-    iot_config_data = Optional(LongStr, default="", lazy=False) # If set to lazy, before_delete fails
-    project_ca_data = Optional(LongStr, default="")
-    project_cert_data = Optional(LongStr, default="")
-    project_public_key_data = Optional(LongStr, default="")
-    project_private_key_data = Optional(LongStr, default="")
+    credential = Optional("Credential", reverse="project", cascade_delete=True)
 
     media_files = Set("MediaFile", reverse="project", cascade_delete=True)
 
@@ -1001,9 +1108,9 @@ class Project(db.Entity):
 
     def before_delete(self):
         #print("Start Project before_delete")
-        if self.iot_config_data:
+        if self.credential:
             #print(f"Deleting Project iot")
-            delete_iot_if_needed(self.iot_config_data, self.is_gateway)
+            self.credential.delete_iot(self.is_gateway)
             #print(f"Project iot deleted")
 
         #print(f"End Project before_delete")
@@ -1159,6 +1266,8 @@ class UpdateTarget(db.Entity):
     date_created = Required(datetime, default=datetime.utcnow)
     last_modified = Optional(datetime, default=datetime.utcnow)
 
+    composite_index(device, state)
+
     def __repr__(self):
         return f"{self.__class__.__name__}: {self.name}"
 
@@ -19,6 +19,7 @@ import {AuroraPostgresEngineVersion, PostgresEngineVersion} from "aws-cdk-lib/aw
 interface IDatabaseProps extends cdk.NestedStackProps {
     prefix: string,
     useAurora: boolean,
+    useProxy: boolean,
     uuid: string,
     vpc: ec2.IVpc,
     myIp: string,
@@ -43,6 +44,9 @@ export class CDKDatabase extends cdk.NestedStack {
   public databaseInstance: rds.DatabaseInstance;
   public dbSecurityGroup : ec2.ISecurityGroup;
   public databaseHostname : string;
+  public databaseReaderHostname : string;
+  public databaseProxy: rds.DatabaseProxy;
+  public databaseProxyHostname : string;
   readonly databaseSecret: rds.DatabaseSecret;
 
   constructor(scope: Construct, id: string, props: IDatabaseProps) {
@@ -165,6 +169,11 @@ export class CDKDatabase extends cdk.NestedStack {
           );
           this.databaseHostname = this.databaseCluster.clusterEndpoint.hostname;
 
+          // The reader endpoint spreads connections over the replicas in the cluster. GET
+          // handlers read from it (see iotapp/dbreplica.py).
+          //
+          this.databaseReaderHostname = this.databaseCluster.clusterReadEndpoint.hostname;
+
       } else {
 
           // NOTE: we are using an RDS/Postgres instance instead of an AuroraPostgres instance so we can keep usage costs
@@ -209,5 +218,33 @@ export class CDKDatabase extends cdk.NestedStack {
           this.databaseInstance.connections.allowFrom(this.bastion, ec2.Port.tcp(parseInt(props.dbPort)));
           this.databaseHostname = this.databaseInstance.instanceEndpoint.hostname;
       }
+
+      // An RDS Proxy in front of the database lets all the lambdas share a small number of
+      // database connections, so bursts of traffic don't use up max_connections. The lambdas
+      // are pointed at it with the DB_POOLER_MODE and DB_POOLER_HOST environment variables
+      // (see iotapp/dbpooler.py). It uses the same secret as the database.
+      //
+      if (props.useProxy) {
+          console.log("    - With RDS Proxy")
+          let proxyTarget = props.useAurora ?
+              rds.ProxyTarget.fromCluster(this.databaseCluster) :
+              rds.ProxyTarget.fromInstance(this.databaseInstance);
+
+          this.databaseProxy = new rds.DatabaseProxy(this, "db_proxy", {
+              proxyTarget: proxyTarget,
+              dbProxyName: props.prefix.replace(/_/g, "-") + "-db-proxy",
+              secrets: [this.databaseSecret],
+              vpc: props.vpc,
+              vpcSubnets: {
+                  subnetType: ec2.SubnetType.PRIVATE_WITH_NAT
+              },
+              securityGroups: [this.dbSecurityGroup],
+              requireTLS: true,
+              maxConnectionsPercent: 90,
+              idleClientTimeout: cdk.Duration.minutes(30),
+              borrowTimeout: cdk.Duration.seconds(30)
+          });
+          this.databaseProxyHostname = this.databaseProxy.endpoint;
+      }
   }
 }
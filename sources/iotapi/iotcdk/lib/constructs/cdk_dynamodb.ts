@@ -45,6 +45,10 @@ export class CDKDynamoDB extends cdk.NestedStack {
             name: 'recorded_at',
             type: ddb.AttributeType.NUMBER
           },
+          /* NOTE: items with an expires_at attribute (epoch seconds) are deleted by DynamoDB
+             once it's passed. This is used for the message ids kept to drop duplicate data messages.
+           */
+          timeToLiveAttribute: 'expires_at',
           billingMode: ddb.BillingMode.PAY_PER_REQUEST,
           removalPolicy: cdk.RemovalPolicy.DESTROY
         });
@@ -30,6 +30,8 @@ interface ILambdaProps extends cdk.NestedStackProps {
     uuid: string,
     logLevel: string,
     dbPasswordKey: string,
+    dbProxyHostname?: string,
+    dbReplicaHostname?: string,
     dynamoDB: CDKDynamoDB,
     httpsPort: number,
     layer: CDKLambdaLayer,
@@ -383,6 +385,11 @@ export class CDKLambda extends cdk.NestedStack {
             "./lib/lambda_src/api/ui/iot_ui_api_device",
            props,false, true, true, true, true);
 
+        // Device details read current values from the last-value items in the dynamodb table,
+        // and fill them in from the database if they're not there yet.
+        //
+        props.dynamoDB.dynamoDBTable.grantReadWriteData(this.uiDeviceLambda);
+
        this.uiModelLambda = this.defineLambdaAndAPI(this.apiGw,
            uiResource,
            "model",
@@ -623,6 +630,28 @@ export class CDKLambda extends cdk.NestedStack {
             sourceArn: iotDataRule.attrArn,
        });
 
+       // Devices can also send data as compact binary (CBOR) payloads. The rule can't parse
+       // them as JSON, so they're base64 encoded and the project and serial number are pulled
+       // out of the topic: simpleiot_v1/app/bin/set/{project}/{serial}
+       //
+       const iotBinaryDataRule = new iot.CfnTopicRule(this, 'iot_lambda_binary_fwd_rule', {
+            topicRulePayload: {
+                actions: [
+                    {
+                        lambda: lambdaIotAction,
+                    },
+                ],
+                ruleDisabled: false,
+                sql: `SELECT encode(*, 'base64') AS payload, topic(5) AS project, topic(6) AS serial FROM 'simpleiot_v1/app/bin/set/#'`,
+                awsIotSqlVersion: '2016-03-23',
+            },
+       });
+
+       this.dataLambda.addPermission('iot_allow_lambda_invoke_binary_rule', {
+            principal: new iam.ServicePrincipal('iot.amazonaws.com'),
+            sourceArn: iotBinaryDataRule.attrArn,
+       });
+
        // We set up a separate rule, where .../checkupdate/... MQTT messages are sent over to
        // the lambda that handles updates.
        //
@@ -767,6 +796,25 @@ export class CDKLambda extends cdk.NestedStack {
                 "IOT_LOGLEVEL": props.logLevel
             };
 
+        // If there's an RDS Proxy, the lambdas connect through it instead of going
+        // straight to the database.
+        //
+        if (props.dbProxyHostname) {
+            lambda_env["DB_POOLER_MODE"] = "rds_proxy";
+            lambda_env["DB_POOLER_HOST"] = props.dbProxyHostname;
+        }
+
+        // Handlers that only read can go to a read replica.
+        //
+        if (props.dbReplicaHostname) {
+            lambda_env["DB_REPLICA_HOST"] = props.dbReplicaHostname;
+        }
+
+        // A dedup claim left pending by an invocation that never finished can be taken
+        // again once the function has timed out.
+        //
+        lambda_env["DEDUP_PENDING_SECS"] = String(props.lambdaTimeOutSecs);
+
         if (props.timestream) {
             lambda_env["TS_DATABASE"] = props.timestream.databaseName;
             lambda_env["TS_TABLENAME"] = props.timestream.tableName;
@@ -98,6 +98,7 @@ export class IotcdkStack extends cdk.Stack {
       let POSTGRES_FULL_VERSION = process.env["POSTGRES_FULL_VERSION"] ?? "**POSTGRES_FULL_UNDEFINED**"
       let POSTGRES_MAJOR_VERSION = process.env["POSTGRES_MAJOR_VERSION"] ?? "**POSTGRES_MAJOR_UNDEFINED**"
       let DATABASE_USE_AURORA = (process.env["DATABASE_USE_AURORA"] == 'True') ?? "**DATABASE_USE_AURORA_UNDEFINED**"
+      let DATABASE_USE_PROXY = (process.env["DATABASE_USE_PROXY"] == 'True')
 
       // These are loaded dynamically from the JSON files created in the bootstrap
       // phase of installation. The bootstrap file is in ~/.simpleiot/{profile} and
@@ -411,6 +412,7 @@ export class IotcdkStack extends cdk.Stack {
                       uuid: uuid,
                       vpc: this.network.vpc,
                       useAurora: DATABASE_USE_AURORA,
+                      useProxy: DATABASE_USE_PROXY,
                       myIp: MY_IP,
                       postgresFullVersion: POSTGRES_FULL_VERSION,
                       postgresMajorVersion: POSTGRES_MAJOR_VERSION,
@@ -443,6 +445,12 @@ export class IotcdkStack extends cdk.Stack {
                       this.database.databaseHostname,
                       "Database endpoint hostname")
 
+                  if (DATABASE_USE_PROXY) {
+                      Common.output(this, "dbProxyHostname",
+                          this.database.databaseProxyHostname,
+                          "Database proxy endpoint hostname")
+                  }
+
                   Common.output(this, "bastionSSHAllowedIP",
                       MY_IP,
                       "IP address with SSH access to bastion host")
@@ -575,6 +583,10 @@ export class IotcdkStack extends cdk.Stack {
                           uuid: uuid,
                           logLevel: config.log_level,
                           dbPasswordKey: config.db_password_key,
+                          dbProxyHostname: this.database.databaseProxyHostname,
+                          // With a proxy, reads stay on it instead of opening their own
+                          // connections to the reader endpoint.
+                          dbReplicaHostname: DATABASE_USE_PROXY ? undefined : this.database.databaseReaderHostname,
                           dynamoDB: this.dynamodb,
                           httpsPort: config.https_tcp_port,
                           layer: this.lambdaLayer,
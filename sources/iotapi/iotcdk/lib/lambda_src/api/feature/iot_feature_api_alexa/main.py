@@ -219,6 +219,7 @@ def delete_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 200
     method = ""
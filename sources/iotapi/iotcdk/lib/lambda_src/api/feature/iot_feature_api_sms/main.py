@@ -164,6 +164,7 @@ def provision_via_sms(config):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 200
     method = ""
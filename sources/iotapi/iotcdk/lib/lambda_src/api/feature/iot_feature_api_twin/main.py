@@ -462,6 +462,7 @@ def erase_twin_3d_data(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 200
     method = ""
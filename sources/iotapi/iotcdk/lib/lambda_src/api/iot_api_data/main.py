@@ -9,9 +9,23 @@
 import os
 import boto3
 import json
+import base64
+from types import SimpleNamespace
 from pony.orm import *
 from iotapp.dbschema import *
 from iotapp.utils import *
+from iotapp.datastore import *
+from iotapp.tswriter import *
+from iotapp.historywriter import *
+from iotapp.fanout import *
+from iotapp.codec import *
+from iotapp.history import *
+from iotapp.aggregate import *
+from iotapp.rollup import *
+from iotapp.laststore import *
+from iotapp.alarms import *
+from iotapp.seriesstats import *
+from iotapp.dedup import *
 from iotapp.params import *
 from iotapp.logger import *
 import os
@@ -54,34 +68,59 @@ except Exception as e:
     ldebug("Unable to connect to TIMESTREAM client")
     pass
 
+ts_writer = TimestreamWriter(tsclient, ts_database, ts_tablename)
+
+dynamodb_table_name = None
+dynamodb_client = None
+
 try:
-    dynamodb_table = os.environ['DYNAMODB_TABLE']
+    dynamodb_table_name = os.environ['DYNAMODB_TABLE']
     dynamodb_client = boto3.client('dynamodb', region_name=region)
-    dynamodb = boto3.resource('dynamodb', region_name=region)
-    dynamodb_table = dynamodb.Table(dynamodb_table)
-    ddb_exceptions = dynamodb_client.exceptions
-
 except Exception as e:
     ldebug("Unable to connect to DynamoDB table")
 
+history_writer = DynamoDBHistoryWriter(dynamodb_client, dynamodb_table_name)
+rollup_updater = RollupUpdater(dynamodb_client, dynamodb_table_name)
+last_value_writer = LastValueWriter(dynamodb_client, dynamodb_table_name)
+dedup_store = DedupStore(dynamodb_client, dynamodb_table_name)
+
+try:
+    geo = boto3.client("location", region_name=region)
+except Exception as e:
+    ldebug("Unable to connect to LOCATION SERVICES client")
+
+# Everything sent out after the database commit goes through the fan-out stage, so the
+# calls run concurrently. It's run at the end of each invocation.
+#
+fanout = FanOut()
+
 # RDS database connection
 connect_database()
 
 
-def format_one(rec):
+#
+# The type and device can be passed in if they've already been looked up (or are cached
+# snapshots) so formatting the record doesn't have to load them again.
+#
+def format_one(rec, type=None, device=None):
+    if not type:
+        type = rec.type
+    if not device:
+        device = rec.device
+
     return_data = {
         "id": rec.id.hex,
-        "name": rec.type.name,
-        "serial": rec.device.serial_number,
-        "model": rec.device.model.name,
-        "project": rec.device.device_project.name
+        "name": type.name,
+        "serial": device.serial_number,
+        "model": device.model.name,
+        "project": device.device_project.name
     }
     if rec.value:
         return_data["value"] = rec.value
-    if rec.type.name:
-        return_data["name"] = rec.type.name
-    if rec.type.desc:
-        return_data["desc"] = rec.type.desc
+    if type.name:
+        return_data["name"] = type.name
+    if type.desc:
+        return_data["desc"] = type.desc
     if rec.position:
         return_data["position"] = rec.position
     if rec.dimension:
@@ -94,7 +133,7 @@ def format_one(rec):
     # expression processing inside here.
     #
     try:
-        label_format = rec.type.label_template
+        label_format = type.label_template
         if label_format:
             label = label_format.format(**return_data)
             if label:
@@ -117,7 +156,13 @@ def format_all(recs):
     return return_data
 
 
-@db_session
+#
+# Current values are read from the last-value item for the device in DynamoDB (see laststore.py).
+# The project, device, and DataType come from the metadata cache, so a hit doesn't touch the
+# database. If the item doesn't have the value and hasn't been filled in from the database yet,
+# the value is read from the database and the item is filled in for next time.
+#
+@replica_session
 def get_record(params, return_raw=False):
     """
     Called with the GET REST call to retrieve one or more records.
@@ -130,36 +175,41 @@ def get_record(params, return_raw=False):
         model = None
         project = None
         device = None
+        device_data = None
 
         if params:
-            project = find_project(params)
+            project = find_project_cached(params)
             if not project:
                 code = 418
                 result = {"status": "error", "message": "Data could not be found. Invalid project"}
             else:
-                device = find_device(params, project)
+                device = find_device_cached(params, project)
                 if not device:
                     code = 418
                     result = {"status": "error", "message": "Data could not be found. Invalid device"}
                 else:
                     data_name = params.get("name", "")
-                    if not data_name:
+                    type = find_data_types_cached(device.model).get(data_name, None) if data_name else None
+                    if not type:
                         code = 418
                         result = {"status": "error", "message": "Data could not be found. Invalid Data Name"}
                     else:
-                        device_data = Data.select(lambda
-                                                      dd: dd.device.serial_number == device.serial_number and
-                                                          dd.type.name == data_name).first()
+                        last_values = get_device_last_values(dynamodb_client, dynamodb_table_name,
+                                                      project.name, device.serial_number)
+                        if last_values:
+                            device_data = last_values.get(data_name, type)
+                        if not device_data and not (last_values and last_values.complete):
+                            device_data = get_data_from_database(project, device, type)
 
                     # If coming through MQTT, we return the raw record
                     if device_data:
                         code = 200
-                        formatted_data = format_one(device_data)
+                        formatted_data = format_one(device_data, type, device)
                         if return_raw:
                             result = formatted_data
                         else:
                             result = json.dumps(formatted_data)
-                    else:
+                    elif type:
                         code = 418
                         result = json.dumps({"status": "error", "message": "Can not find Data value"})
 
@@ -172,6 +222,579 @@ def get_record(params, return_raw=False):
     return code, result
 
 
+#
+# All the values of a device, or of every device of a model, in one call. This is a GET with
+# no 'name', and either 'all=true' or 'names' (a comma-separated list of DataType names):
+#
+#   project, serial: all the values of one device
+#   project, model: all the values of every device of the model
+#
+# The values of one device come from its last-value item if it's been filled in. Otherwise,
+# they're loaded with a single query joined with the device, model, and project, and the
+# DataTypes come from the metadata cache, so formatting them doesn't load anything else.
+#
+# {
+#     "status": "ok",
+#     "count": 2,
+#     "data": [{"name": "temperature", "serial": "...", "value": "21.5", ...}, ...]
+# }
+#
+def is_multi_value_request(params):
+    return bool(params) and not params.get("name", None) and bool(params.get("all", None) or
+                                                                  params.get("names", None))
+
+
+@replica_session
+def get_records(params):
+    code = 200
+    result = {}
+    try:
+        project = find_project_cached(params)
+        device = find_device_cached(params, project) if project else None
+        model = device.model if device else find_model_cached(params, project) if project else None
+
+        if not project:
+            code = 418
+            result = {"status": "error", "message": "Data could not be found. Invalid project"}
+        elif not device and (params.get("serial", None) or params.get("device_id", None)):
+            code = 418
+            result = {"status": "error", "message": "Data could not be found. Invalid device"}
+        elif not model:
+            code = 418
+            result = {"status": "error", "message": "Data could not be found. Invalid device or model"}
+        else:
+            types = find_data_types_cached(model)
+            names = [n.strip() for n in params.get("names", "").split(",") if n.strip()]
+            invalid = [n for n in names if n not in types]
+            if names:
+                types = {n: t for n, t in types.items() if n in names}
+            types_by_id = {t.id: t for t in types.values()}
+
+            if not types_by_id:
+                data = []
+            elif device:
+                records = get_device_records(project, device, types, types_by_id, bool(names))
+                data = [format_one(rec, types_by_id[rec.type_id], device) for rec in records]
+            else:
+                devices = {}
+                data = []
+                for serial, rec in select_device_data(project.id, model_id=model.id, type_ids=types_by_id.keys()):
+                    if serial not in devices:
+                        devices[serial] = SimpleNamespace(serial_number=serial, model=model, device_project=project)
+                    data.append(format_one(rec, types_by_id[rec.type_id], devices[serial]))
+
+            result = {"status": "ok", "count": len(data), "data": data}
+            if invalid:
+                result["errors"] = [{"name": n, "message": f"Invalid data type for name: {n}"} for n in invalid]
+
+    except Exception as e:
+        lerror(f"ERROR getting records: {str(e)}")
+        code = 500
+        result = {"status": "error", "message": str(e)}
+
+    return code, json.dumps(result)
+
+
+#
+# Fleet-wide filter on the current values of a model's devices. This is a GET with:
+#
+#   project, model: which devices to look at
+#   name: the DataType to filter on
+#   op: gt, gte, lt, lte, eq, or ne
+#   value: the number to compare to, or true/false for boolean DataTypes
+#   pagenum, pagesize: which page of devices to return (default: 1 and 100)
+#
+# For example, model=pump&name=pressure&op=gt&value=40 returns the pumps with a current pressure
+# over 40. The comparison is done in the database on the typed value columns, so only the
+# matching devices are read.
+#
+# {
+#     "status": "ok",
+#     "total": 12,
+#     "devices": [{"serial": "...", "name": "...", "value": "41.5", "timestamp": "..."}, ...]
+# }
+#
+FILTER_MAX_PAGE_SIZE = 1000
+
+
+def is_filter_request(params):
+    return bool(params) and bool(params.get("op", None))
+
+
+@replica_session
+def get_filtered_devices(params):
+    code = 200
+    result = {}
+    try:
+        project = find_project_cached(params)
+        model = find_model_cached(params, project) if project else None
+        type = find_data_types_cached(model).get(params.get("name", ""), None) if model else None
+        op = params.get("op", "")
+        threshold = params.get("value", None)
+
+        if not project or not model:
+            code = 418
+            result = {"status": "error", "message": "Data could not be found. Invalid project or model"}
+        elif not type:
+            code = 418
+            result = {"status": "error", "message": "Data could not be found. Invalid Data Name"}
+        elif op not in FILTER_OPS or threshold is None:
+            code = 418
+            result = {"status": "error", "message": f"Invalid filter. 'op' must be one of {', '.join(FILTER_OPS)}, "
+                                                    f"with a 'value'"}
+        elif not is_numeric_data_type(type) and not is_bool_data_type(type):
+            code = 418
+            result = {"status": "error", "message": f"Data {type.name} is not a number or boolean"}
+        else:
+            if is_bool_data_type(type):
+                _, threshold = get_typed_values(type, threshold)
+            else:
+                threshold, _ = get_typed_values(type, threshold)
+
+            if threshold is None:
+                code = 418
+                result = {"status": "error", "message": "Invalid filter value"}
+            else:
+                pagenum = max(1, int(params.get("pagenum", 1)))
+                pagesize = max(1, min(int(params.get("pagesize", 100)), FILTER_MAX_PAGE_SIZE))
+                total, rows = select_devices_by_value(project.id, model.id, type.id, op, threshold, pagenum, pagesize)
+                devices = []
+                for serial, device_name, rec in rows:
+                    device = {"serial": serial, "value": rec.value, "timestamp": rec.timestamp.isoformat()}
+                    if device_name:
+                        device["name"] = device_name
+                    devices.append(device)
+                result = {"status": "ok", "total": total, "pagenum": pagenum, "pagesize": pagesize,
+                          "devices": devices}
+
+    except Exception as e:
+        lerror(f"ERROR filtering devices: {str(e)}")
+        code = 500
+        result = {"status": "error", "message": str(e)}
+
+    return code, json.dumps(result)
+
+
+def get_device_records(project, device, types, types_by_id, subset):
+    last_values = get_device_last_values(dynamodb_client, dynamodb_table_name, project.name, device.serial_number)
+    if last_values and last_values.complete:
+        records = [last_values.get(name, type) for name, type in types.items()]
+        return [rec for rec in records if rec]
+
+    records = [rec for _, rec in select_device_data(project.id, device_id=device.id, type_ids=types_by_id.keys())]
+    if not subset:
+        fill_last_values(dynamodb_client, dynamodb_table_name, project.name, device.serial_number,
+                         records, types_by_id)
+    return records
+
+
+#
+# Fallback when the last-value item doesn't have a value. All the values for the device are
+# loaded with one query, so the item can be filled in.
+#
+def get_data_from_database(project, device, type):
+    device_id = device.id
+    records = Data.select(lambda dd: dd.device.id == device_id).prefetch(DataType)[:]
+    fill_last_values(dynamodb_client, dynamodb_table_name, project.name, device.serial_number, records)
+    for rec in records:
+        if rec.type.id == type.id:
+            return rec
+    return None
+
+
+#
+# History of a single value, read back from the DynamoDB data table for a time range.
+# This is a GET with 'from' and/or 'to' (or 'history=true' for the whole range):
+#
+#   project, serial, name: which value to get
+#   from, to: time range (epoch seconds/ms/us/ns, or ISO date strings)
+#   limit: max number of points (default 1000, max 10000)
+#   next: token returned with the previous page
+#   fields: comma-separated list of value, latitude, longitude, altitude (default: value)
+#   order: 'asc' (default) or 'desc'
+#   time_unit: unit of the returned timestamps: s, ms (default), us, or ns
+#
+# Results come back as columnar lists. Values of numeric DataTypes are returned as numbers.
+#
+# For charts, numeric values can be reduced on the server instead of returning every point.
+# The whole time range is read (limit, next, fields, and order don't apply):
+#
+#   bucket: size of each bucket in seconds. Returns 'min', 'max', 'avg', 'count', and 'last'
+#           lists, with the start of each bucket in 'timestamps'. Buckets are aligned to
+#           multiples of the bucket size.
+#   points: number of points to downsample to, using LTTB. Returns 'timestamps' and 'values'.
+#
+# If the bucket size is a whole number of minutes, the aggregates are computed from the 1-minute
+# or 1-hour rollups instead of the raw values (see rollup.py), which is a lot less to read. Since
+# rollups cover whole minutes or hours, the first and last buckets may include values just outside
+# the time range. Passing 'source=raw' forces reading the raw values.
+#
+# {
+#     "status": "ok",
+#     "count": 2,
+#     "timestamps": [1650000000000, 1650000060000],
+#     "values": [21.5, 21.7],
+#     "next": "{token}"   (only if there are more)
+# }
+#
+HISTORY_MAX_SCAN_POINTS = int(os.environ.get("HISTORY_MAX_SCAN_POINTS", "1000000"))
+
+
+def is_history_request(params):
+    return bool(params) and bool(params.get("from", None) or params.get("to", None) or
+                                 params.get("history", None))
+
+
+@replica_session
+def get_history(params):
+    code = 200
+    result = {}
+    try:
+        project = find_project_cached(params)
+        device = find_device_cached(params, project) if project else None
+        data_name = params.get("name", "")
+        type = find_data_types_cached(device.model).get(data_name, None) if device else None
+
+        if not project:
+            code = 418
+            result = {"status": "error", "message": "History could not be found. Invalid project"}
+        elif not device:
+            code = 418
+            result = {"status": "error", "message": "History could not be found. Invalid device"}
+        elif not type:
+            code = 418
+            result = {"status": "error", "message": "History could not be found. Invalid Data Name"}
+        elif not dynamodb_client or not dynamodb_table_name:
+            code = 500
+            result = {"status": "error", "message": "No DynamoDB data table configured"}
+        else:
+            fields = [f.strip() for f in params.get("fields", "value").split(",") if f.strip()]
+            invalid = [f for f in fields if f not in HISTORY_FIELDS]
+            time_unit = params.get("time_unit", "ms")
+            if invalid:
+                code = 418
+                result = {"status": "error", "message": f"Invalid history fields: {', '.join(invalid)}"}
+            elif time_unit not in TIME_UNIT_DIVISORS:
+                code = 418
+                result = {"status": "error", "message": f"Invalid time unit: {time_unit}"}
+            elif params.get("bucket", None) or params.get("points", None):
+                code, result = get_reduced_history(params, project, device, type, time_unit)
+            else:
+                history = query_history(dynamodb_client, dynamodb_table_name,
+                                        history_key(project.name, device.serial_number, type.name),
+                                        start_ns=parse_timestamp_nanosec(params.get("from", None)),
+                                        end_ns=parse_timestamp_nanosec(params.get("to", None)),
+                                        limit=params.get("limit", HISTORY_DEFAULT_LIMIT),
+                                        next_token=params.get("next", None),
+                                        fields=fields,
+                                        descending=params.get("order", "asc").lower() == "desc",
+                                        numeric=is_numeric_data_type(type),
+                                        time_unit=time_unit)
+                result = {"status": "ok",
+                          "project": project.name,
+                          "serial": device.serial_number,
+                          "name": type.name,
+                          "time_unit": time_unit}
+                result.update(history)
+
+    except Exception as e:
+        lerror(f"ERROR getting history: {str(e)}")
+        code = 500
+        result = {"status": "error", "message": str(e)}
+
+    return code, json.dumps(result)
+
+
+#
+# Picks the largest rollup period that the bucket size is a multiple of.
+#
+def get_rollup_period(bucket_secs):
+    period = None
+    for name, secs in sorted(ROLLUP_PERIODS.items(), key=lambda p: p[1]):
+        if bucket_secs >= secs and bucket_secs % secs == 0:
+            period = name
+    return period
+
+
+def get_reduced_history(params, project, device, type, time_unit):
+    if not is_numeric_data_type(type):
+        return 418, {"status": "error", "message": f"History of '{type.name}' is not numeric"}
+
+    bucket_secs = float(params.get("bucket", 0) or 0)
+    points = int(params.get("points", 0) or 0)
+    if bucket_secs < 0 or points < 0 or (points and points < 3):
+        return 418, {"status": "error", "message": "Invalid bucket size or point count"}
+
+    start_ns = parse_timestamp_nanosec(params.get("from", None))
+    end_ns = parse_timestamp_nanosec(params.get("to", None))
+    period = None
+    if bucket_secs and params.get("source", "") != "raw":
+        period = get_rollup_period(bucket_secs)
+
+    if period:
+        pages = iter_rollup_pages(dynamodb_client, dynamodb_table_name, period,
+                                  rollup_key(period, project.name, device.serial_number, type.name),
+                                  start_ns=start_ns, end_ns=end_ns)
+        reduced = merge_rollup_pages(pages, int(bucket_secs * TIME_UNIT_DIVISORS["s"]))
+    else:
+        pages = iter_history_pages(dynamodb_client, dynamodb_table_name,
+                                   history_key(project.name, device.serial_number, type.name),
+                                   start_ns=start_ns, end_ns=end_ns,
+                                   max_points=HISTORY_MAX_SCAN_POINTS)
+        if bucket_secs:
+            reduced = bucket_aggregate(pages, 0, int(bucket_secs * TIME_UNIT_DIVISORS["s"]))
+        else:
+            reduced = lttb_downsample(pages, points)
+
+    divisor = TIME_UNIT_DIVISORS[time_unit]
+    reduced["timestamps"] = [t // divisor for t in reduced["timestamps"]]
+    result = {"status": "ok",
+              "project": project.name,
+              "serial": device.serial_number,
+              "name": type.name,
+              "time_unit": time_unit,
+              "source": f"rollup:{period}" if period else "raw",
+              "num_points": len(reduced["timestamps"])}
+    result.update(reduced)
+    return 200, result
+
+
+#
+# Data can be sent in one of three ways:
+#
+# - a single 'name' and 'value' pair.
+# - a 'data' string with comma-separated 'name=value' pairs.
+# - a 'data' JSON list of reading objects. This is the batch mode, used by devices that
+#   report many values per wake-up:
+#
+#   "data": [
+#       {"name": "temperature", "value": 22.5, "timestamp": 1670000000, "position": "..."},
+#       {"name": "humidity", "value": 40}
+#   ]
+#
+# All of them are normalized into a list of reading dicts so they go through the same path.
+# Timestamps and positions are optional per reading. If not specified, the server time and the
+# request-level 'position' and 'dimension' values are used.
+#
+def get_readings_from_params(params):
+    readings = []
+    name_str = params.get("name", None)
+    if name_str:
+        readings.append({"name": name_str, "value": params.get("value", "")})
+    else:
+        data = params.get("data", None)
+        if isinstance(data, list):
+            for item in data:
+                if isinstance(item, dict) and item.get("name", None):
+                    readings.append(item)
+                else:
+                    ldebug(f"Invalid data item: {item}. Skipping.")
+        elif data:
+            data_list = data.split(",")
+            for d in data_list:
+                kv = d.split('=')
+                if len(kv) == 2:
+                    k = kv[0]
+                    if k:
+                        k = k.strip()
+                    v = kv[1].strip()
+                    if v:
+                        v = v.strip()
+                    readings.append({"name": k, "value": v})
+                else:
+                    ldebug(f"Invalid key/value: {d}. Skipping.")
+
+    return readings
+
+
+#
+# If location data is specified, we set the device last-known position AND
+# send the value up to location services. NOTE: only ONE value per device
+# should have location data, otherwise you'll mess up mapping.
+#
+def update_device_location(device, params):
+    lat = params.get("geo_lat", None)
+    lng = params.get("geo_lng", None)
+    alt = params.get("geo_alt", None)
+
+    if device.model.has_location_tracking and (lat or lng or alt):
+        tracker = device.model.tracker_name  # check that a tracker is specified
+        if tracker:
+            try:
+                # The device may be a cached snapshot, so we load the record to modify it.
+                #
+                device_rec = Device[device.id]
+                if alt:
+                    device_rec.set(geo_alt=alt)
+                if lat and lng:
+                    device_rec.set(geo_lat=lat)
+                    device_rec.set(geo_lng=lng)
+                    updates = [
+                        {
+                            "DeviceId": device.serial_number,
+                            "SampleTime": datetime.now().isoformat(),
+                            "Position": [float(lng), float(lat)]
+                        }
+                    ]
+                    fanout.add("location", send_device_position, tracker, updates)
+            except Exception as e:
+                ldebug(f"Error updating device location: {str(e)}")
+
+
+def send_device_position(tracker, updates):
+    if geo:
+        response = geo.batch_update_device_position(TrackerName=tracker, Updates=updates)
+        ldebug(f"GEO Tracker update response: {response}")
+
+
+#
+# This applies a list of readings to the Data records for a single device. The DataTypes
+# for the device model come out of the metadata cache, and all the Data records are inserted or
+# updated with a single upsert statement, so the cost doesn't go up with the number of values sent.
+# Nothing is committed here -- the caller commits all of them in one transaction.
+#
+# If more than one value for the same name is sent, the Data record gets the latest one, but
+# all of them are passed on to the sinks so they show up in the history.
+#
+# Values for DataTypes with a deadband are compared to the last value stored (loaded with one
+# query, only if needed). If they're within the deadband, they're returned in the suppressed list
+# and not stored or sent out.
+#
+# The device can be an entity or a cached snapshot. Each reading that is applied gets its 'data'
+# record, 'type', 'timestamp_nano' and string 'value' filled in, so the sinks can send out the
+# values as they were reported. Readings with unknown names are returned in the error list.
+#
+def apply_device_readings(device, readings, params):
+    resolved = []
+    applied = []
+    suppressed = []
+    errors = []
+    latest = {}
+
+    data_types = find_data_types_cached(device.model)
+    default_position = params.get("position", None)
+    default_dimension = params.get("dimension", None)
+
+    for reading in readings:
+        n = str(reading["name"])
+        type = data_types.get(n, None)
+        if not type:
+            errors.append({"name": n, "message": f"Data could not be set. Invalid data type for name: {n}"})
+            continue
+
+        timestamp_nano = parse_timestamp_nanosec(reading.get("timestamp", None))
+        if not timestamp_nano:
+            timestamp_nano = time.time_ns()
+
+        reading["type"] = type
+        reading["value"] = str(reading.get("value", ""))
+        reading["number_value"], reading["bool_value"] = get_typed_values(type, reading["value"])
+        reading["timestamp_nano"] = timestamp_nano
+        resolved.append(reading)
+
+    deadband_type_ids = set([r["type"].id for r in resolved if has_deadband(r["type"])])
+    compiled_ranges = {}
+    for reading in resolved:
+        compiled = get_compiled_ranges(reading["type"])
+        if compiled:
+            compiled_ranges[reading["type"].id] = compiled
+    numeric_type_ids = set([r["type"].id for r in resolved if is_numeric_data_type(r["type"])])
+    last_values, series_stats = get_last_values_and_stats(device.id, deadband_type_ids | numeric_type_ids |
+                                                          set(compiled_ranges.keys()))
+    previous_values = dict(last_values)
+
+    for reading in sorted(resolved, key=lambda r: r["timestamp_nano"]):
+        type = reading["type"]
+        timestamp = nanosec_to_datetime(reading["timestamp_nano"])
+
+        if type.id in deadband_type_ids:
+            last_value, last_timestamp = last_values.get(type.id, (None, None))
+            if is_within_deadband(type, reading["value"], timestamp, last_value, last_timestamp):
+                suppressed.append(reading)
+                continue
+            last_values[type.id] = (reading["value"], timestamp)
+
+        # Numeric values are checked against the running statistics of the values before them,
+        # then added to them.
+        #
+        if type.id in numeric_type_ids and reading["number_value"] is not None:
+            stats = series_stats.setdefault(type.id, SeriesStats())
+            anomaly = stats.check(reading["number_value"])
+            if anomaly:
+                reading["anomaly"] = anomaly
+            stats.update(reading["number_value"])
+
+        applied.append(reading)
+        latest[type.id] = {
+            "type_id": type.id,
+            "value": reading["value"],
+            "position": reading.get("position", default_position),
+            "dimension": reading.get("dimension", default_dimension),
+            "timestamp": timestamp,
+            "timestamp_nano": reading["timestamp_nano"],
+            "number_value": reading["number_value"],
+            "bool_value": reading["bool_value"],
+            "stats": series_stats.get(type.id, None)
+        }
+
+    # Values older than the stored one aren't written (see upsert_device_data). They still
+    # go into the history, but aren't sent out as the current value.
+    #
+    records = upsert_device_data(device.id, list(latest.values()))
+    for reading in applied:
+        reading["data"] = records[reading["type"].id]
+        if reading["data"].stale:
+            ldebug(f"Data {reading['type'].name} value is older than the stored one: {reading['value']}")
+        else:
+            ldebug(f"Data {reading['type'].name} set to value: {reading['value']}")
+
+    if compiled_ranges:
+        evaluate_alarms(device, applied, compiled_ranges, previous_values)
+
+    if suppressed:
+        ldebug(f"Suppressed {len(suppressed)} values within deadband for {device.serial_number}")
+
+    for reading in applied:
+        if reading.get("anomaly", None):
+            ldebug(f"Anomaly in {reading['type'].name} for {device.serial_number}: {reading['anomaly']}")
+
+    return applied, suppressed, errors
+
+
+#
+# Checks the applied values against the ranges of their DataTypes (see alarms.py). When a value
+# moves to a different range than the one the previous value was in, an Alarm record is created
+# (committed along with the values) and the event is kept in reading["alarm"] so it can be
+# published once the changes are committed.
+#
+def evaluate_alarms(device, applied, compiled_ranges, previous_values):
+    by_type = {}
+    for reading in applied:
+        if reading["data"].stale:
+            continue
+        if reading["type"].id in compiled_ranges and reading["number_value"] is not None:
+            by_type.setdefault(reading["type"].id, []).append(reading)
+
+    for type_id, readings in by_type.items():
+        previous_value, _ = previous_values.get(type_id, (None, None))
+        previous_number, _ = get_typed_values(readings[0]["type"], previous_value)
+        values = [r["number_value"] for r in readings]
+
+        for index, event in find_transitions(compiled_ranges[type_id], previous_number, values):
+            reading = readings[index]
+            reading["alarm"] = event
+            Alarm(device=device.id,
+                  type=type_id,
+                  value=reading["value"],
+                  range_name=event["range"],
+                  previous_range=event["previous"],
+                  color=event["color"],
+                  actions=event["actions"],
+                  timestamp=nanosec_to_datetime(reading["timestamp_nano"]))
+            ldebug(f"Alarm for {device.serial_number} {reading['type'].name}: "
+                   f"'{event['previous']}' -> '{event['range']}'")
+
+
 @db_session
 def modify_record(params, send_to_mqtt=True):
     """
@@ -193,198 +816,224 @@ def modify_record(params, send_to_mqtt=True):
     receive updates. We may want to revisit this decision if the dashboard is going to show
     ALL values vs. only those marked as showable on a Digital Twin.
 
+    All the values in a request are written to the database in a single transaction, then
+    sent out to DynamoDB, MQTT, and Timestream in bulk.
+
+    If the device sends a message id (see dedup.py), copies of a message that has already
+    been processed are dropped here, before anything is written or published.
+
     :return:
     """
     code = 200
     result = {}
     device = None
-    data_set = {}
+    project = None
 
     try:
-        project = find_project(params)
+        project = find_project_cached(params)
         if not project:
             code = 418
             result = {"status": "error", "message": "Data could not be set. Invalid project"}
         else:
             ldebug(f"Found project: {project.name}")
-            device = find_device(params, project)
+            device = find_device_cached(params, project)
             if not device:
                 code = 418
                 result = {"status": "error", "message": "Data could not be set. Invalid device"}
             else:
                 ldebug(f"Found Device with serial: {device.serial_number}")
-                name_str = params.get("name", None)
-                if name_str:
-                    value = params.get("value", "")
-                    data_set[name_str] = value
-                else:
-                    data_str = params.get("data", None)
-                    if data_str:
-                        data_list = data_str.split(",")
-                        for d in data_list:
-                            kv = d.split('=')
-                            if len(kv) == 2:
-                                k = kv[0]
-                                if k:
-                                    k = k.strip()
-                                v = kv[1].strip()
-                                if v:
-                                    v = v.strip()
-                                data_set[k] = v
-                            else:
-                                ldebug(f"Invalid key/value: {d}. Skipping.")
+                readings = get_readings_from_params(params)
+                message_id = get_message_id(params)
+
+                if len(readings) > 0 and message_id and \
+                        not dedup_store.claim(project.name, device.serial_number, message_id):
+                    ldebug(f"Dropping duplicate message {message_id} from {device.serial_number}")
+                    code = 200
+                    result = {"status": "ok", "duplicate": True, "message_id": message_id, "data": []}
+                elif len(readings) > 0:
+                    update_device_location(device, params)
+                    applied, suppressed, errors = apply_device_readings(device, readings, params)
+                    commit()
+                    send_device_updates(project, device, applied, suppressed, params, send_to_mqtt)
+
+                    result_set = []
+                    for reading in applied:
+                        result_set.append(format_one(reading["data"], reading["type"], device))
+
+                    if len(applied) > 0 or len(suppressed) > 0:
+                        code = 200
+                        result = {"status": "ok", "data": result_set}
+                        if suppressed:
+                            result["suppressed"] = [r["type"].name for r in suppressed]
+                        anomalies = [r["type"].name for r in applied if r.get("anomaly", None)]
+                        if anomalies:
+                            result["anomalies"] = anomalies
+                        if errors:
+                            result["errors"] = errors
                     else:
                         code = 418
-                        result = {"status": "error", "message": "Data could not be set. Missing 'name' or 'data' parameter"}
+                        result = {"status": "error",
+                                  "message": "Data could not be set. 'name' parameter does not match",
+                                  "errors": errors}
+                else:
+                    code = 418
+                    result = {"status": "error", "message": "Name and value (or data) not specified."}
 
-                position = params.get("position", None)
-                dimension = params.get("dimension", None)
+    except Exception as e:
+        lerror(f"Error setting Device Data: {str(e)}")
+        code = 500
+        result = {"status": "error", "message": str(e)}
+        raise e
 
-                # Let's see if we have some data to set.
-                # NOTE: we mark all data with the same lat/long (if specified).
-                #
-                result_set = []
-                if len(data_set) > 0:
-                    # If location data is specified, we set the device last-known position AND
-                    # send the value up to location services. NOTE: only ONE value per device
-                    # should have location data, otherwise you'll mess up mapping.
-                    #
-                    lat = params.get("geo_lat", None)
-                    lng = params.get("geo_lng", None)
-                    alt = params.get("geo_alt", None)
-
-                    if device.model.has_location_tracking:
-                        tracker = device.model.tracker_name  # check that a tracker is specified
-                        if tracker:
-                            try:
-                                geo = boto3.client("location", region_name=region)
-
-                                if alt:
-                                    device.set(geo_alt=alt)
-                                if lat and lng:
-                                    device.set(geo_lat=lat)
-                                    device.set(geo_lng=lng)
-                                    updates = [
-                                        {
-                                            "DeviceId": device.serial_number,
-                                            "SampleTime": datetime.now().isoformat(),
-                                            "Position": [float(lng), float(lat)]
-                                        }
-                                    ]
-                                    response = geo.batch_update_device_position(TrackerName=tracker,
-                                                                                Updates=updates)
-                                    ldebug(f"GEO Tracker update response: {response}")
-                            except Exception as e:
-                                ldebug("Unable to connect to LOCATION SERVICES client")
-
-                    for n in data_set.keys():
-                        v = data_set[n]
-                        type = DataType.select(lambda dt: dt.model.model_project == project and
-                                                          dt.model == device.model and
-                                                          dt.name == n).first()
-                        if not type:
-                            code = 418
-                            result = {"status": "error",
-                                      "message": "Data could not be set. 'name' parameter does not match"}
-                        else:
-                            type_name = type.name
-                            ldebug(f"Found type name: {type_name}")
-
-                        # NOTE: we need to send this to the Data DDB (vs. Device DDB)
-                        #
-                        try:
-                            # DynamoDB write
-
-                            ddb_key = f"{project.name}:{device.serial_number}:{n}"
-                            timestamp_nano = time.time_ns()
-                            timestamp_tr = format_nanosec(timestamp_nano)
-                            ddb_data = {
-                                    'id': ddb_key,
-                                    'name': n,
-                                    'value': v,
-                                    'project': project.name,
-                                    'model': device.model.name,
-                                    "serial": device.serial_number,
-                                    "timestamp": timestamp_tr,
-                                    "recorded_at": timestamp_nano
-                                }
-                            if lat:
-                                ddb_data['latitude'] = lat
-                            if lng:
-                                ddb_data['longitude'] = lng
-                            if alt:
-                                ddb_data['altitude'] = lng
-
-                            response = dynamodb_table.put_item(
-                                Item=ddb_data
-                            )
-                        except Exception as e:
-                            ldebug(f"Error writing to DynamoDB: {str(e)}")
+    ldebug(f"Metadata cache stats: {metadata_cache.stats()}")
+    return code, json.dumps(result)
 
-                        type = DataType.select(
-                            lambda dt: dt.model == device.model and dt.name == n).first()
-                        if not type:
-                            code = 418
-                            result = {"status": "error", "message": f"Data could not be set. Invalid data type for name: {n}"}
-                        else:
-                            ldebug(f"Found data type for: {n}")
-                            data = Data.get(type=type, device=device)
-                            if data:
-                                # NOTE: if value is the same, we can set it up so we don't update
-                                # each one.
-
-                                ldebug(f"Found Data: {n}")
-                                data.set(value=str(v))
-                                if position:
-                                    data.set(position=str(position))
-                                if dimension:
-                                    data.set(dimension=str(dimension))
-                                data.set(timestamp=datetime.utcnow())
-                                ldebug(f"Data {n} set to value: {v}")
-                                commit()
-                                # print(f"Created a new data record with {n} = {v}")
 
-                                # Now send it out to MQTT for those listening.
-                                # Also to timestream. We need to eventually provide a way to make this optional
-                                if data.type.show_on_twin:
-                                    publish_mqtt_update(data, params, send_to_mqtt)
-                                    submit_to_timestream(data, params)
+#
+# Once the values have been committed to the database, they're sent out to the other sinks.
+# The messages are built here, but the network calls are queued on the fan-out stage and
+# made concurrently at the end of the invocation.
+#
+def send_device_updates(project, device, applied, suppressed, params, send_to_mqtt):
+    # Values dropped by the deadband only update the device heartbeat.
+    #
+    if suppressed:
+        record_heartbeat(project, device, suppressed)
 
-                                code = 200
-                                result = format_one(data)
-                                result_set.append(result)
-                            else:
-                                # Doesn't exist so we have to create it. To create it, we have to find the data type based on name
-                                ldebug("Data record doesn't exist. Creating.")
-                                position = params.get("position", "")
-                                dimension = params.get("dimension", "")
-
-                                data = Data(device=device,
-                                            type=type,
-                                            value=str(v),
-                                            position=str(position),
-                                            dimension=str(dimension)
-                                            )
-                                commit()
-                                # print(f"Created a new datatype record with {name} = {value}")
+    # NOTE: we need to send this to the Data DDB (vs. Device DDB)
+    #
+    write_to_dynamodb(project, device, applied, params)
 
-                                # Now send it out to MQTT for those listening.
-                                # Also to timestream. We need to eventually provide a way to make this optional
-                                if data.type.show_on_twin:
-                                    publish_mqtt_update(data, params, send_to_mqtt)
-                                    submit_to_timestream(data, params)
+    # Now send it out to MQTT for those listening.
+    # Each Data record is only published once, even if more than one value for it
+    # was sent in the same request.
+    #
+    published = set()
+    monitor_readings = []
+    for reading in applied:
+        data = reading["data"]
+        if data.stale:
+            continue
+        if reading["type"].show_on_twin and data.id not in published:
+            if send_to_mqtt or MONITOR_PER_VALUE:
+                publish_mqtt_update(data, params, send_to_mqtt, reading["type"], device,
+                                    monitor=MONITOR_PER_VALUE, anomaly=reading.get("anomaly", None))
+            monitor_readings.append(reading)
+            published.add(data.id)
+
+    if MONITOR_PER_DEVICE:
+        publish_device_monitor_update(device, monitor_readings, params)
+
+    for reading in applied:
+        if reading.get("alarm", None):
+            publish_alarm(device, reading)
+
+    # Also to timestream, if the model has data logging turned on.
+    #
+    submit_to_timestream(device, applied, params)
 
-                        ldebug(f"Data {n} created with value: {v}")
 
-                    code = 200
-                    result = {"status": "ok", "data": result_set}
+#
+# Gateways can send the readings for all their attached devices in a single message,
+# instead of one message per device. The envelope is sent with the gateway serial number
+# and a list of devices, each with its own data list (or name/value) and optional geo
+# location:
+#
+# {
+#     "action": "set",
+#     "project": "{project name}",
+#     "serial": "{gateway serial number}",
+#     "devices": [
+#         {"serial": "{device serial}", "data": [{"name": "temperature", "value": 22.5}, ...]},
+#         {"serial": "{device serial}", "name": "humidity", "value": 40, "geo_lat": ..., "geo_lng": ...}
+#     ]
+# }
+#
+# All the attached devices are looked up with a single query, scoped to the gateway, so a
+# gateway can only send data for its own devices. The database changes for all devices are
+# committed together, and the result has an entry for each device so the gateway can tell
+# which ones failed.
+#
+@db_session
+def modify_gateway_records(params, send_to_mqtt=True):
+    code = 200
+    result = {}
+    project = None
+    gateway = None
 
+    try:
+        message_id = get_message_id(params)
+        project = find_project_cached(params)
+        if not project:
+            code = 418
+            result = {"status": "error", "message": "Data could not be set. Invalid project"}
+        else:
+            gateway = find_device_cached(params, project)
+            if not gateway:
+                code = 418
+                result = {"status": "error", "message": "Data could not be set. Invalid gateway"}
+            elif ModelType(gateway.model.model_type) is not ModelType.GATEWAY:
+                code = 418
+                result = {"status": "error", "message": "Data could not be set. Device Model is not of type GATEWAY"}
+            elif message_id and not dedup_store.claim(project.name, gateway.serial_number, message_id):
+                ldebug(f"Dropping duplicate message {message_id} from gateway {gateway.serial_number}")
+                result = {"status": "ok", "duplicate": True, "message_id": message_id, "devices": []}
+            else:
+                entries = [e for e in params.get("devices", []) if isinstance(e, dict)]
+                serials = list(set([str(e.get("serial", e.get("device", ""))) for e in entries]))
+                children = {}
+                gateway_id = gateway.id
+                for child in Device.select(lambda d: d.gateway.id == gateway_id and d.serial_number in serials):
+                    children[child.serial_number] = child
+
+                device_results = []
+                device_updates = []
+                for entry in entries:
+                    serial = str(entry.get("serial", entry.get("device", "")))
+                    device = children.get(serial, None)
+                    if not device:
+                        device_results.append({"serial": serial, "status": "error",
+                                               "message": "Device not found or not attached to gateway"})
+                        continue
+
+                    readings = get_readings_from_params(entry)
+                    if not readings:
+                        device_results.append({"serial": serial, "status": "error",
+                                               "message": "Name and value (or data) not specified."})
+                        continue
+
+                    update_device_location(device, entry)
+                    applied, suppressed, errors = apply_device_readings(device, readings, entry)
+                    device_result = {"serial": serial,
+                                     "status": "ok" if applied or suppressed else "error",
+                                     "data": [format_one(r["data"], r["type"], device) for r in applied]}
+                    if suppressed:
+                        device_result["suppressed"] = [r["type"].name for r in suppressed]
+                    anomalies = [r["type"].name for r in applied if r.get("anomaly", None)]
+                    if anomalies:
+                        device_result["anomalies"] = anomalies
+                    if errors:
+                        device_result["errors"] = errors
+                    device_results.append(device_result)
+                    device_updates.append((device, applied, suppressed, entry))
+
+                commit()
+
+                for device, applied, suppressed, entry in device_updates:
+                    send_device_updates(project, device, applied, suppressed, entry, send_to_mqtt)
+
+                ok_count = len([r for r in device_results if r["status"] == "ok"])
+                if ok_count == len(device_results) and ok_count > 0:
+                    result = {"status": "ok", "devices": device_results}
+                elif ok_count > 0:
+                    result = {"status": "partial", "devices": device_results}
                 else:
                     code = 418
-                    result = {"status": "error", "message": "Name and value (or data) not specified."}
+                    result = {"status": "error", "message": "Data could not be set for any device",
+                              "devices": device_results}
 
     except Exception as e:
-        lerror(f"Error setting Device Data: {str(e)}")
+        lerror(f"Error setting Gateway Device Data: {str(e)}")
         code = 500
         result = {"status": "error", "message": str(e)}
         raise e
@@ -392,10 +1041,71 @@ def modify_record(params, send_to_mqtt=True):
     return code, json.dumps(result)
 
 
-def format_nanosec(nanosec):
-    dt = datetime.fromtimestamp(nanosec / 1e9)
-    time_str = '{}.{:09.0f}'.format(dt.strftime('%Y-%m-%dT%H:%M:%S'), nanosec % 1e9)
-    return time_str
+#
+# Each applied reading is written out as a history item to the DynamoDB data table.
+# They're buffered in history_writer and sent out with batch_write_item at the end of
+# the invocation, one fan-out task per batch of 25. The sort key is the device timestamp, if one was sent.
+# The new values also go into the last-value item for the device, written at the end of the
+# invocation with one update per device.
+#
+def write_to_dynamodb(project, device, readings, params):
+    lat = params.get("geo_lat", None)
+    lng = params.get("geo_lng", None)
+    alt = params.get("geo_alt", None)
+
+    try:
+        for reading in readings:
+            anomaly = reading.get("anomaly", None)
+            item = make_history_item(project.name, device.model.name, device.serial_number,
+                                     reading["type"].name, reading["value"],
+                                     reading["timestamp_nano"], lat, lng, alt,
+                                     anomaly["zscore"] if anomaly else None)
+            history_writer.add(item)
+            if not reading["data"].stale:
+                last_value_writer.add(project.name, device.serial_number, reading["type"].name,
+                                      make_last_value_entry(reading["data"], reading["type"].id,
+                                                            reading["timestamp_nano"]))
+
+            # Numeric values also go into the rollups.
+            #
+            if reading["number_value"] is not None:
+                rollup_updater.add(project.name, device.serial_number, reading["type"].name,
+                                   reading["timestamp_nano"], reading["number_value"])
+    except Exception as e:
+        ldebug(f"Error writing to DynamoDB: {str(e)}")
+
+
+#
+# When values are dropped by the deadband, we still record when the device last reported,
+# with a single update to a heartbeat item in the DynamoDB data table. The item also keeps
+# count of how many values have been dropped.
+#
+HEARTBEAT_KEY_PREFIX = "heartbeat"
+
+
+def record_heartbeat(project, device, suppressed):
+    if not dynamodb_client or not dynamodb_table_name:
+        return
+    key = f"{HEARTBEAT_KEY_PREFIX}:{project.name}:{device.serial_number}"
+    last_seen = max([r["timestamp_nano"] for r in suppressed])
+    fanout.add("heartbeat", write_heartbeat, key, last_seen, len(suppressed))
+
+
+def write_heartbeat(key, last_seen, count):
+    dynamodb_client.update_item(
+        TableName=dynamodb_table_name,
+        Key={
+            "id": {"S": key},
+            "recorded_at": {"N": "0"}
+        },
+        UpdateExpression="SET last_seen = :last_seen, #ts = :ts ADD suppressed :count",
+        ExpressionAttributeNames={"#ts": "timestamp"},
+        ExpressionAttributeValues={
+            ":last_seen": {"N": str(last_seen)},
+            ":ts": {"S": format_nanosec(last_seen)},
+            ":count": {"N": str(count)}
+        }
+    )
 
 
 @db_session
@@ -440,6 +1150,10 @@ def delete_record(params):
                                 device_data_id = device_data.id.hex
                                 device_data.delete()
                                 commit()
+                                try:
+                                    last_value_writer.remove_value(project.name, device.serial_number, data_name)
+                                except Exception as e:
+                                    lerror(f"Error removing last value {data_name}: {str(e)}")
                                 result = {"status": "ok", "id": device_data_id}
                                 code = 200
                             else:
@@ -460,13 +1174,88 @@ def delete_record(params):
 # topic, along with formatted metadata from the database.
 #
 #
-def publish_mqtt_update(data, params, api_update=False):
-    project = data.device.device_project.name
-    model = data.device.model.name
-    serial = data.device.serial_number
-    name = data.type.name
+def publish_mqtt_update(data, params, api_update=False, type=None, device=None, monitor=True, anomaly=None):
+    if not type:
+        type = data.type
+    if not device:
+        device = data.device
+    project = device.device_project.name
+    model = device.model.name
+    serial = device.serial_number
+    name = type.name
     value = data.value
-    payload = format_one(data)
+    payload = format_one(data, type, device)
+    add_geo_to_payload(payload, params)
+    if anomaly:
+        payload["anomaly"] = anomaly
+
+    payload_str = json.dumps(payload)
+    topics = []
+    if api_update:
+        topics.append(f"simpleiot_v1/app/data/set/{project}/{model}/{serial}/{name}")
+    # Unless only device-level monitor messages are being sent, we update the common monitor topic
+    if monitor:
+        topics.append(f"simpleiot_v1/app/monitor/{project}/{model}/{serial}/{name}")
+
+    if iotclient:
+        for topic in topics:
+            ldebug(f"Sending IOT update to {topic} with payload: {payload_str}")
+            fanout.add("mqtt", publish_mqtt_message, topic, payload_str)
+
+
+#
+# Instead of one monitor message per value, a single message can be sent per device update,
+# with all the values that changed, to simpleiot_v1/app/monitor/{project}/{model}/{serial}.
+# This is set with the MONITOR_MODE environment variable:
+#
+#   value: one message per value, to the per-value monitor topics (default)
+#   device: one message per device, to the device monitor topic
+#   both: send both
+#
+# The device message looks like:
+#
+# {
+#     "project": "{project name}",
+#     "model": "{model name}",
+#     "serial": "{device serial}",
+#     "data": [{formatted data record}, ...],
+#     "geo_lat": ..., "geo_lng": ..., "geo_alt": ...   (if sent)
+# }
+#
+MONITOR_MODE = os.environ.get("MONITOR_MODE", "value").lower()
+MONITOR_PER_VALUE = MONITOR_MODE in ("value", "both")
+MONITOR_PER_DEVICE = MONITOR_MODE in ("device", "both")
+
+
+def publish_device_monitor_update(device, readings, params):
+    if not readings:
+        return
+    project = device.device_project.name
+    model = device.model.name
+    serial = device.serial_number
+    payload = {
+        "project": project,
+        "model": model,
+        "serial": serial,
+        "data": [format_monitor_reading(r, device) for r in readings]
+    }
+    add_geo_to_payload(payload, params)
+
+    if iotclient:
+        topic = f"simpleiot_v1/app/monitor/{project}/{model}/{serial}"
+        payload_str = json.dumps(payload)
+        ldebug(f"Sending IOT update to {topic} with payload: {payload_str}")
+        fanout.add("mqtt", publish_mqtt_message, topic, payload_str)
+
+
+def format_monitor_reading(reading, device):
+    formatted = format_one(reading["data"], reading["type"], device)
+    if reading.get("anomaly", None):
+        formatted["anomaly"] = reading["anomaly"]
+    return formatted
+
+
+def add_geo_to_payload(payload, params):
     lat = params.get("geo_lat", None)
     if lat:
         payload["geo_lat"] = lat
@@ -477,130 +1266,90 @@ def publish_mqtt_update(data, params, api_update=False):
     if alt:
         payload["geo_alt"] = alt
 
-    payload_str = json.dumps(payload)
-    if api_update:
-        mqtt_topic = f"simpleiot_v1/app/data/set/{project}/{model}/{serial}/{name}"
-        ldebug(f"Sending IOT update to {mqtt_topic} with payload: {payload_str}")
-        if iotclient:
-            response = iotclient.publish(
-                topic=mqtt_topic,
-                qos=1,
-                payload=payload_str
-            )
-    # Regardless, we update the common monitor topic
-    monitor_topic = f"simpleiot_v1/app/monitor/{project}/{model}/{serial}/{name}"
-    ldebug(f"Sending IOT update to {monitor_topic} with payload: {payload_str}")
+
+#
+# Alarm events are sent to simpleiot_v1/app/alarm/{project}/{model}/{serial}/{name}:
+#
+# {
+#     "project": ..., "model": ..., "serial": ..., "name": ...,
+#     "value": "42.5",
+#     "timestamp": "{ISO date}",
+#     "range": "Warning",        (empty if outside all the ranges)
+#     "previous": "Good",
+#     "color": "yellow",
+#     "audio": "",
+#     "actions": ["{when_in/when_below/when_above function names}"]
+# }
+#
+def publish_alarm(device, reading):
+    project = device.device_project.name
+    model = device.model.name
+    serial = device.serial_number
+    name = reading["type"].name
+    payload = {
+        "project": project,
+        "model": model,
+        "serial": serial,
+        "name": name,
+        "value": reading["value"],
+        "timestamp": nanosec_to_datetime(reading["timestamp_nano"]).isoformat()
+    }
+    payload.update(reading["alarm"])
 
     if iotclient:
-        response = iotclient.publish(
-            topic=monitor_topic,
-            qos=1,
-            payload=payload_str
-        )
+        topic = f"simpleiot_v1/app/alarm/{project}/{model}/{serial}/{name}"
+        fanout.add("mqtt", publish_mqtt_message, topic, json.dumps(payload))
+
+
+def publish_mqtt_message(topic, payload_str):
+    iotclient.publish(
+        topic=topic,
+        qos=1,
+        payload=payload_str
+    )
 
 
 #
-# We get the record that was saved to the database, but we also look at the original
+# We get the readings that were saved to the database, but we also look at the original
 # params payload sent in to see if lat/lng data was specified. Currently we don't
 # save that data in the database by itself, but in the future we might.
 #
-def submit_to_timestream(rec, params):
-    global tsclient, ts_database, ts_tablename
-
-    if not tsclient:  # no timestream database specified
+# Only models with data_log set send their values to Timestream. The records are buffered
+# in ts_writer and sent out in bulk, either when a device has 100 pending records or at the
+# end of the invocation.
+#
+def submit_to_timestream(device, readings, params):
+    if not ts_writer.is_enabled():  # no timestream database specified
+        return
+    if not readings or not device.model.data_log:
         return
 
-    data_type_value = 'DOUBLE'
-    try:
-        data_type = rec.type.data_type
-        if data_type:
-            data_type_str = data_type.lower()
-            if data_type_str == 'str' or data_type_str == 'string':
-                data_type_value = 'VARCHAR'
-            elif data_type_str == 'num' or \
-                    data_type_str == 'number' or \
-                    data_type_str == 'float' or \
-                    data_type_str == 'double':
-                data_type_value = 'DOUBLE'
-
-        # These are values sent with every data point.
-        #
-        common_attributes = {
-            'Dimensions': [
-                {
-                    'Name': "Project",
-                    'Value': rec.device.device_project.name,
-                    'DimensionValueType': 'VARCHAR'
-                },
-                {
-                    'Name': "Model",
-                    'Value': rec.device.model.name,
-                    'DimensionValueType': 'VARCHAR'
-                },
-                {
-                    'Name': "Serial",
-                    'Value': rec.device.serial_number,
-                    'DimensionValueType': 'VARCHAR'
-                }
-            ]
-        }
-
-        # Add lat/long if specified
-
-        dimension_lat = None
-        dimension_lng = None
-        dimension_list = None
+    # Add lat/long if specified
 
-        current_lat = params.get("geo_lat", None)
-        current_lng = params.get("geo_lng", None)
+    dimension_list = None
+    current_lat = params.get("geo_lat", None)
+    current_lng = params.get("geo_lng", None)
 
-        if current_lat:
-            dimension_lat = {
+    if current_lat and current_lng:
+        dimension_list = [
+            {
                 'Name': "latitude",
                 'Value': str(current_lat),
                 'DimensionValueType': "VARCHAR"
-            }
-        if current_lng:
-            dimension_lng = {
+            },
+            {
                 'Name': "longitude",
                 'Value': str(current_lng),
                 'DimensionValueType': "VARCHAR"
             }
+        ]
 
-        if dimension_lat and dimension_lng:
-            dimension_list = [dimension_lat, dimension_lng]
-
-        # if rec.dimension:
-        #     dimension_list.append(rec.dimension)
-
-        payload = {
-            'Time': str(time.time_ns()),
-            'TimeUnit': "NANOSECONDS",
-            'MeasureName': rec.type.name,
-            'MeasureValue': str(rec.value),
-            'MeasureValueType': data_type_value
-        }
-        if dimension_list:
-            payload['Dimensions'] = dimension_list
-
-        if not ts_database:
-            ts_database = os.environ["TS_DATABASE"]
-        if not ts_tablename:
-            ts_tablename = os.environ["TS_TABLENAME"]
-
-        if ts_database and ts_tablename:
-            response = tsclient.write_records(
-                CommonAttributes=common_attributes,
-                DatabaseName=ts_database,
-                TableName=ts_tablename,
-                Records=[payload]
-            )
-            ldebug(f"Timestream write status: {response['ResponseMetadata']['HTTPStatusCode']}")
-        else:
-            ldebug(f"No Timestream database and table found")
-
-    except Exception as e:
-        raise Exception(f"Timestream error error: {e}")
+    for reading in readings:
+        value = reading["value"]
+        if reading["number_value"] is not None:
+            value = repr(reading["number_value"])
+        ts_writer.add_reading(device, reading["type"], value,
+                              reading["timestamp_nano"], dimension_list)
 
 
 #
@@ -639,7 +1388,10 @@ def process_as_iot_request(params):
         action = params.get("action", None)
         if action:
             if action == "set":
-                code, result = modify_record(params, send_to_mqtt=False)
+                if params.get("devices", None):
+                    code, result = modify_gateway_records(params, send_to_mqtt=False)
+                else:
+                    code, result = modify_record(params, send_to_mqtt=False)
             elif action == "delete":
                 code, result = delete_record(params)
             else:
@@ -677,11 +1429,63 @@ def process_as_iot_request(params):
     return code, result
 
 
+#
+# Binary (CBOR) messages are sent by devices to:
+#
+#   simpleiot_v1/app/bin/set/{project}/{serial}
+#
+# They come in through their own IOT rule, which base64 encodes the payload and pulls the
+# project and serial number out of the topic. See codec.py for the payload format.
+#
+@db_session
+def process_binary_iot_request(event):
+    try:
+        payload = decode_cbor(base64.b64decode(event.get("payload", "")))
+    except Exception as e:
+        lerror(f"Error decoding binary payload: {str(e)}")
+        return 418, json.dumps({"status": "error", "message": f"Invalid binary payload: {str(e)}"})
+
+    project_name = event.get("project", None)
+    serial = event.get("serial", None)
+
+    if not is_short_key_payload(payload):
+        if not isinstance(payload, dict):
+            return 418, json.dumps({"status": "error", "message": "Binary payload must be a map or array"})
+        # The device is always the one the topic is for, whatever the payload says.
+        #
+        params = dict(payload)
+        params.setdefault("action", "set")
+        params["project"] = project_name
+        params["serial"] = serial
+        return process_as_iot_request(params)
+
+    params = {"project": project_name, "serial": serial}
+    project = find_project_cached(params)
+    device = find_device_cached(params, project) if project else None
+    if not device:
+        return 418, json.dumps({"status": "error", "message": "Data could not be set. Invalid device"})
+
+    key_names = find_data_type_keys_cached(device.model)
+    expanded, key_errors = expand_short_keys(payload, key_names)
+    params.update(expanded)
+    if not params["data"]:
+        return 418, json.dumps({"status": "error", "message": "No valid short keys in binary payload",
+                                "errors": key_errors})
+
+    code, result = modify_record(params, send_to_mqtt=False)
+    if key_errors:
+        result = json.loads(result)
+        result["errors"] = result.get("errors", []) + key_errors
+        result = json.dumps(result)
+    return code, result
+
+
 #
 # This lambda is called via both normal API gateway calls as well as via MQTT
 # calls from an IOT rule.
 #
 def lambda_handler(event, context):
+    ensure_database()
     result = {}
     code = 200
     method = ""
@@ -695,10 +1499,20 @@ def lambda_handler(event, context):
                 body = event["body"]
                 ldebug(f"Parsing body: '{body}'")
                 payload = json.loads(body)
-                code, result = modify_record(payload)
+                if payload.get("devices", None):
+                    code, result = modify_gateway_records(payload)
+                else:
+                    code, result = modify_record(payload)
             elif method == "GET":
                 params = event.get("queryStringParameters", None)
-                code, result = get_record(params)
+                if is_history_request(params):
+                    code, result = get_history(params)
+                elif is_filter_request(params):
+                    code, result = get_filtered_devices(params)
+                elif is_multi_value_request(params):
+                    code, result = get_records(params)
+                else:
+                    code, result = get_record(params)
             elif method == "PUT":
                 params = event.get("queryStringParameters", None)
                 code, result = modify_record(params)
@@ -707,8 +1521,12 @@ def lambda_handler(event, context):
                 code, result = delete_record(params)
         else:
             # Lambda call doesn't have an HTTP Method, so we assume it came here via IOT rule.
+            # The binary data rule sends the encoded payload without an action.
             #
-            code, result = process_as_iot_request(event)
+            if "payload" in event and "action" not in event:
+                code, result = process_binary_iot_request(event)
+            else:
+                code, result = process_as_iot_request(event)
 
 
     except Exception as e:
@@ -717,6 +1535,36 @@ def lambda_handler(event, context):
         result = json.dumps(payload)
         code = 500
 
+    # Send out whatever is still buffered for DynamoDB and Timestream, along with the
+    # MQTT and location updates, and wait for all of them before the invocation ends.
+    #
+    for batch in history_writer.pop_batches():
+        fanout.add("dynamodb", history_writer.write_batch, batch)
+    if ts_writer.pending() > 0:
+        fanout.add("timestream", ts_writer.flush)
+    for key, bucket_start, agg in rollup_updater.pop_buckets():
+        fanout.add("rollup", rollup_updater.write_bucket, key, bucket_start, agg)
+    for key, entries in last_value_writer.pop_updates():
+        fanout.add("lastvalue", last_value_writer.write_device, key, entries)
+    history_failed = history_writer.items_failed
+    timings = {}
+    if fanout.pending() > 0:
+        timings = fanout.run()
+        ldebug(f"Fan-out timings: {timings}")
+        ldebug(f"DynamoDB history writer stats: {history_writer.stats()}")
+        ldebug(f"Timestream writer stats: {ts_writer.stats()}")
+        ldebug(f"Rollup stats: {rollup_updater.stats()}")
+        ldebug(f"Last value stats: {last_value_writer.stats()}")
+        ldebug(f"Dedup stats: {dedup_store.stats()}")
+        ldebug(f"DB connection stats: {connection_limiter.stats()}")
+
+    # Messages claimed for dedup are only marked done once their values are in the database
+    # and the history. Otherwise the claims are dropped so the retry isn't taken for a duplicate.
+    #
+    history_timing = timings.get("dynamodb", {})
+    dedup_store.finish(code < 500 and history_writer.items_failed == history_failed and
+                       not history_timing.get("errors", 0) and not history_timing.get("timeouts", 0))
+
     # response_headers = {
     #     'Content-Type': 'application/json'
     # }
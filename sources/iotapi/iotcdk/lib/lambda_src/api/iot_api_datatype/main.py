@@ -42,6 +42,13 @@ def format_one(rec):
         return_data["label_template"] = rec.label_template
     if rec.ranges:
         return_data["ranges"] = rec.ranges
+    if rec.deadband:
+        return_data["deadband"] = rec.deadband
+        return_data["deadband_percent"] = rec.deadband_percent
+    if rec.min_report_secs:
+        return_data["min_report_secs"] = rec.min_report_secs
+    if rec.short_key is not None:
+        return_data["short_key"] = rec.short_key
     if rec.date_created:
         return_data['date_created'] = rec.date_created.isoformat()
     if rec.last_modified:
@@ -86,6 +93,9 @@ def add_record(params):
                         data_normal = params.get("data_normal", "")
                         label_template = params.get("label_template", "")
                         ranges = params.get("ranges", "")
+                        deadband = float(params.get("deadband", 0))
+                        deadband_percent = params.get("deadband_percent", False)
+                        min_report_secs = int(params.get("min_report_secs", 0))
 
                         type = DataType(name=name,
                                               desc=desc,
@@ -96,9 +106,14 @@ def add_record(params):
                                               data_position = data_position,
                                               data_normal = data_normal,
                                               label_template = label_template,
-                                              ranges = ranges
+                                              ranges = ranges,
+                                              deadband = deadband,
+                                              deadband_percent = deadband_percent,
+                                              min_report_secs = min_report_secs,
+                                              short_key = assign_data_type_short_key(model)
                                               )
                         commit()
+                        bump_metadata_version()
                         result = {"status": "ok", "id": type.id.hex}
                     else:
                         code = 409
@@ -246,9 +261,22 @@ def modify_record(params):
                         if ranges:
                             updates['ranges'] = ranges
 
+                        deadband = params.get("deadband", None)
+                        if deadband is not None:
+                            updates['deadband'] = float(deadband)
+
+                        deadband_percent = params.get("deadband_percent", None)
+                        if deadband_percent is not None:
+                            updates['deadband_percent'] = deadband_percent
+
+                        min_report_secs = params.get("min_report_secs", None)
+                        if min_report_secs is not None:
+                            updates['min_report_secs'] = int(min_report_secs)
+
                         ldebug(f"Updating datatype with data: {str(updates)}")
                         data_type.set(**updates)
                         commit()
+                        bump_metadata_version()
                         code = 200
                         result = {"status": "ok", "id": model.id.hex}
                     else:
@@ -305,6 +333,7 @@ def delete_record(params):
                         device_data_type_id = device_data_type.id.hex
                         device_data_type.delete()
                         commit()
+                        bump_metadata_version()
                         result = {"status": "ok", "id": device_data_type_id}
                         code = 200
                     else:
@@ -325,6 +354,7 @@ def delete_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = {}
     code = 200
     method = ""
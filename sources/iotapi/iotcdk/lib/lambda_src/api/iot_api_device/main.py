@@ -59,11 +59,14 @@ def format_device(project, model, dev, show_cert=False, detail=False):
     if dev.date_created:
         return_data['date_created'] = dev.date_created.isoformat()
 
+    # Certificates are kept in a separate Credential record, so they're only loaded here.
+    #
     if show_cert:
-        return_data["ca_pem"] = dev.device_ca_data
-        return_data["cert_pem"] = dev.device_cert_data
-        return_data["private_key"] = dev.device_private_key_data
-        return_data["public_key"] = dev.device_public_key_data
+        credential = dev.credential
+        return_data["ca_pem"] = credential.ca_data if credential else ""
+        return_data["cert_pem"] = credential.cert_data if credential else ""
+        return_data["private_key"] = credential.private_key_data if credential else ""
+        return_data["public_key"] = credential.public_key_data if credential else ""
 
     return return_data
 
@@ -205,13 +208,14 @@ def add_record(params):
                             #
                             if ModelSecurity(model.model_security) is ModelSecurity.MODEL:
                                 # If there's a model-cert already there, let's copy it.
-                                if model.iot_config_data:
+                                model_credential = model.credential
+                                if model_credential and model_credential.iot_config_data:
                                     ldebug(f"Got IOT settings at MODEL level.")
-                                    iot_config_data = model.iot_config_data
-                                    device_ca = model.model_ca_data
-                                    device_cert = model.model_cert_data
-                                    device_public_key = model.model_public_key_data
-                                    device_private_key = model.model_private_key_data
+                                    iot_config_data = model_credential.iot_config_data
+                                    device_ca = model_credential.ca_data
+                                    device_cert = model_credential.cert_data
+                                    device_public_key = model_credential.public_key_data
+                                    device_private_key = model_credential.private_key_data
                                 else:
                                     ldebug(f"No IOT config data at MODEL. Creating IOT Thing.")
 
@@ -226,18 +230,12 @@ def add_record(params):
                                         ldebug(f"Got IOT result: {str(iot_data)}")
                                         ldebug(f"Writing IOT settings to Model.")
                                         device_ca = iot_data.get('ca_pem', "")
-                                        model.model_ca_data = device_ca
                                         device_cert = iot_data.get('cert_pem', "")
-                                        model.model_cert_data = device_cert
-
                                         device_public_key = iot_data.get('public_key', "")
-                                        model.model_public_key_data = device_public_key
-
                                         device_private_key = iot_data.get('private_key', "")
-                                        model.model_private_key_data = device_private_key
-
                                         iot_config_data = json.dumps(iot_data, indent=4)
-                                        model.iot_config_data = iot_config_data
+                                        set_credential(model, iot_config_data, device_ca, device_cert,
+                                                       device_public_key, device_private_key)
 
                                         # Let's save it to the model.
                                         commit()
@@ -254,13 +252,14 @@ def add_record(params):
                             # see if the certs are per-device or per model family.
                             ldebug(f"Model Security is {ModelSecurity(model.model_security)}.")
                             if ModelSecurity(model.model_security) is ModelSecurity.MODEL:
-                                if model.iot_config_data:
+                                model_credential = model.credential
+                                if model_credential and model_credential.iot_config_data:
                                     ldebug(f"Already have GG iot_config_data from Model.")
-                                    iot_config_data = model.iot_config_data
-                                    device_ca = model.model_ca_data
-                                    device_cert = model.model_cert_data
-                                    device_public_key = model.model_public_key_data
-                                    device_private_key = model.model_private_key_data
+                                    iot_config_data = model_credential.iot_config_data
+                                    device_ca = model_credential.ca_data
+                                    device_cert = model_credential.cert_data
+                                    device_public_key = model_credential.public_key_data
+                                    device_private_key = model_credential.private_key_data
                                 else:
                                     ldebug(f"GG iot_config_data not found. Creating GG for model.")
                                     # unique_id = f"{project.name}-{model.name}-{serial}"
@@ -272,18 +271,12 @@ def add_record(params):
                                     if iot_data:
                                         ldebug(f"Got fresh GG IOT result: {iot_config_data}")
                                         device_ca = iot_data.get('ca_pem', "")
-                                        model.model_ca_data = device_ca
                                         device_cert = iot_data.get('cert_pem', "")
-                                        model.model_cert_data = device_cert
-
                                         device_public_key = iot_data.get('public_key', "")
-                                        model.model_public_key_data = device_public_key
-
                                         device_private_key = iot_data.get('private_key', "")
-                                        model.model_private_key_data = device_private_key
-
                                         iot_config_data = json.dumps(iot_data, indent=4)
-                                        model.iot_config_data = iot_config_data
+                                        set_credential(model, iot_config_data, device_ca, device_cert,
+                                                       device_public_key, device_private_key)
 
                                         # Let's save it to the model.
                                         commit()
@@ -315,13 +308,10 @@ def add_record(params):
                                             name=name,
                                             model=model,
                                             desc=desc,
-                                            device_ca_data=device_ca,
-                                            device_cert_data=device_cert,
-                                            device_public_key_data=device_public_key,
-                                            device_private_key_data=device_private_key,
-                                            iot_config_data=iot_config_data,
                                             is_gateway=is_gateway)
                             if device:
+                                set_credential(device, iot_config_data, device_ca, device_cert,
+                                               device_public_key, device_private_key)
                                 ldebug(f"{serial} device record created")
                                 code = 200
 
@@ -353,7 +343,7 @@ def add_record(params):
     return code, json.dumps(result)
 
 
-@db_session
+@replica_session
 def get_record(params):
     """
     Called with the GET REST call to retrieve one or more records.
@@ -452,6 +442,7 @@ def attach_device_to_gateway(params):
                                 ggv2_detach_device(device)
                                 device.gateway = None
                                 commit()
+                                bump_metadata_version()
 
                             ggv2_attach_device(device, gateway)
 
@@ -511,8 +502,8 @@ def get_device_and_gateway_thing_names(device, gateway):
 
     try:
         ldebug("Getting device and gateway thing names")
-        device_config_data = device.iot_config_data
-        gateway_config_data = gateway.iot_config_data
+        device_config_data = device.credential.iot_config_data if device.credential else None
+        gateway_config_data = gateway.credential.iot_config_data if gateway.credential else None
 
         if device_config_data:
             device_data = json.loads(device_config_data)
@@ -549,6 +540,7 @@ def ggv2_attach_device(device, gateway):
             ldebug(f"Device associated with gateway: {json.dumps(resp, indent=2)}")
             device.gateway = gateway
             commit()
+            bump_metadata_version()
             result = True
 
     except Exception as e:
@@ -573,6 +565,7 @@ def ggv2_detach_device(device):
             ldebug(f"Device dissociated from gateway: {json.dumps(resp, indent=2)}")
             device.gateway = None
             commit()
+            bump_metadata_version()
             result = True
 
     except Exception as e:
@@ -663,6 +656,11 @@ def modify_record(params):
             #
             status = modify_device_params(device)
             if status:
+                # The device may have been moved to another model or project, so the ingest
+                # lambdas have to look it up again.
+                #
+                commit()
+                bump_metadata_version()
                 code = 200
                 result = {"status": "ok"}
             else:
@@ -700,6 +698,7 @@ def delete_record(params):
                     model = device.model.name
                     device.delete()
                     commit()
+                    bump_metadata_version()
                     result = {"status": "ok", "model": model, "id": device_id}
                     code = 200
                 else:
@@ -714,6 +713,7 @@ def delete_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 200
     method = ""
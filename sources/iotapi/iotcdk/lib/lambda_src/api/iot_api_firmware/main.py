@@ -183,23 +183,28 @@ def process_generator(project,
 
     ldebug(f"Processing generator start root: {downloaded_generator_root}")
 
+    # The certs come from the device if it has its own, otherwise from the model.
+    #
+    device_credential = device.credential
+    model_credential = model.credential
+
     root_ca = None
-    if device.device_ca_data:
-        root_ca = device.device_ca_data
-    else:
-        root_ca = model.model_ca_data
+    if device_credential and device_credential.ca_data:
+        root_ca = device_credential.ca_data
+    elif model_credential:
+        root_ca = model_credential.ca_data
 
     device_cert = None
-    if device.device_cert_data:
-        device_cert = device.device_cert_data
-    else:
-        device_cert = model.model_cert_data
+    if device_credential and device_credential.cert_data:
+        device_cert = device_credential.cert_data
+    elif model_credential:
+        device_cert = model_credential.cert_data
 
     private_key = None
-    if device.device_cert_data:
-        private_key = device.device_private_key_data
-    else:
-        private_key = model.model_private_key_data
+    if device_credential and device_credential.cert_data:
+        private_key = device_credential.private_key_data
+    elif model_credential:
+        private_key = model_credential.private_key_data
 
     iot_endpoint = get_param(SIMPLEIOT_IOT_ENDPOINT_KEY)
 
@@ -216,6 +221,7 @@ def process_generator(project,
     # The values passed down will be:
     #
     #     data.name: name of data type
+    #     data.key: short key used in compact binary payloads (see codec.py)
     #     data.type: type of data
     #     data.allow_modify: whether it's a read-only or writable variable
     #     data.show_on_twin: whether it's supposed to be shown on a twin
@@ -411,12 +417,13 @@ def generate_firmware(params):
 
                 if model and device:
                     ldebug(f"Getting datatypes for model: {model.name}")
-                    data_types = DataType.select(lambda dt: dt.model == model)
+                    data_types = get_data_type_key_order(DataType.select(lambda dt: dt.model == model)[:])
                     data_list = []
                     for type in data_types:
                         ldebug(f"Getting datatype details: {type.name}")
                         one = {
                             "name": type.name,
+                            "key": type.short_key,
                             "allow_modify": type.allow_modify,
                             "show_on_twin": type.show_on_twin
                         }
@@ -432,7 +439,7 @@ def generate_firmware(params):
                         label_template = type.label_template
                         if label_template:
                             one["label_template"] = label_template
-                    data_list.append(one)
+                        data_list.append(one)
 
                     if not generator:
                         ldebug(f"ERROR: no generator of this type found")
@@ -537,6 +544,7 @@ def list_generators(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 200
     method = ""
@@ -38,7 +38,8 @@ def format_one(rec):
         "security": enum_to_str(ModelSecurity, rec.model_security),
         "storage": enum_to_str_list(ModelStorage, rec.model_storage),
         "device_count": device_count,
-        "has_digital_twin": rec.has_digital_twin
+        "has_digital_twin": rec.has_digital_twin,
+        "data_log": rec.data_log
     }
 
     if rec.desc:
@@ -180,6 +181,7 @@ def add_record(params):
                     sky_box_url = params.get("sky_box_url", "")
 
                     hw_version = params.get("hw_version", "0.1")
+                    data_log = params.get("data_log", False)
 
                     model = Model(model_project=project,
                                         name=name,
@@ -199,7 +201,8 @@ def add_record(params):
                                         twin3d_model_url=twin3d_model_url,
                                         env_img_url=env_img_url,
                                         sky_box_url=sky_box_url,
-                                        hw_version=hw_version
+                                        hw_version=hw_version,
+                                        data_log=data_log
                                         )
                     commit()
                     result = {"status": "ok", "id": model.id.hex}
@@ -223,7 +226,7 @@ def add_record(params):
     return code, json.dumps(result)
 
 
-@db_session
+@replica_session
 def get_record(params):
     """
     Called with the GET REST call to retrieve one or more records.
@@ -342,11 +345,16 @@ def modify_record(params):
                     if hw_version:
                         updates['hw_version'] = hw_version
 
+                    data_log = params.get("data_log", None)
+                    if data_log is not None:
+                        updates['data_log'] = data_log
+
                     # These changes are OK to make -- they don't impact device functionality.
                     #
                     ldebug(f"Updating model with basic data: {str(updates)}")
                     model.set(**updates)
                     commit()
+                    bump_metadata_version()
                     #
                     # We zero out the already processed updates
                     #
@@ -415,6 +423,7 @@ def modify_record(params):
                             ldebug(f"Updating model with 0 device data: {str(updates)}")
                             model.set(**updates)
                             commit()
+                            bump_metadata_version()
                             code = 200
                             result = {"status": "ok", "id": model.id.hex}
                         else:
@@ -466,6 +475,7 @@ def delete_record(params):
                     model_id = model.id.hex
                     model.delete()
                     commit()
+                    bump_metadata_version()
                     result = {"status": "ok", "id": model_id}
                     code = 200
                 else:
@@ -483,6 +493,7 @@ def delete_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 200
     method = ""
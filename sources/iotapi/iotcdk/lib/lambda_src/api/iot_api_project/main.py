@@ -382,6 +382,7 @@ def modify_record(params):
 
             project.set(**update)
             commit()
+            bump_metadata_version()
         else:
             code = 418
             result = {"status": "error", "message": "Project not found"}
@@ -414,7 +415,8 @@ def delete_record(params):
             if project:
                 project_id = project.id.hex
                 project.delete()
-                flush()
+                commit()
+                bump_metadata_version()
                 result = {"status": "ok", "id": project_id}
                 code = 200
             else:
@@ -429,6 +431,7 @@ def delete_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 200
     method = ""
@@ -1243,6 +1243,7 @@ def process_iot_request(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 200
     method = ""
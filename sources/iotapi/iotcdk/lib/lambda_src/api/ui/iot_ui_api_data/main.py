@@ -125,7 +125,7 @@ def add_record(params):
     return code, json.dumps(result)
 
 
-@db_session
+@replica_session
 def get_record(params):
     """
     Called with the GET REST call to retrieve one or more records.
@@ -219,6 +219,7 @@ def delete_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 200
     method = ""
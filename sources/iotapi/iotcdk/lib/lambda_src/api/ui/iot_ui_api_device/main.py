@@ -10,7 +10,9 @@ import json
 from pony.orm import *
 from iotapp.dbschema import *
 from iotapp.utils import *
+from iotapp.laststore import *
 from iotapp.logger import *
+import boto3
 import os
 import traceback
 
@@ -25,6 +27,15 @@ region = os.environ['AWS_REGION']
 prefix = os.environ['PREFIX']
 stage = os.environ['STAGE']
 
+dynamodb_table_name = None
+dynamodb_client = None
+
+try:
+    dynamodb_table_name = os.environ['DYNAMODB_TABLE']
+    dynamodb_client = boto3.client('dynamodb', region_name=region)
+except Exception as e:
+    ldebug("Unable to connect to DynamoDB table")
+
 connect_database()
 
 
@@ -62,12 +73,8 @@ def format_device(project, model, dev, detail=False):
         if dev.date_manufactured:
             return_data['date_manufactured'] = dev.date_manufactured.isoformat()
 
-        device_data = []
-        data_items = Data.select(lambda d: d.device == dev)
-        return_data['data_count'] = count(data_items)
-        if count(data_items) > 0:
-            device_data = format_device_data(data_items)
-
+        device_data = get_device_data(dev)
+        return_data['data_count'] = len(device_data)
         return_data['datatype'] = device_data
 
     if dev.date_created:
@@ -104,8 +111,30 @@ def format_model(model):
         }
     return model_data
 
-def format_one_device_data(data):
-    type = data.type
+#
+# The current values come from the last-value item for the device in DynamoDB (see laststore.py).
+# If it hasn't been filled in from the database yet, they're read from the database and the item
+# is filled in, so the next poll doesn't have to.
+#
+def get_device_data(dev):
+    project_name = dev.device_project.name
+    last_values = get_device_last_values(dynamodb_client, dynamodb_table_name, project_name, dev.serial_number)
+    if last_values and last_values.complete:
+        device_data = []
+        for name, type in find_data_types_cached(dev.model).items():
+            data = last_values.get(name, type)
+            if data:
+                device_data.append(format_one_device_data(data, type))
+        return device_data
+
+    data_items = Data.select(lambda d: d.device == dev).prefetch(DataType)[:]
+    fill_last_values(dynamodb_client, dynamodb_table_name, project_name, dev.serial_number, data_items)
+    return format_device_data(data_items)
+
+
+def format_one_device_data(data, type=None):
+    if not type:
+        type = data.type
     return_data = {
         "id": data.id.hex,
         "udi": data.udi,
@@ -161,7 +190,7 @@ def format_all(project, model, devices, total_devices):
     return return_data
 
 
-@db_session
+@replica_session
 def get_record(params):
     """
     Called with the GET REST call to retrieve one or more records.
@@ -220,6 +249,7 @@ def get_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 400
     method = ""
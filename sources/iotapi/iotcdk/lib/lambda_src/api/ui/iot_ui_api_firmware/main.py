@@ -147,6 +147,7 @@ def format_one_data_type(type):
         "data_normal": type.data_normal,
         "label_template": type.label_template,
         "ranges": type.ranges,
+        "short_key": type.short_key,
         "date_created":  type.date_created.isoformat()
     }
     return return_data
@@ -236,7 +237,7 @@ def format_all(project, recs):
 
 
 
-@db_session
+@replica_session
 def get_record(params):
     """
     Called with the GET REST call to retrieve one or more records.
@@ -283,6 +284,7 @@ def get_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 404
     method = ""
@@ -20,7 +20,11 @@ import traceback
 
 connect_database()
 
-def format_device(dev, detail=False):
+#
+# 'data' is the list of Data records of the device, if they've already been loaded
+# (see get_data_by_devices). Otherwise they're loaded here.
+#
+def format_device(dev, detail=False, data=None):
     return_data = {
         "id": dev.id.hex,
         "serial": dev.serial_number,
@@ -53,10 +57,12 @@ def format_device(dev, detail=False):
         if dev.date_manufactured:
             return_data['date_manufactured'] = dev.date_manufactured.isoformat()
 
+        if data is None:
+            data = get_data_by_devices([dev]).get(dev.id, [])
         device_data = []
-        if dev.data:
-            return_data['data_count'] = count(dev.data)
-            device_data = format_device_data(dev.data)
+        if data:
+            return_data['data_count'] = len(data)
+            device_data = format_device_data(data)
 
         return_data['data'] = device_data
 
@@ -65,9 +71,18 @@ def format_device(dev, detail=False):
     return return_data
 
 
-def format_model(model, show_devices=False):
+#
+# 'device_counts' and 'data_types' are the device counts and DataTypes of a list of models,
+# keyed by model id, if they've already been loaded (see format_all). Otherwise they're
+# loaded here.
+#
+def format_model(model, show_devices=False, device_counts=None, data_types=None):
+    if device_counts is None:
+        device_counts = get_count_of_devices_by_models([model])
+    if data_types is None:
+        data_types = get_data_types_by_models([model])
 
-    device_count = get_count_of_devices_by_model(model)
+    device_count = device_counts.get(model.id, 0)
 
     return_data = {
         "id": model.id.hex,
@@ -106,18 +121,18 @@ def format_model(model, show_devices=False):
         if model.sky_box_url:
             return_data['sky_box_url'] = model.sky_box_url
 
-    data_types = DataType.select(lambda d: d.model == model)
+    model_data_types = data_types.get(model.id, [])
     data_types_data = []
-    return_data['type_count'] = count(data_types)
-    if count(data_types) > 0:
-        data_types_data = format_data_type(data_types)
+    return_data['type_count'] = len(model_data_types)
+    if model_data_types:
+        data_types_data = format_data_type(model_data_types)
 
     return_data['data_types'] = data_types_data
 
     if show_devices:
         devices = Device.select(lambda d: d.device_project == model.model_project and
-                                          d.model == model)
-        ldebug(f"Got {count(devices)} records")
+                                          d.model == model)[:]
+        ldebug(f"Got {len(devices)} records")
         device_list = []
         for device in devices:
             one_device = format_device(device, False)
@@ -143,6 +158,7 @@ def format_one_data_type(type):
         "data_normal": type.data_normal,
         "label_template": type.label_template,
         "ranges": type.ranges,
+        "short_key": type.short_key,
         "date_created":  type.date_created.isoformat()
     }
     return return_data
@@ -215,6 +231,7 @@ def format_all(project, recs):
         "ml": ml_options
     }
 
+    recs = recs[:]
     return_data = {
         "project": project.name,
         "project_id": project.id.hex,
@@ -222,9 +239,15 @@ def format_all(project, recs):
         "options": options
     }
 
+    # The device counts and DataTypes of all the models are loaded up front, so the number
+    # of queries doesn't go up with the number of models.
+    #
+    device_counts = get_count_of_devices_by_models(recs)
+    data_types = get_data_types_by_models(recs)
+
     model_data = []
     for rec in recs:
-        one = format_model(rec, False)
+        one = format_model(rec, False, device_counts, data_types)
         model_data.append(one)
 
     return_data["models"] = model_data
@@ -302,7 +325,7 @@ def add_record(params):
     return code, json.dumps(result)
 
 
-@db_session
+@replica_session
 def get_record(params):
     """
     Called with the GET REST call to retrieve one or more records.
@@ -350,6 +373,7 @@ def get_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 404
     method = ""
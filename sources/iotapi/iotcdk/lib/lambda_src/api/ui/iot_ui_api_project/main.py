@@ -119,7 +119,7 @@ def format_all(recs):
     return return_data
 
 
-@db_session
+@replica_session
 def get_record(params):
     """
     Called with the GET REST call to retrieve one or more records.
@@ -158,6 +158,7 @@ def get_record(params):
 
 
 def lambda_handler(event, context):
+    ensure_database()
     result = ""
     code = 404
     method = ""
@@ -0,0 +1,197 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: History Aggregation
+# aggregate.py
+#
+# A week of values sent once a second is over 600,000 points -- far more than a chart
+# can show. These reduce the history of a value down to something that can be charted,
+# using NumPy so the work is done in vectorized operations instead of Python loops:
+#
+# - bucket_aggregate: min, max, avg, count, and last value for each N-second bucket.
+#   The pages of history are reduced as they're read, so only one page of raw points
+#   (plus the per-bucket results) is held in memory at a time.
+#   Bucket sizes that are multiples of a minute or an hour can also be computed from the
+#   rollups kept at ingest time (see rollup.py) with merge_rollup_pages.
+#
+# - lttb_downsample: Largest-Triangle-Three-Buckets downsampling to a target number of
+#   points. It keeps the points that preserve the visual shape of the line, so peaks
+#   and dips aren't averaged away. This needs all the points, so they're collected first.
+#
+# Timestamps in and out are in nanoseconds. Non-numeric values are skipped.
+#
+import numpy as np
+
+
+AGGREGATE_FIELDS = ["min", "max", "avg", "count", "last"]
+
+
+def _to_arrays(timestamps, values):
+    t = np.asarray(timestamps, dtype=np.int64)
+    v = np.asarray([np.nan if x is None else x for x in values], dtype=np.float64)
+    valid = ~np.isnan(v)
+    return t[valid], v[valid]
+
+
+#
+# Reduces one page of (sorted) points to per-bucket partials.
+#
+def _reduce_page(t, v, start_ns, bucket_ns):
+    buckets = (t - start_ns) // bucket_ns
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(buckets)]
+    return {
+        "bucket": buckets[starts],
+        "min": np.minimum.reduceat(v, starts),
+        "max": np.maximum.reduceat(v, starts),
+        "sum": np.add.reduceat(v, starts),
+        "count": ends - starts,
+        "last": v[ends - 1],
+        "last_at": t[ends - 1]
+    }
+
+
+#
+# Merges the partials of all the pages. A bucket can be split across two pages, so
+# partials with the same bucket number are combined.
+#
+def _merge_partials(partials):
+    merged = {k: np.concatenate([p[k] for p in partials]) for k in partials[0].keys()}
+    buckets = merged["bucket"]
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(buckets)]
+    return {
+        "bucket": buckets[starts],
+        "min": np.minimum.reduceat(merged["min"], starts),
+        "max": np.maximum.reduceat(merged["max"], starts),
+        "sum": np.add.reduceat(merged["sum"], starts),
+        "count": np.add.reduceat(merged["count"], starts),
+        "last": merged["last"][ends - 1],
+        "last_at": merged["last_at"][ends - 1]
+    }
+
+
+def bucket_partials(pages, start_ns, bucket_ns):
+    """
+    Computes per-bucket aggregates over pages of history.
+
+    :param pages: iterable of (timestamps, values) lists, oldest first (see iter_history_pages)
+    :param start_ns: start of the first bucket, in nanoseconds
+    :param bucket_ns: size of each bucket, in nanoseconds
+    :return: dict of numpy arrays: bucket (number), min, max, sum, count, last, and last_at
+    (timestamp of the last value). Empty buckets are left out. None if there were no values.
+    """
+    partials = []
+    for timestamps, values in pages:
+        t, v = _to_arrays(timestamps, values)
+        if len(t) > 0:
+            partials.append(_reduce_page(t, v, start_ns, bucket_ns))
+
+    if not partials:
+        return None
+    return _merge_partials(partials)
+
+
+def _format_buckets(result, start_ns, bucket_ns):
+    if result is None:
+        return {"timestamps": [], "min": [], "max": [], "avg": [], "count": [], "last": []}
+    return {
+        "timestamps": (start_ns + result["bucket"] * bucket_ns).tolist(),
+        "min": result["min"].tolist(),
+        "max": result["max"].tolist(),
+        "avg": (result["sum"] / result["count"]).tolist(),
+        "count": result["count"].tolist(),
+        "last": result["last"].tolist()
+    }
+
+
+def bucket_aggregate(pages, start_ns, bucket_ns):
+    """
+    Same as bucket_partials, but returns a dict with 'timestamps' (start of each bucket,
+    in nanoseconds) and lists for each of the AGGREGATE_FIELDS.
+    """
+    return _format_buckets(bucket_partials(pages, start_ns, bucket_ns), start_ns, bucket_ns)
+
+
+def merge_rollup_pages(pages, bucket_ns):
+    """
+    Combines pages of rollup items (see iter_rollup_pages) into larger buckets. The bucket
+    size has to be a multiple of the rollup period. Buckets are aligned to multiples of the
+    bucket size.
+
+    :return: same as bucket_aggregate
+    """
+    partials = []
+    for page in pages:
+        starts = np.asarray(page["start"], dtype=np.int64)
+        partials.append({
+            "bucket": starts // bucket_ns,
+            "min": np.asarray(page["min"], dtype=np.float64),
+            "max": np.asarray(page["max"], dtype=np.float64),
+            "sum": np.asarray(page["sum"], dtype=np.float64),
+            "count": np.asarray(page["count"], dtype=np.int64),
+            "last": np.asarray(page["last"], dtype=np.float64),
+            "last_at": np.asarray(page["last_at"], dtype=np.int64)
+        })
+
+    if not partials:
+        return _format_buckets(None, 0, bucket_ns)
+    return _format_buckets(_merge_partials(partials), 0, bucket_ns)
+
+
+def lttb(t, v, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of sorted points.
+
+    :param t: numpy array of timestamps
+    :param v: numpy array of values
+    :param threshold: number of points to return
+    :return: (timestamps, values) numpy arrays
+    """
+    n = len(t)
+    if threshold >= n or threshold < 3:
+        return t, v
+
+    x = t.astype(np.float64)
+    selected = np.zeros(threshold, dtype=np.int64)
+    selected[-1] = n - 1
+
+    # The first and last points are always kept. The rest are split into threshold - 2 buckets
+    # and the point in each that makes the largest triangle with the point picked in the previous
+    # bucket and the average of the next one is kept.
+    #
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = edges[i + 1], (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = v[next_lo:next_hi].mean()
+
+        areas = np.abs((x[a] - avg_x) * (v[lo:hi] - v[a]) - (x[a] - x[lo:hi]) * (avg_y - v[a]))
+        a = lo + int(np.argmax(areas))
+        selected[i + 1] = a
+
+    return t[selected], v[selected]
+
+
+def lttb_downsample(pages, threshold):
+    """
+    Downsamples pages of history to about 'threshold' points with LTTB.
+
+    :return: dict with 'timestamps' (nanoseconds) and 'values' lists.
+    """
+    ts = []
+    vs = []
+    for timestamps, values in pages:
+        t, v = _to_arrays(timestamps, values)
+        ts.append(t)
+        vs.append(v)
+
+    if not ts:
+        return {"timestamps": [], "values": []}
+
+    t, v = lttb(np.concatenate(ts), np.concatenate(vs), threshold)
+    return {"timestamps": t.tolist(), "values": v.tolist()}
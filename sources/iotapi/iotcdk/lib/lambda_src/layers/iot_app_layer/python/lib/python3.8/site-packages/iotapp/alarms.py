@@ -0,0 +1,136 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Range Alarms
+# alarms.py
+#
+# Evaluates incoming values against the ranges defined for their DataType (see the notes
+# on DataType.ranges in dbschema.py):
+#
+# [
+#     {"name": "Good", "low": 50, "high": 100, "color": "green", "when_in": "...", ...},
+#     {"name": "Warning", "low": 10, "high": 49, "color": "yellow", ...},
+#     ...
+# ]
+#
+# The JSON is parsed once per DataType into arrays of low and high limits, and kept in the
+# metadata cache, so it's dropped whenever a DataType is changed. All the values for a DataType
+# in a request are classified in one go, and an alarm event is only created when a value lands
+# in a different range than the one before it (or moves in or out of all of them).
+#
+# A missing low or high means the range is open on that side. If ranges overlap, the first one
+# listed wins.
+#
+import json
+import math
+import numpy as np
+from .cache import metadata_cache
+from .logger import *
+
+
+NO_RANGE = -1
+
+
+def _to_limit(value, default):
+    try:
+        limit = float(value)
+        if not math.isnan(limit):
+            return limit
+    except (TypeError, ValueError):
+        pass
+    return default
+
+
+class CompiledRanges(object):
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.lows = np.array([_to_limit(r.get("low", None), -np.inf) for r in ranges], dtype=np.float64)
+        self.highs = np.array([_to_limit(r.get("high", None), np.inf) for r in ranges], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def classify(self, values):
+        """
+        Returns the index of the range each value is in, or NO_RANGE.
+
+        :param values: numpy array of floats
+        """
+        inside = (values[:, None] >= self.lows) & (values[:, None] <= self.highs)
+        return np.where(inside.any(axis=1), inside.argmax(axis=1), NO_RANGE)
+
+
+def compile_ranges(ranges):
+    """
+    Parses the ranges JSON of a DataType. Ranges that aren't dicts are skipped.
+
+    :return: CompiledRanges, or None if there are no valid ranges.
+    """
+    if not ranges:
+        return None
+    try:
+        parsed = json.loads(ranges) if isinstance(ranges, str) else ranges
+    except ValueError as e:
+        lerror(f"Invalid ranges JSON: {str(e)}")
+        return None
+    if not isinstance(parsed, list):
+        return None
+    parsed = [r for r in parsed if isinstance(r, dict)]
+    if not parsed:
+        return None
+    return CompiledRanges(parsed)
+
+
+def get_compiled_ranges(type):
+    """
+    Returns the CompiledRanges for a DataType (entity or snapshot), or None if it has no ranges.
+    """
+    if not getattr(type, "ranges", None):
+        return None
+    return metadata_cache.get_or_load(("ranges", type.id), lambda: compile_ranges(type.ranges))
+
+
+def _actions(previous, current, value):
+    actions = []
+    if previous:
+        if value < _to_limit(previous.get("low", None), -np.inf) and previous.get("when_below", None):
+            actions.append(previous["when_below"])
+        elif value > _to_limit(previous.get("high", None), np.inf) and previous.get("when_above", None):
+            actions.append(previous["when_above"])
+    if current and current.get("when_in", None):
+        actions.append(current["when_in"])
+    return actions
+
+
+def find_transitions(compiled, previous_value, values):
+    """
+    Finds where a series of values moves from one range to another.
+
+    :param previous_value: the last value stored before these, or None if there isn't one
+    (which counts as being outside all the ranges)
+    :param values: list of numbers, in time order
+    :return: list of (index into values, alarm event) tuples. The event is a dict with 'range',
+    'previous', 'color', 'audio', and 'actions'.
+    """
+    if not values:
+        return []
+    current = compiled.classify(np.asarray(values, dtype=np.float64))
+    start = NO_RANGE
+    if previous_value is not None:
+        start = compiled.classify(np.asarray([previous_value], dtype=np.float64))[0]
+
+    states = np.r_[start, current]
+    transitions = []
+    for i in np.flatnonzero(states[1:] != states[:-1]):
+        previous = compiled.ranges[states[i]] if states[i] != NO_RANGE else None
+        now = compiled.ranges[states[i + 1]] if states[i + 1] != NO_RANGE else None
+        transitions.append((int(i), {
+            "range": now.get("name", "") if now else "",
+            "previous": previous.get("name", "") if previous else "",
+            "color": now.get("color", "") if now else "",
+            "audio": now.get("audio", "") if now else "",
+            "actions": _actions(previous, now, values[i])
+        }))
+    return transitions
@@ -0,0 +1,178 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Metadata Cache
+# cache.py
+#
+# Projects, Models, Devices, and DataTypes almost never change, but the data ingest path
+# used to look them up in the database for every value received. This is a process-level
+# cache for them, so a warm lambda container can resolve them without going to the database.
+#
+# Pony entities are bound to the db_session they were loaded in, so we can't keep them
+# around between invocations. Instead, we cache read-only snapshots with the same attribute
+# names as the entities. Relationships to other entities (i.e. device.model) are snapshots
+# as well, so code that only reads attributes works with either one.
+#
+# Entries are dropped after a TTL and the cache is capped at a maximum number of entries.
+# The Model, DataType, Device, and Project APIs also bump a shared version counter (kept
+# in the DynamoDB table) whenever they change something. The cache checks that counter
+# every few seconds and clears itself if it has changed.
+#
+import os
+import time
+import threading
+import boto3
+from collections import OrderedDict
+from .logger import *
+
+
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", "2048"))
+METADATA_CACHE_TTL_SECS = int(os.environ.get("METADATA_CACHE_TTL_SECS", "300"))
+METADATA_CACHE_VERSION_CHECK_SECS = int(os.environ.get("METADATA_CACHE_VERSION_CHECK_SECS", "10"))
+
+# Key of the DynamoDB item holding the metadata version counter. The sort key is always 0.
+#
+METADATA_VERSION_KEY = "simpleiot:metadata_version"
+
+_version_table = None
+
+
+def _get_version_table():
+    global _version_table
+
+    if not _version_table:
+        table_name = os.environ.get("DYNAMODB_TABLE", None)
+        if table_name:
+            dynamodb = boto3.resource('dynamodb', region_name=os.environ.get("AWS_REGION", None))
+            _version_table = dynamodb.Table(table_name)
+    return _version_table
+
+
+def get_metadata_version():
+    version = 0
+    try:
+        table = _get_version_table()
+        if table:
+            response = table.get_item(Key={"id": METADATA_VERSION_KEY, "recorded_at": 0},
+                                      ProjectionExpression="version")
+            item = response.get("Item", None)
+            if item:
+                version = int(item.get("version", 0))
+    except Exception as e:
+        lerror(f"Error getting metadata version: {str(e)}")
+    return version
+
+
+#
+# This is called by the APIs that modify Projects, Models, Devices, or DataTypes so all
+# the warm containers drop their cached copies.
+#
+def bump_metadata_version():
+    try:
+        table = _get_version_table()
+        if table:
+            table.update_item(Key={"id": METADATA_VERSION_KEY, "recorded_at": 0},
+                              UpdateExpression="ADD version :one",
+                              ExpressionAttributeValues={":one": 1})
+    except Exception as e:
+        lerror(f"Error updating metadata version: {str(e)}")
+
+    metadata_cache.clear()
+
+
+class EntitySnapshot(object):
+    """
+    Read-only copy of the attributes of an entity. Related snapshots can be passed
+    in as keyword arguments.
+    """
+    def __init__(self, entity, attrs, **related):
+        self.id = entity.id
+        for attr in attrs:
+            setattr(self, attr, getattr(entity, attr))
+        for name, value in related.items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}: {getattr(self, 'name', self.id)}"
+
+
+class MetadataCache(object):
+    def __init__(self, max_size=METADATA_CACHE_SIZE, ttl_secs=METADATA_CACHE_TTL_SECS,
+                 version_check_secs=METADATA_CACHE_VERSION_CHECK_SECS):
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        self.version_check_secs = version_check_secs
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = 0
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_secs:
+            return
+        self._version_checked_at = now
+        version = get_metadata_version()
+        if self._version is not None and version != self._version:
+            ldebug(f"Metadata version changed from {self._version} to {version}. Clearing cache.")
+            self.clear()
+            self.invalidations += 1
+        self._version = version
+
+    def get(self, key):
+        self._check_version()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_secs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for the key. If not found, the loader is called and
+        the value it returns is cached. None values are not cached.
+        """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+
+# Process-wide singleton, kept across warm invocations.
+#
+metadata_cache = MetadataCache()
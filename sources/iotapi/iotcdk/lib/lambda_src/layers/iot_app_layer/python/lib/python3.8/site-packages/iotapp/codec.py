@@ -0,0 +1,100 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Binary payload codec
+# codec.py
+#
+# Devices on metered links can send data as CBOR instead of JSON. Instead of DataType
+# names, the values are keyed by the short key of each DataType -- see
+# find_data_type_keys_cached in utils.py. The project and serial number come from
+# the topic the data was sent to, so they're not in the payload either.
+#
+# The payload is a CBOR map of short key to value:
+#
+#   {0: 21.5, 1: 40, 3: "on"}
+#
+# A few negative keys are reserved for the values that apply to the whole message:
+#
+#   -1: timestamp (epoch seconds, or ms/us/ns)
+#   -2: latitude
+#   -3: longitude
+#   -4: altitude
+#
+# It can also be a CBOR array of values in short key order, with null for the ones that
+# weren't sent:
+#
+#   [21.5, 40, null, "on"]
+#
+# A map with string keys is handled the same as a JSON message, for devices that can send
+# CBOR but don't want to use the short keys.
+#
+import cbor2
+from .logger import *
+
+
+KEY_TIMESTAMP = -1
+KEY_GEO_LAT = -2
+KEY_GEO_LNG = -3
+KEY_GEO_ALT = -4
+
+_GEO_KEYS = {
+    KEY_GEO_LAT: "geo_lat",
+    KEY_GEO_LNG: "geo_lng",
+    KEY_GEO_ALT: "geo_alt"
+}
+
+
+def decode_cbor(raw):
+    return cbor2.loads(raw)
+
+
+def is_short_key_payload(payload):
+    if isinstance(payload, list):
+        return True
+    if isinstance(payload, dict):
+        return all(isinstance(k, int) for k in payload.keys())
+    return False
+
+
+#
+# Converts a short key payload to the same parameters a JSON request would have, with
+# the values in the 'data' list. Keys that don't match a DataType are returned as errors.
+#
+def expand_short_keys(payload, key_names):
+    if isinstance(payload, list):
+        payload = {index: value for index, value in enumerate(payload) if value is not None}
+
+    params = {}
+    data = []
+    errors = []
+    timestamp = payload.get(KEY_TIMESTAMP, None)
+
+    for key, value in payload.items():
+        if key in _GEO_KEYS:
+            params[_GEO_KEYS[key]] = value
+        elif key == KEY_TIMESTAMP:
+            continue
+        elif 0 <= key < len(key_names) and key_names[key]:
+            reading = {"name": key_names[key], "value": _format_value(value)}
+            if timestamp is not None:
+                reading["timestamp"] = timestamp
+            data.append(reading)
+        else:
+            errors.append({"key": key, "message": f"Data could not be set. Invalid short key: {key}"})
+
+    params["data"] = data
+    return params, errors
+
+
+#
+# JSON values are sent as strings, so booleans are converted to the same 'true'/'false'
+# strings the firmware would have sent.
+#
+def _format_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
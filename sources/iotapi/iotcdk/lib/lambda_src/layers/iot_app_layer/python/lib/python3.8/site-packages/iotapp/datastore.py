@@ -0,0 +1,348 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Data Store
+# datastore.py
+#
+# Fast-path writes for the last-value Data records.
+#
+# Going through the ORM, each value costs a Data.get, up to four .set() calls and a commit,
+# and two lambdas getting values for the same device at the same time can both miss the
+# Data.get and create duplicate records. Instead, we write all the values for a device with a
+# single INSERT ... ON CONFLICT ... DO UPDATE ... RETURNING statement, relying on the unique
+# (device, type) key on the Data table. The same SQL works on Postgres and on SQLite 3.35+
+# (which is what the tests use).
+#
+# Values can arrive out of order (retries, gateways flushing a backlog). An existing record is
+# only updated if the new value's timestamp is the same or later, so an older value can't
+# replace a newer one.
+#
+# NOTE: since this bypasses the ORM, Data objects already loaded in the current db_session
+# will not see the changes.
+#
+import math
+import uuid
+from decimal import Decimal
+from .dbschema import *
+from .history import is_numeric_data_type
+from .seriesstats import SeriesStats
+from .logger import *
+
+
+BOOL_DATA_TYPES = ["bool", "boolean"]
+TRUE_STRINGS = ["true", "1", "on", "yes"]
+FALSE_STRINGS = ["false", "0", "off", "no"]
+
+STATS_COLUMNS = ["stats_count", "stats_mean", "stats_m2", "stats_ewma"]
+
+# Largest number that fits in the number_value column (24 digits, 8 after the decimal point).
+#
+MAX_NUMBER_VALUE = 1e16
+
+
+class DataRecord(object):
+    """
+    What's returned for each upserted value. Has the same attribute names as a Data
+    entity, so it can be passed to code that formats Data records.
+
+    If stale is set, the value was older than the one already stored, and wasn't written.
+    """
+    def __init__(self, id, type_id, value, position, dimension, timestamp, udi=None,
+                 number_value=None, bool_value=None, stale=False):
+        self.id = id
+        self.udi = udi
+        self.type_id = type_id
+        self.value = value
+        self.position = position
+        self.dimension = dimension
+        self.timestamp = timestamp
+        self.number_value = number_value
+        self.bool_value = bool_value
+        self.stale = stale
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}: {self.id}"
+
+
+def _py2sql(attr, value):
+    if value is None:
+        return None
+    return attr.converters[0].py2sql(value)
+
+
+def _sql2py(attr, value):
+    if value is None:
+        return None
+    return attr.converters[0].sql2py(value)
+
+
+def is_bool_data_type(type):
+    return bool(type.data_type) and type.data_type.lower() in BOOL_DATA_TYPES
+
+
+def get_typed_values(type, value):
+    """
+    Converts a value to what's stored in the number_value and bool_value columns, according
+    to its DataType. Values that can't be converted are stored as None.
+
+    :return: (number, bool) tuple
+    """
+    if is_numeric_data_type(type):
+        try:
+            number = float(value)
+            if math.isfinite(number) and abs(number) < MAX_NUMBER_VALUE:
+                return number, None
+        except (TypeError, ValueError):
+            pass
+    elif is_bool_data_type(type):
+        text = str(value).strip().lower()
+        if text in TRUE_STRINGS:
+            return None, True
+        if text in FALSE_STRINGS:
+            return None, False
+    return None, None
+
+
+def upsert_device_data(device_id, rows):
+    """
+    Inserts or updates the Data records for one device with a single statement.
+
+    :param device_id: UUID of the device
+    :param rows: list of dicts with 'type_id', 'value', 'timestamp' (datetime), and optional
+    'position' and 'dimension' strings, 'number_value' and 'bool_value' (see get_typed_values),
+    and 'stats' (SeriesStats). If position or dimension are empty, the existing values
+    are kept. There should only be one row per type_id.
+    :return: dict of DataRecord objects, keyed by type_id. Rows older than the stored value
+    aren't written, and come back with stale set and the id of the existing record.
+    """
+    if not rows:
+        return {}
+
+    quote = db.provider.quote_name
+    table = quote(Data._table_)
+    id_col = quote(Data.id.columns[0])
+    device_col = quote(Data.device.columns[0])
+    type_col = quote(Data.type.columns[0])
+    value_col = quote(Data.value.columns[0])
+    position_col = quote(Data.position.columns[0])
+    dimension_col = quote(Data.dimension.columns[0])
+    timestamp_col = quote(Data.timestamp.columns[0])
+    number_col = quote(Data.number_value.columns[0])
+    bool_col = quote(Data.bool_value.columns[0])
+    stats_cols = [quote(getattr(Data, attr).columns[0]) for attr in STATS_COLUMNS]
+
+    args = {"device_id": _py2sql(Data.device, device_id)}
+    values_sql = []
+    for i, row in enumerate(rows):
+        args[f"id{i}"] = _py2sql(Data.id, uuid.uuid4())
+        args[f"type{i}"] = _py2sql(Data.type, row["type_id"])
+        args[f"value{i}"] = str(row.get("value", ""))
+        args[f"position{i}"] = str(row.get("position", "") or "")
+        args[f"dimension{i}"] = str(row.get("dimension", "") or "")
+        args[f"timestamp{i}"] = _py2sql(Data.timestamp, row["timestamp"])
+        number = row.get("number_value", None)
+        args[f"number{i}"] = _py2sql(Data.number_value, Decimal(repr(number)) if number is not None else None)
+        args[f"bool{i}"] = _py2sql(Data.bool_value, row.get("bool_value", None))
+        stats = row["stats"].to_row() if row.get("stats", None) else {}
+        for attr in STATS_COLUMNS:
+            args[f"{attr}{i}"] = _py2sql(getattr(Data, attr), stats.get(attr, None))
+        stats_sql = ", ".join([f"${attr}{i}" for attr in STATS_COLUMNS])
+        values_sql.append(f"($id{i}, $device_id, $type{i}, $value{i}, $position{i}, $dimension{i}, "
+                          f"$timestamp{i}, $number{i}, $bool{i}, {stats_sql})")
+
+    sql = f"INSERT INTO {table} ({id_col}, {device_col}, {type_col}, {value_col}, " \
+          f"{position_col}, {dimension_col}, {timestamp_col}, {number_col}, {bool_col}, " \
+          f"{', '.join(stats_cols)}) " \
+          f"VALUES {', '.join(values_sql)} " \
+          f"ON CONFLICT ({device_col}, {type_col}) DO UPDATE SET " \
+          f"{value_col} = excluded.{value_col}, " \
+          f"{timestamp_col} = excluded.{timestamp_col}, " \
+          f"{number_col} = excluded.{number_col}, " \
+          f"{bool_col} = excluded.{bool_col}, " \
+          f"{''.join([f'{col} = COALESCE(excluded.{col}, {table}.{col}), ' for col in stats_cols])}" \
+          f"{position_col} = CASE WHEN excluded.{position_col} = '' " \
+          f"THEN {table}.{position_col} ELSE excluded.{position_col} END, " \
+          f"{dimension_col} = CASE WHEN excluded.{dimension_col} = '' " \
+          f"THEN {table}.{dimension_col} ELSE excluded.{dimension_col} END " \
+          f"WHERE {table}.{timestamp_col} IS NULL OR excluded.{timestamp_col} >= {table}.{timestamp_col} " \
+          f"RETURNING {id_col}, {type_col}, {position_col}, {dimension_col}"
+
+    cursor = db.execute(sql, args)
+
+    rows_by_type = {}
+    for row in rows:
+        rows_by_type[row["type_id"]] = row
+
+    result = {}
+    for data_id, type_id, position, dimension in cursor.fetchall():
+        type_id = _sql2py(Data.type, type_id)
+        row = rows_by_type[type_id]
+        result[type_id] = DataRecord(_sql2py(Data.id, data_id),
+                                     type_id,
+                                     str(row.get("value", "")),
+                                     position,
+                                     dimension,
+                                     row["timestamp"],
+                                     number_value=row.get("number_value", None),
+                                     bool_value=row.get("bool_value", None))
+
+    # Rows that weren't returned were skipped by the timestamp check.
+    #
+    stale_type_ids = [type_id for type_id in rows_by_type.keys() if type_id not in result]
+    if stale_type_ids:
+        existing = select((d.type.id, d.id, d.position, d.dimension) for d in Data
+                          if d.device.id == device_id and d.type.id in stale_type_ids)
+        for type_id, data_id, position, dimension in existing:
+            row = rows_by_type[type_id]
+            result[type_id] = DataRecord(data_id,
+                                         type_id,
+                                         str(row.get("value", "")),
+                                         position,
+                                         dimension,
+                                         row["timestamp"],
+                                         number_value=row.get("number_value", None),
+                                         bool_value=row.get("bool_value", None),
+                                         stale=True)
+    return result
+
+
+def select_device_data(project_id, model_id=None, device_id=None, type_ids=None):
+    """
+    Loads the Data records for one device, or for all the devices of a model, with a single
+    query joined with Device (and through it, Model and Project). The DataType attributes
+    needed to format them can come from the cached DataType snapshots, so nothing is lazily
+    loaded per row.
+
+    :param type_ids: if given, only values of these DataTypes are returned
+    :return: list of (serial number, DataRecord) tuples, ordered by serial number.
+    """
+    query = select((d.id, d.type.id, d.value, d.position, d.dimension, d.timestamp, d.udi, d.device.serial_number)
+                   for d in Data if d.device.device_project.id == project_id)
+    if device_id:
+        query = query.where(lambda d: d.device.id == device_id)
+    if model_id:
+        query = query.where(lambda d: d.device.model.id == model_id)
+    if type_ids is not None:
+        type_ids = list(type_ids)
+        query = query.where(lambda d: d.type.id in type_ids)
+
+    result = []
+    for id, type_id, value, position, dimension, timestamp, udi, serial in query.order_by(8):
+        result.append((serial, DataRecord(id, type_id, value, position, dimension, timestamp, udi)))
+    return result
+
+
+FILTER_OPS = ["gt", "gte", "lt", "lte", "eq", "ne"]
+
+
+def select_devices_by_value(project_id, model_id, type_id, op, threshold, pagenum=1, pagesize=100):
+    """
+    Finds the devices of a model whose current value of a DataType matches a condition, such
+    as 'pressure > 40'. Numbers are compared using the (type, number_value) index. For
+    boolean DataTypes, only 'eq' and 'ne' can be used, and the threshold is a bool.
+
+    :param op: one of FILTER_OPS
+    :return: (total count, list of (serial number, device name, DataRecord) tuples for the page)
+    """
+    query = select((d.device.serial_number, d.device.name, d.id, d.value, d.position, d.dimension,
+                    d.timestamp, d.number_value, d.bool_value)
+                   for d in Data if d.type.id == type_id and d.device.model.id == model_id and
+                   d.device.device_project.id == project_id)
+
+    if isinstance(threshold, bool):
+        if op == "eq":
+            query = query.where(lambda d: d.bool_value == threshold)
+        elif op == "ne":
+            query = query.where(lambda d: d.bool_value != threshold)
+        else:
+            raise ValueError(f"Invalid operation for a boolean value: {op}")
+    else:
+        threshold = Decimal(repr(float(threshold)))
+        if op == "gt":
+            query = query.where(lambda d: d.number_value > threshold)
+        elif op == "gte":
+            query = query.where(lambda d: d.number_value >= threshold)
+        elif op == "lt":
+            query = query.where(lambda d: d.number_value < threshold)
+        elif op == "lte":
+            query = query.where(lambda d: d.number_value <= threshold)
+        elif op == "eq":
+            query = query.where(lambda d: d.number_value == threshold)
+        elif op == "ne":
+            query = query.where(lambda d: d.number_value != threshold)
+        else:
+            raise ValueError(f"Invalid operation: {op}")
+
+    total = query.count()
+    result = []
+    for serial, name, id, value, position, dimension, timestamp, number, flag in \
+            query.order_by(1).page(int(pagenum), int(pagesize)):
+        result.append((serial, name, DataRecord(id, type_id, value, position, dimension, timestamp,
+                                                number_value=float(number) if number is not None else None,
+                                                bool_value=flag)))
+    return total, result
+
+
+#
+# Returns the last stored (value, timestamp) for some of the DataTypes of a device,
+# keyed by type_id. Loaded with a single query.
+#
+def get_last_values(device_id, type_ids):
+    last_values, _ = get_last_values_and_stats(device_id, type_ids)
+    return last_values
+
+
+#
+# Same as get_last_values, but also returns the SeriesStats of each DataType, keyed by type_id.
+#
+def get_last_values_and_stats(device_id, type_ids):
+    if not type_ids:
+        return {}, {}
+    type_ids = list(type_ids)
+    last_values = {}
+    stats = {}
+    for type_id, value, timestamp, count, mean, m2, ewma in \
+            select((d.type.id, d.value, d.timestamp, d.stats_count, d.stats_mean, d.stats_m2, d.stats_ewma)
+                   for d in Data if d.device.id == device_id and d.type.id in type_ids):
+        last_values[type_id] = (value, timestamp)
+        stats[type_id] = SeriesStats(count, mean, m2, ewma)
+    return last_values, stats
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def has_deadband(type):
+    return bool(getattr(type, "deadband", 0) or getattr(type, "deadband_percent", False) or
+                getattr(type, "min_report_secs", 0))
+
+
+#
+# Checks if a new value can be dropped because it's within the deadband of the last one
+# stored for its DataType (see DataType.deadband). Non-numeric values are never dropped.
+#
+def is_within_deadband(type, value, timestamp, last_value, last_timestamp):
+    if not has_deadband(type) or last_value is None:
+        return False
+
+    new = _to_float(value)
+    old = _to_float(last_value)
+    if new is None or old is None:
+        return False
+
+    tolerance = type.deadband
+    if type.deadband_percent:
+        tolerance = abs(old) * type.deadband / 100.0
+    if abs(new - old) > tolerance:
+        return False
+
+    if type.min_report_secs and last_timestamp:
+        if (timestamp - last_timestamp).total_seconds() >= type.min_report_secs:
+            return False
+    return True
@@ -0,0 +1,241 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Database Connection Bootstrap
+# dbconnect.py
+#
+# Every lambda connects to the database when it's loaded (see connect_database). The login
+# data comes out of SecretsManager. To keep cold starts short:
+#
+# - the secret is cached in the process for DB_SECRET_TTL_SECS, and can also be saved to a
+#   file (DB_SECRET_CACHE_FILE, i.e. /tmp/simpleiot-db.json) so it's still there if the
+#   lambda is re-initialized in the same environment. The file is only readable by its owner.
+# - the SecretsManager client is only created once.
+# - checking that all the tables exist when the mapping is generated is optional, and off
+#   unless DB_CHECK_TABLES is set. It issues a query for every table.
+#
+# The connection is kept open and re-used across warm invocations. Lambdas call
+# ensure_database at the start of each one, which checks the connection with a 'SELECT 1'
+# if it hasn't been checked for DB_PROBE_INTERVAL_SECS, and reconnects if it's gone.
+#
+# The database password is rotated by SecretsManager. Connections that are already open keep
+# working, but new ones fail to log in with the old password. When that happens, the secret
+# is fetched again and the connection settings are updated with the new password before
+# retrying.
+#
+# If DB_POOLER_MODE is set, the connection goes through RDS Proxy or PgBouncer instead of
+# straight to the database (see dbpooler.py). If DB_REPLICA_HOST is set, functions that use
+# replica_session instead of db_session read from a replica (see dbreplica.py).
+#
+# NOTE: PonyORM keeps a connection per thread. The new password is applied to the connection
+# settings of the thread that runs ensure_database, which is the one the lambdas use for
+# all their database work.
+#
+import os
+import json
+import time
+import boto3
+from pony.orm import db_session
+from pony.orm.core import BindingError
+from .dbschema import db
+from .dbpooler import get_pooler_bind_args, connection_limiter
+from .dbreplica import add_replica, replica_session, read_from_replica, get_replica_router
+from .logger import *
+
+
+DB_SECRET_TTL_SECS = int(os.environ.get("DB_SECRET_TTL_SECS", "900"))
+DB_SECRET_CACHE_FILE = os.environ.get("DB_SECRET_CACHE_FILE", "")
+DB_CHECK_TABLES = os.environ.get("DB_CHECK_TABLES", "false").lower() in ("1", "true", "yes")
+DB_PROBE_INTERVAL_SECS = int(os.environ.get("DB_PROBE_INTERVAL_SECS", "30"))
+
+# Parts of the error messages returned by PostgreSQL and MySQL when a login is refused.
+#
+AUTH_FAILURE_MESSAGES = ["password authentication failed", "access denied for user"]
+
+
+class SecretCache(object):
+    def __init__(self, ttl_secs=DB_SECRET_TTL_SECS, cache_file=DB_SECRET_CACHE_FILE):
+        self.ttl_secs = ttl_secs
+        self.cache_file = cache_file
+        self.fetches = 0
+        self._client = None
+        self._secrets = {}
+
+    def _get_client(self):
+        if not self._client:
+            self._client = boto3.client(service_name='secretsmanager', region_name=os.environ['AWS_REGION'])
+        return self._client
+
+    def _read_file(self, secret_name):
+        if not self.cache_file:
+            return None
+        try:
+            with open(self.cache_file, "r") as infile:
+                cached = json.load(infile)
+            if cached.get("name", None) == secret_name:
+                return cached
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _write_file(self, secret_name, cached):
+        if not self.cache_file:
+            return
+        try:
+            fd = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as outfile:
+                json.dump({"name": secret_name, **cached}, outfile)
+        except OSError as e:
+            lerror(f"Could not save secret cache file: {str(e)}")
+
+    def get(self, secret_name, refresh=False):
+        """
+        Returns the parsed JSON of a secret. It's only fetched from SecretsManager if it's not
+        cached, the cached copy is older than the TTL, or refresh is set.
+        """
+        now = time.time()
+        if not refresh:
+            cached = self._secrets.get(secret_name, None) or self._read_file(secret_name)
+            if cached and now - cached["fetched_at"] < self.ttl_secs:
+                self._secrets[secret_name] = cached
+                return cached["secret"]
+
+        response = self._get_client().get_secret_value(SecretId=secret_name)
+        self.fetches += 1
+        secret = json.loads(response["SecretString"]) if "SecretString" in response else None
+        cached = {"secret": secret, "fetched_at": now}
+        self._secrets[secret_name] = cached
+        self._write_file(secret_name, cached)
+        return secret
+
+    def clear(self):
+        self._secrets.clear()
+        if self.cache_file and os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+
+
+# Process-wide singleton, kept across warm invocations.
+#
+secret_cache = SecretCache()
+
+_last_probe_at = None
+
+
+def get_db_login_data(refresh=False):
+    try:
+        password_data = secret_cache.get(os.environ['DB_PASS_KEY'], refresh=refresh)
+        if password_data:
+            dbtype = password_data["engine"]
+            dbhost = password_data["host"]
+            port = password_data["port"]
+            username = password_data["username"]
+            password = password_data["password"]
+            dbname = password_data["dbname"]
+            return dbtype, dbhost, port, username, password, dbname
+    except Exception as e:
+        lerror(f"Error getting DB credentials: {str(e)}")
+
+    lerror(f"ERROR: could not obtain DB credentials from SecretsManager.")
+    return None, None, None, None, None, None
+
+
+def is_auth_failure(e):
+    message = str(getattr(e, "original_exc", e)).lower()
+    return any(m in message for m in AUTH_FAILURE_MESSAGES)
+
+
+def _bind(refresh=False):
+    db_type, db_host, db_port, db_user, db_pass, db_name = get_db_login_data(refresh=refresh)
+    if not db_type:
+        lerror("ERROR: can not get DB login data")
+        return False
+
+    provider, db_host, db_port, extra = get_pooler_bind_args(db_type, db_host, db_port)
+    db.bind(provider,
+            user=db_user,
+            password=db_pass,
+            host=db_host,
+            database=db_name,
+            port=str(db_port),
+            **extra)
+    return True
+
+
+#
+# Binds the database and generates the mapping, once per process. Calling it again
+# (i.e. on a warm start) doesn't do anything.
+#
+def connect_database():
+    if db.provider is None:
+        try:
+            _bind()
+        except BindingError:
+            lerror("Error connecting to database with bind")
+        except Exception as e:
+            # A cached password may have been rotated. Fetch it again and retry once.
+            if not is_auth_failure(e):
+                raise
+            ldebug("Database login failed. Refreshing credentials.")
+            _bind(refresh=True)
+
+        if db.provider is not None:
+            add_replica(db.provider)
+
+    if db.provider is not None and db.schema is None:
+        try:
+            db.generate_mapping(check_tables=DB_CHECK_TABLES, create_tables=False)
+        except BindingError:
+            pass
+
+
+def disconnect_db():
+    db.disconnect()
+
+
+#
+# Updates the password PonyORM uses to open new connections, after it's been rotated.
+#
+def _refresh_password():
+    _, _, _, _, db_pass, _ = get_db_login_data(refresh=True)
+    pool = getattr(db.provider, "pool", None)
+    if not db_pass or pool is None:
+        return False
+    refreshed = False
+    for each_pool in getattr(pool, "pools", [pool]):
+        if "password" in getattr(each_pool, "kwargs", {}):
+            each_pool.kwargs["password"] = db_pass
+            refreshed = True
+    return refreshed
+
+
+@db_session
+def _probe():
+    db.select("SELECT 1")
+
+
+def ensure_database():
+    """
+    Makes sure there's a working database connection at the start of an invocation.
+    """
+    global _last_probe_at
+
+    if db.provider is None or db.schema is None:
+        connect_database()
+        return
+
+    now = time.monotonic()
+    if _last_probe_at is not None and now - _last_probe_at < DB_PROBE_INTERVAL_SECS:
+        return
+
+    try:
+        _probe()
+    except Exception as e:
+        ldebug(f"Database connection check failed: {str(e)}")
+        db.disconnect()
+        if is_auth_failure(e):
+            ldebug("Database login failed. Refreshing credentials.")
+            _refresh_password()
+        _probe()
+    _last_probe_at = now
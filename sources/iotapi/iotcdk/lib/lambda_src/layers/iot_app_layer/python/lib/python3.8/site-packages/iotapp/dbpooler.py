@@ -0,0 +1,204 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Connection Pooler Support
+# dbpooler.py
+#
+# Each lambda container keeps its own database connection, so a burst of traffic across all
+# the lambdas can use up the max_connections of the database. Pointing them at a connection
+# pooler (RDS Proxy or PgBouncer) lets a lot of lambda connections share a few database ones.
+#
+# This is turned on by setting DB_POOLER_MODE to 'rds_proxy' or 'pgbouncer'. DB_POOLER_HOST
+# (and DB_POOLER_PORT, if it's not the database port) is the address of the pooler, and is
+# used instead of the host in the database secret. The database name, user, and password
+# are the same.
+#
+# Poolers running in transaction mode hand each transaction to whichever database
+# connection is free, so nothing can be left on a connection between transactions:
+#
+# - Pony normally runs 'SET client_encoding' on each new connection. Here the encoding is
+#   sent with the login instead, so there's no SET.
+# - Pony runs 'DISCARD ALL' at the end of every db_session to clear session state. We don't
+#   create any, so it's skipped. This also saves a round trip per db_session. On RDS Proxy it
+#   would also pin the connection to one database connection.
+# - psycopg2 doesn't use server-side prepared statements, so there are none to lose when the
+#   pooler moves to another database connection.
+# - SET TRANSACTION (used by serializable db_sessions) only lasts until the end of the
+#   transaction, so it's safe.
+#
+# DB_MAX_CONNECTIONS caps how many connections each lambda container can have open at once.
+# Pony uses one per thread, so this only matters for lambdas that use the database from more
+# than one thread. A thread that can't get a connection waits up to DB_CONNECT_WAIT_SECS and
+# then fails. The total for a lambda is the cap times its concurrency. Threads that use the
+# database should call db.disconnect() before they end, to give their connection back.
+#
+# Connection counts and timings are kept in 'connection_limiter' (see stats).
+#
+import os
+import time
+import threading
+from .logger import *
+
+
+POOLER_MODE_NONE = ""
+POOLER_MODE_RDS_PROXY = "rds_proxy"
+POOLER_MODE_PGBOUNCER = "pgbouncer"
+POOLER_MODES = [POOLER_MODE_NONE, POOLER_MODE_RDS_PROXY, POOLER_MODE_PGBOUNCER]
+
+DB_POOLER_MODE = os.environ.get("DB_POOLER_MODE", POOLER_MODE_NONE).lower()
+DB_POOLER_HOST = os.environ.get("DB_POOLER_HOST", "")
+DB_POOLER_PORT = os.environ.get("DB_POOLER_PORT", "")
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", "2"))
+DB_CONNECT_WAIT_SECS = float(os.environ.get("DB_CONNECT_WAIT_SECS", "10"))
+DB_CONNECT_TIMEOUT_SECS = int(os.environ.get("DB_CONNECT_TIMEOUT_SECS", "10"))
+
+
+class ConnectionLimiter(object):
+    def __init__(self, max_connections=DB_MAX_CONNECTIONS, wait_secs=DB_CONNECT_WAIT_SECS):
+        self.max_connections = max_connections
+        self.wait_secs = wait_secs
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+        self.failed = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.connect_ms = 0.0
+
+    def acquire(self):
+        """
+        Waits for a free connection slot.
+
+        :return: True if one was free, False if it timed out.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waits += 1
+            if not self._slots.acquire(timeout=self.wait_secs):
+                with self._lock:
+                    self.timeouts += 1
+                return False
+        with self._lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        return True
+
+    def opened_connection(self, connect_secs):
+        with self._lock:
+            self.opened += 1
+            self.connect_ms += connect_secs * 1000.0
+
+    def release(self, failed=False):
+        with self._lock:
+            self.in_use -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.closed += 1
+        self._slots.release()
+
+    def stats(self):
+        return {
+            "max": self.max_connections,
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "opened": self.opened,
+            "closed": self.closed,
+            "failed": self.failed,
+            "waits": self.waits,
+            "timeouts": self.timeouts,
+            "avg_connect_ms": round(self.connect_ms / self.opened, 1) if self.opened else 0.0
+        }
+
+
+# Process-wide singleton, shared by all the threads.
+#
+connection_limiter = ConnectionLimiter()
+
+
+def is_pooler_enabled(mode=DB_POOLER_MODE):
+    if mode not in POOLER_MODES:
+        lerror(f"Unknown DB_POOLER_MODE '{mode}'. Connecting to the database directly.")
+        return False
+    return mode != POOLER_MODE_NONE
+
+
+#
+# The PostgreSQL provider imports psycopg2 when it's loaded, so the classes are only defined
+# once they're needed.
+#
+_pooler_provider_cls = None
+
+
+def get_pooler_provider():
+    global _pooler_provider_cls
+
+    if _pooler_provider_cls:
+        return _pooler_provider_cls
+
+    from pony.orm.dbproviders.postgres import PGPool, PGProvider
+
+    class PoolerPGPool(PGPool):
+        def _connect(self):
+            if not connection_limiter.acquire():
+                raise self.dbapi_module.OperationalError(
+                    f"No database connection free after {connection_limiter.wait_secs} secs "
+                    f"(DB_MAX_CONNECTIONS={connection_limiter.max_connections})")
+            start = time.monotonic()
+            try:
+                super()._connect()
+            except Exception:
+                connection_limiter.release(failed=True)
+                raise
+            connection_limiter.opened_connection(time.monotonic() - start)
+
+        def release(self, con):
+            # Only ends the transaction. There's no session state to DISCARD.
+            assert con is self.con
+            try:
+                con.rollback()
+            except Exception:
+                self.drop(con)
+                raise
+
+        def drop(self, con):
+            connection_limiter.release()
+            super().drop(con)
+
+        def disconnect(self):
+            if self.con is not None:
+                connection_limiter.release()
+            super().disconnect()
+
+    class PoolerPGProvider(PGProvider):
+        def get_pool(self, *args, **kwargs):
+            return PoolerPGPool(self.dbapi_module, *args, **kwargs)
+
+    _pooler_provider_cls = PoolerPGProvider
+    return _pooler_provider_cls
+
+
+def get_pooler_bind_args(db_type, db_host, db_port, mode=DB_POOLER_MODE):
+    """
+    Returns the provider, host, port, and extra connection settings to bind with. If there's
+    no pooler, they're the ones passed in.
+    """
+    if not is_pooler_enabled(mode):
+        return db_type, db_host, db_port, {}
+    if db_type not in ("postgres", "postgresql"):
+        lerror(f"DB_POOLER_MODE is only supported for PostgreSQL, not '{db_type}'")
+        return db_type, db_host, db_port, {}
+    if not DB_POOLER_HOST:
+        lerror("DB_POOLER_MODE is set without a DB_POOLER_HOST. Connecting to the database directly.")
+        return db_type, db_host, db_port, {}
+
+    extra = {
+        "client_encoding": "UTF8",
+        "connect_timeout": DB_CONNECT_TIMEOUT_SECS
+    }
+    return get_pooler_provider(), DB_POOLER_HOST, DB_POOLER_PORT or db_port, extra
@@ -0,0 +1,235 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Read Replica Routing
+# dbreplica.py
+#
+# GET handlers only read from the database, so they can be sent to a read replica and take
+# the load off the primary. If DB_REPLICA_HOST (and DB_REPLICA_PORT, if it's different) is
+# set, functions decorated with @replica_session instead of @db_session run their queries on
+# the replica:
+#
+#   @replica_session
+#   def get_record(params):
+#       ...
+#
+#   @replica_session(max_lag_secs=0)     # always read from the primary
+#
+# If the replica can't be reached, or its connection fails, the primary is used instead and
+# the replica isn't tried again for DB_REPLICA_RETRY_SECS.
+#
+# Replicas can be a little behind the primary. A replica that is more than max_lag_secs
+# behind (DB_REPLICA_MAX_LAG_SECS by default) isn't used, so a read that follows a write can
+# ask for a tighter bound, or 0 to go to the primary. The lag is checked with
+# pg_last_xact_replay_timestamp() at most every DB_REPLICA_LAG_CHECK_SECS. If the replica
+# hasn't replayed anything yet, it's treated as being too far behind.
+#
+# Both connections use the same login and settings, so this works the same with a pooler
+# (see dbpooler.py), i.e. the read-only endpoint of an RDS Proxy.
+#
+# NOTE: a replica_session nested inside a db_session always uses the primary, so it sees the
+# writes of the outer one. Functions decorated with replica_session must not write anything.
+# If the replica is down, they run on the primary and the writes would go through.
+#
+import os
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from pony.orm import db_session
+from pony.orm.core import local
+from .dbschema import db
+from .logger import *
+
+
+DB_REPLICA_HOST = os.environ.get("DB_REPLICA_HOST", "")
+DB_REPLICA_PORT = os.environ.get("DB_REPLICA_PORT", "")
+DB_REPLICA_MAX_LAG_SECS = float(os.environ.get("DB_REPLICA_MAX_LAG_SECS", "5"))
+DB_REPLICA_LAG_CHECK_SECS = float(os.environ.get("DB_REPLICA_LAG_CHECK_SECS", "5"))
+DB_REPLICA_RETRY_SECS = float(os.environ.get("DB_REPLICA_RETRY_SECS", "60"))
+
+# Seconds the replica is behind the primary. It's 0 if it has replayed everything it has
+# received, so a quiet primary doesn't make it look stale.
+#
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+
+class ReplicaRouter(object):
+    """
+    Takes the place of the PonyORM connection pool, and hands out connections from the
+    primary pool or the replica pool. Each is a separate pool, with a connection per thread.
+    """
+    def __init__(self, primary, replica, retry_secs=DB_REPLICA_RETRY_SECS,
+                 lag_check_secs=DB_REPLICA_LAG_CHECK_SECS):
+        self.primary = primary
+        self.replica = replica
+        self.retry_secs = retry_secs
+        self.lag_check_secs = lag_check_secs
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._down_until = 0
+        self._lag = None
+        self._lag_checked_at = None
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.stale_skips = 0
+        self.failures = 0
+
+    @property
+    def pools(self):
+        return [self.primary, self.replica]
+
+    @property
+    def kwargs(self):
+        return self.primary.kwargs
+
+    def route_to_replica(self, max_lag_secs):
+        self._local.max_lag_secs = max_lag_secs
+
+    def route_to_primary(self):
+        self._local.max_lag_secs = None
+
+    def mark_down(self, reason):
+        with self._lock:
+            self.failures += 1
+            self._down_until = time.monotonic() + self.retry_secs
+            self._lag_checked_at = None
+        lerror(f"Read replica not available, using primary for {self.retry_secs} secs: {reason}")
+
+    def is_down(self):
+        return time.monotonic() < self._down_until
+
+    def _check_lag(self, con):
+        now = time.monotonic()
+        if self._lag_checked_at is not None and now - self._lag_checked_at < self.lag_check_secs:
+            return self._lag
+        cursor = con.cursor()
+        cursor.execute(REPLICA_LAG_SQL)
+        row = cursor.fetchone()
+        # Pony sets the transaction mode on the connection after this, which it can't do in
+        # the middle of a transaction.
+        con.rollback()
+        self._lag = float(row[0]) if row and row[0] is not None else None
+        self._lag_checked_at = now
+        return self._lag
+
+    def _connect_replica(self, max_lag_secs):
+        if max_lag_secs is None or max_lag_secs <= 0 or self.is_down():
+            return None
+        con = None
+        try:
+            con, is_new_connection = self.replica.connect()
+            lag = self._check_lag(con)
+        except Exception as e:
+            if con is not None:
+                try:
+                    self.replica.drop(con)
+                except Exception:
+                    pass
+            self.mark_down(str(e))
+            return None
+        if lag is None or lag > max_lag_secs:
+            self.stale_skips += 1
+            self.replica.release(con)
+            return None
+        return con, is_new_connection
+
+    def connect(self):
+        result = self._connect_replica(getattr(self._local, "max_lag_secs", None))
+        if result:
+            self.replica_reads += 1
+            return result
+        if getattr(self._local, "max_lag_secs", None) is not None:
+            self.primary_reads += 1
+        return self.primary.connect()
+
+    def _pool_for(self, con):
+        return self.replica if con is not None and con is self.replica.con else self.primary
+
+    def release(self, con):
+        self._pool_for(con).release(con)
+
+    def drop(self, con):
+        # Pony drops a connection when it fails, so the replica isn't used for a while.
+        pool = self._pool_for(con)
+        if pool is self.replica:
+            self.mark_down("connection dropped")
+        pool.drop(con)
+
+    def disconnect(self):
+        self.replica.disconnect()
+        self.primary.disconnect()
+
+    def stats(self):
+        return {
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "stale_skips": self.stale_skips,
+            "failures": self.failures,
+            "lag": self._lag,
+            "down": self.is_down()
+        }
+
+
+def add_replica(provider, host=DB_REPLICA_HOST, port=DB_REPLICA_PORT):
+    """
+    Adds a read replica to a bound database. The replica pool is made the same way as the
+    primary one, with the host and port changed.
+    """
+    primary = provider.pool
+    if not host or isinstance(primary, ReplicaRouter):
+        return primary
+    if not hasattr(primary, "kwargs") or "host" not in primary.kwargs:
+        lerror(f"Read replicas are not supported for {provider.dialect}")
+        return primary
+
+    kwargs = dict(primary.kwargs)
+    kwargs["host"] = host
+    if port:
+        kwargs["port"] = str(port)
+    replica = type(primary)(primary.dbapi_module, *primary.args, **kwargs)
+    provider.pool = ReplicaRouter(primary, replica)
+    return provider.pool
+
+
+def get_replica_router():
+    pool = getattr(db.provider, "pool", None)
+    return pool if isinstance(pool, ReplicaRouter) else None
+
+
+@contextmanager
+def read_from_replica(max_lag_secs=DB_REPLICA_MAX_LAG_SECS):
+    router = get_replica_router()
+    if router is None or local.db_session is not None:
+        yield
+        return
+    router.route_to_replica(max_lag_secs)
+    try:
+        yield
+    finally:
+        router.route_to_primary()
+
+
+def replica_session(func=None, max_lag_secs=DB_REPLICA_MAX_LAG_SECS):
+    """
+    Same as db_session, but the queries are sent to the read replica if there is one and it's
+    no more than max_lag_secs behind the primary.
+    """
+    if func is None:
+        return lambda f: replica_session(f, max_lag_secs=max_lag_secs)
+
+    session_func = db_session(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with read_from_replica(max_lag_secs):
+            return session_func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,209 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Duplicate Message Suppression
+# dedup.py
+#
+# Devices publish data at QoS 1 and the IOT rule retries failed Lambda invocations, so the same
+# message can arrive more than once. If a device sends a 'message_id' (or a sequence number in
+# 'seq') with its data, the first message with that id is claimed here and any copies that come
+# in after it are dropped before anything is written or published.
+#
+# Claims are kept in the DynamoDB data table, with the id:
+#
+#   dedup:{project}:{serial}:{message id}
+#
+# and a recorded_at of 0. The item is written with a conditional put, so only one invocation
+# can claim a message, even if the copies are processed at the same time by different
+# containers. Each item has an 'expires_at' attribute (epoch seconds) used as the table TTL,
+# so they're deleted by DynamoDB on their own. Since TTL deletes can lag, expired items can
+# also be claimed again.
+#
+# A claim starts out 'pending', and only expires DEDUP_PENDING_SECS (the function timeout)
+# after it was made. Once the values have been stored and sent out, the invocation calls
+# finish(), which marks its claims 'done' and keeps them for DEDUP_TTL_SECS. If anything
+# failed, the claims are dropped instead, so the retry is processed. If the invocation never
+# gets that far (i.e. it timed out or the container died), the pending claim expires and a
+# retry can claim the message again.
+#
+# Each container also remembers the messages it has claimed recently in a small LRU, so
+# copies that land on the same container don't need a call to DynamoDB.
+#
+# NOTE: message ids only need to be unique per device within DEDUP_TTL_SECS. Devices that
+# send a sequence number that starts over when they reboot should add something to it
+# that changes each boot, or their first messages after a quick reboot will be dropped.
+#
+import os
+import time
+import threading
+from collections import OrderedDict
+from .logger import *
+
+
+DEDUP_KEY_PREFIX = "dedup"
+DEDUP_STATE_PENDING = "pending"
+DEDUP_STATE_DONE = "done"
+DEDUP_TTL_SECS = int(os.environ.get("DEDUP_TTL_SECS", "3600"))
+DEDUP_PENDING_SECS = int(os.environ.get("DEDUP_PENDING_SECS", "60"))
+DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", "4096"))
+
+# Names of the parameters a device can send its message id in, in order of preference.
+#
+MESSAGE_ID_PARAMS = ["message_id", "seq"]
+
+
+def get_message_id(params):
+    if not params:
+        return None
+    for name in MESSAGE_ID_PARAMS:
+        value = params.get(name, None)
+        if value is not None and value != "":
+            return str(value)
+    return None
+
+
+def dedup_key(project_name, serial, message_id):
+    return f"{DEDUP_KEY_PREFIX}:{project_name}:{serial}:{message_id}"
+
+
+def _is_conditional_check_failure(e):
+    return getattr(e, "response", {}).get("Error", {}).get("Code", "") == "ConditionalCheckFailedException"
+
+
+class DedupStore(object):
+    def __init__(self, client, table_name, ttl_secs=DEDUP_TTL_SECS, max_size=DEDUP_CACHE_SIZE,
+                 pending_secs=DEDUP_PENDING_SECS):
+        self.client = client
+        self.table_name = table_name
+        self.ttl_secs = ttl_secs
+        self.pending_secs = pending_secs
+        self.max_size = max_size
+        self.claimed = 0
+        self.completed = 0
+        self.released = 0
+        self.duplicates = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self._recent = OrderedDict()
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _remember(self, key, expires_at):
+        with self._lock:
+            self._recent[key] = expires_at
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.max_size:
+                self._recent.popitem(last=False)
+
+    def _seen_recently(self, key, now):
+        with self._lock:
+            expires_at = self._recent.get(key, None)
+            if expires_at is None:
+                return False
+            if expires_at <= now:
+                del self._recent[key]
+                return False
+            self._recent.move_to_end(key)
+            return True
+
+    def claim(self, project_name, serial, message_id):
+        """
+        Claims a message for processing. The claim is pending until finish() is called.
+
+        :return: True if this is the first time the message has been seen (or an earlier
+        attempt never finished), False if it's a duplicate. If DynamoDB can't be reached,
+        the message is let through.
+        """
+        key = dedup_key(project_name, serial, message_id)
+        now = int(time.time())
+        if self._seen_recently(key, now):
+            self.cache_hits += 1
+            self.duplicates += 1
+            return False
+
+        expires_at = now + self.pending_secs
+        if self.client and self.table_name:
+            try:
+                self.client.put_item(TableName=self.table_name,
+                                     Item={"id": {"S": key},
+                                           "recorded_at": {"N": "0"},
+                                           "state": {"S": DEDUP_STATE_PENDING},
+                                           "claimed_at": {"N": str(now)},
+                                           "expires_at": {"N": str(expires_at)}},
+                                     ConditionExpression="attribute_not_exists(id) OR expires_at < :now",
+                                     ExpressionAttributeValues={":now": {"N": str(now)}})
+            except Exception as e:
+                if _is_conditional_check_failure(e):
+                    self._remember(key, expires_at)
+                    self.duplicates += 1
+                    return False
+                lerror(f"Error claiming message {key}: {str(e)}")
+                self.errors += 1
+
+        self._remember(key, expires_at)
+        self._pending.append(key)
+        self.claimed += 1
+        return True
+
+    def finish(self, succeeded):
+        """
+        Called at the end of an invocation. If everything was stored and sent out, the claims
+        it made are marked done. Otherwise they're released.
+        """
+        pending = self._pending
+        self._pending = []
+        for key in pending:
+            if succeeded:
+                self._complete(key)
+            else:
+                self._release(key)
+
+    def _complete(self, key):
+        expires_at = int(time.time()) + self.ttl_secs
+        self._remember(key, expires_at)
+        self.completed += 1
+        if self.client and self.table_name:
+            try:
+                self.client.update_item(TableName=self.table_name,
+                                        Key={"id": {"S": key}, "recorded_at": {"N": "0"}},
+                                        UpdateExpression="SET #state = :state, expires_at = :expires_at",
+                                        ExpressionAttributeNames={"#state": "state"},
+                                        ExpressionAttributeValues={":state": {"S": DEDUP_STATE_DONE},
+                                                                   ":expires_at": {"N": str(expires_at)}})
+            except Exception as e:
+                lerror(f"Error completing message {key}: {str(e)}")
+                self.errors += 1
+
+    def release(self, project_name, serial, message_id):
+        """
+        Drops the claim on a message that couldn't be processed, so a retry isn't
+        taken for a duplicate.
+        """
+        key = dedup_key(project_name, serial, message_id)
+        if key in self._pending:
+            self._pending.remove(key)
+        self._release(key)
+
+    def _release(self, key):
+        self.released += 1
+        with self._lock:
+            self._recent.pop(key, None)
+        if self.client and self.table_name:
+            try:
+                self.client.delete_item(TableName=self.table_name,
+                                        Key={"id": {"S": key}, "recorded_at": {"N": "0"}})
+            except Exception as e:
+                lerror(f"Error releasing message {key}: {str(e)}")
+
+    def stats(self):
+        return {
+            "claimed": self.claimed,
+            "completed": self.completed,
+            "released": self.released,
+            "duplicates": self.duplicates,
+            "cache_hits": self.cache_hits,
+            "errors": self.errors,
+            "size": len(self._recent)
+        }
@@ -0,0 +1,87 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Fan-out
+# fanout.py
+#
+# Once data has been committed to the database, it is sent out to a number of sinks
+# (MQTT, DynamoDB, Timestream, Location services), each one a separate network call.
+# Instead of making them one after the other, they're queued up with add() and run
+# concurrently on a bounded thread pool with run(), which waits for all of them to finish.
+#
+# Each task is timed, and the timings are rolled up per sink. An exception in one task
+# is logged and counted, but doesn't stop the others.
+#
+# NOTE: tasks run on other threads, so they shouldn't touch the database. Anything they
+# need from database records should be looked up before they're queued. The boto3 clients
+# they use should be created once at module load -- clients (unlike resources) are thread-safe.
+#
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from .logger import *
+
+
+FANOUT_MAX_WORKERS = int(os.environ.get("FANOUT_MAX_WORKERS", "8"))
+FANOUT_TIMEOUT_SECS = float(os.environ.get("FANOUT_TIMEOUT_SECS", "20"))
+
+
+class FanOut(object):
+    def __init__(self, max_workers=FANOUT_MAX_WORKERS, timeout_secs=FANOUT_TIMEOUT_SECS):
+        self.timeout_secs = timeout_secs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fanout")
+        self._tasks = []
+
+    def add(self, sink, fn, *args, **kwargs):
+        self._tasks.append((sink, fn, args, kwargs))
+
+    def pending(self):
+        return len(self._tasks)
+
+    @staticmethod
+    def _run_task(sink, fn, args, kwargs):
+        started = time.monotonic()
+        error = None
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            lerror(f"Error sending to {sink}: {str(e)}")
+            error = e
+        return sink, (time.monotonic() - started) * 1000.0, error
+
+    #
+    # Runs all the queued tasks and waits for them to finish. Returns the timings for each sink:
+    # number of tasks, errors, total and max milliseconds. Tasks still running after the
+    # timeout are counted under 'timeouts'.
+    #
+    def run(self):
+        tasks = self._tasks
+        self._tasks = []
+        timings = {}
+        if not tasks:
+            return timings
+
+        futures = {}
+        for sink, fn, args, kwargs in tasks:
+            future = self._executor.submit(self._run_task, sink, fn, args, kwargs)
+            futures[future] = sink
+            if sink not in timings:
+                timings[sink] = {"count": 0, "errors": 0, "timeouts": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+        done, not_done = wait(futures.keys(), timeout=self.timeout_secs)
+        for future in done:
+            sink, elapsed_ms, error = future.result()
+            timing = timings[sink]
+            timing["count"] += 1
+            timing["total_ms"] = round(timing["total_ms"] + elapsed_ms, 1)
+            timing["max_ms"] = round(max(timing["max_ms"], elapsed_ms), 1)
+            if error:
+                timing["errors"] += 1
+        for future in not_done:
+            sink = futures[future]
+            lerror(f"Timed out waiting for {sink}")
+            timings[sink]["timeouts"] += 1
+
+        return timings
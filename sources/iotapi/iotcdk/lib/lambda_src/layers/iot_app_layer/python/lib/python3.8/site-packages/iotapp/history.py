@@ -0,0 +1,194 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: DynamoDB History Queries
+# history.py
+#
+# Reads back the history items written by historywriter.py for one device value over
+# a time range. Results are returned in columnar form -- one list per field, all in the
+# same order -- instead of one dict per point, which keeps large responses small and
+# fast to serialize:
+#
+# {
+#     "timestamps": [1650000000000, 1650000060000, ...],
+#     "values": [21.5, 21.7, ...],
+#     "latitude": [...]                      (only if asked for)
+# }
+#
+# Paging is done with an opaque 'next' token, which is passed back in to get the next page.
+#
+import json
+import base64
+from boto3.dynamodb.types import TypeDeserializer
+from .logger import *
+
+
+HISTORY_DEFAULT_LIMIT = 1000
+HISTORY_MAX_LIMIT = 10000
+
+# Fields that can be asked for, mapped to the attribute they come from and the name of
+# the list they're returned in.
+#
+HISTORY_FIELDS = {
+    "value": ("value", "values"),
+    "latitude": ("latitude", "latitude"),
+    "longitude": ("longitude", "longitude"),
+    "altitude": ("altitude", "altitude")
+}
+
+TIME_UNIT_DIVISORS = {
+    "ns": 1,
+    "us": 1000,
+    "ms": 1000000,
+    "s": 1000000000
+}
+
+NUMERIC_DATA_TYPES = ["num", "number", "float", "double", "int", "integer"]
+
+_deserializer = TypeDeserializer()
+
+
+def history_key(project_name, serial, name):
+    return f"{project_name}:{serial}:{name}"
+
+
+def is_numeric_data_type(type):
+    return bool(type.data_type) and type.data_type.lower() in NUMERIC_DATA_TYPES
+
+
+def encode_next_token(last_key):
+    recorded_at = _deserializer.deserialize(last_key["recorded_at"])
+    return base64.urlsafe_b64encode(json.dumps({"t": int(recorded_at)}).encode("utf-8")).decode("utf-8")
+
+
+def decode_next_token(token):
+    return int(json.loads(base64.urlsafe_b64decode(token.encode("utf-8")))["t"])
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_json_value(value):
+    # Numbers come back from DynamoDB as Decimals, which json can't handle.
+    if value is None or isinstance(value, str):
+        return value
+    return float(value)
+
+
+def _make_query(table_name, key, start_ns, end_ns, fields, descending):
+    names = {"#id": "id", "#ra": "recorded_at"}
+    values = {":id": {"S": key}}
+    condition = "#id = :id"
+    if start_ns is not None and end_ns is not None:
+        condition += " AND #ra BETWEEN :start AND :end"
+        values[":start"] = {"N": str(start_ns)}
+        values[":end"] = {"N": str(end_ns)}
+    elif start_ns is not None:
+        condition += " AND #ra >= :start"
+        values[":start"] = {"N": str(start_ns)}
+    elif end_ns is not None:
+        condition += " AND #ra <= :end"
+        values[":end"] = {"N": str(end_ns)}
+
+    projection = ["#ra"]
+    for i, field in enumerate(fields):
+        names[f"#f{i}"] = HISTORY_FIELDS[field][0]
+        projection.append(f"#f{i}")
+
+    return {
+        "TableName": table_name,
+        "KeyConditionExpression": condition,
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": values,
+        "ProjectionExpression": ", ".join(projection),
+        "ScanIndexForward": not descending
+    }
+
+
+def query_history(client, table_name, key, start_ns=None, end_ns=None, limit=HISTORY_DEFAULT_LIMIT,
+                  next_token=None, fields=None, descending=False, numeric=False, time_unit="ms"):
+    """
+    Queries the history of one value over a time range.
+
+    :param key: history key (see history_key)
+    :param start_ns, end_ns: time range in nanoseconds (inclusive). Either one can be None.
+    :param limit: maximum number of points returned
+    :param next_token: token returned by the previous page, if any
+    :param fields: list of fields to return (see HISTORY_FIELDS). Defaults to just the value.
+    :param descending: if True, newest values are returned first
+    :param numeric: if True, values are returned as numbers (or None if they can't be converted)
+    :param time_unit: unit of the timestamps returned: s, ms, us, or ns.
+    :return: dict of columnar lists, plus 'count', and 'next' if there are more.
+    """
+    if not fields:
+        fields = ["value"]
+    limit = max(1, min(int(limit), HISTORY_MAX_LIMIT))
+    divisor = TIME_UNIT_DIVISORS.get(time_unit, TIME_UNIT_DIVISORS["ms"])
+
+    query = _make_query(table_name, key, start_ns, end_ns, fields, descending)
+    if next_token:
+        query["ExclusiveStartKey"] = {"id": {"S": key}, "recorded_at": {"N": str(decode_next_token(next_token))}}
+
+    result = {"timestamps": []}
+    columns = {}
+    for field in fields:
+        columns[field] = result.setdefault(HISTORY_FIELDS[field][1], [])
+
+    last_key = None
+    count = 0
+    while count < limit:
+        query["Limit"] = limit - count
+        response = client.query(**query)
+        for item in response.get("Items", []):
+            result["timestamps"].append(int(item["recorded_at"]["N"]) // divisor)
+            for field in fields:
+                attr = item.get(HISTORY_FIELDS[field][0], None)
+                value = _deserializer.deserialize(attr) if attr else None
+                if field == "value" and numeric:
+                    value = _to_number(value)
+                columns[field].append(_to_json_value(value))
+            count += 1
+        last_key = response.get("LastEvaluatedKey", None)
+        if not last_key:
+            break
+        query["ExclusiveStartKey"] = last_key
+
+    result["count"] = count
+    if last_key:
+        result["next"] = encode_next_token(last_key)
+    return result
+
+
+def iter_history_pages(client, table_name, key, start_ns=None, end_ns=None, max_points=None):
+    """
+    Streams the history of a numeric value over a time range, oldest first, one
+    DynamoDB page at a time. Used for aggregation, where the whole range has to be read.
+
+    :param max_points: stop after this many points, if specified
+    :return: generator of (timestamps, values) lists for each page. Timestamps are in
+    nanoseconds and values are floats (or None if they weren't numbers).
+    """
+    query = _make_query(table_name, key, start_ns, end_ns, ["value"], False)
+    count = 0
+    while True:
+        response = client.query(**query)
+        timestamps = []
+        values = []
+        for item in response.get("Items", []):
+            timestamps.append(int(item["recorded_at"]["N"]))
+            attr = item.get("value", None)
+            values.append(_to_number(_deserializer.deserialize(attr)) if attr else None)
+        count += len(timestamps)
+        if timestamps:
+            yield timestamps, values
+
+        last_key = response.get("LastEvaluatedKey", None)
+        if not last_key or (max_points and count >= max_points):
+            break
+        query["ExclusiveStartKey"] = last_key
@@ -0,0 +1,160 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: DynamoDB History Writer
+# historywriter.py
+#
+# Every value received is also written as a history item to the DynamoDB data table,
+# keyed on "{project}:{serial}:{name}" with the time it was recorded (in nanoseconds)
+# as the sort key. Items are only buffered by add(). At the end of the invocation they're
+# split into batches of 25 (the batch_write_item limit) with pop_batches(), and each batch is
+# written with write_batch(), on any thread, so the batches can be sent out concurrently.
+# Anything DynamoDB returns as unprocessed is retried with exponential backoff and jitter.
+#
+# The recorded_at sort key comes from the timestamp sent by the device, if there was one,
+# so readings that arrive late or are backfilled are still stored in the right order.
+#
+import time
+import random
+import threading
+from datetime import datetime
+from decimal import Decimal
+from boto3.dynamodb.types import TypeSerializer
+from .history import history_key
+from .logger import *
+
+
+DYNAMODB_MAX_ITEMS_PER_BATCH = 25
+DYNAMODB_MAX_RETRIES = 6
+DYNAMODB_RETRY_BASE_SECS = 0.05
+DYNAMODB_RETRY_MAX_SECS = 2.0
+
+_serializer = TypeSerializer()
+
+
+def format_nanosec(nanosec):
+    dt = datetime.utcfromtimestamp(nanosec // 1000000000)
+    time_str = '{}.{:09d}'.format(dt.strftime('%Y-%m-%dT%H:%M:%S'), nanosec % 1000000000)
+    return time_str
+
+
+#
+# DynamoDB doesn't accept floats, so they're stored as Decimals.
+#
+def _to_ddb_value(value):
+    if isinstance(value, float):
+        return Decimal(str(value))
+    return value
+
+
+def make_history_item(project_name, model_name, serial, name, value, timestamp_nano,
+                      lat=None, lng=None, alt=None, anomaly_zscore=None):
+    item = {
+        'id': history_key(project_name, serial, name),
+        'name': name,
+        'value': value,
+        'project': project_name,
+        'model': model_name,
+        'serial': serial,
+        'timestamp': format_nanosec(timestamp_nano),
+        'recorded_at': timestamp_nano
+    }
+    if lat:
+        item['latitude'] = _to_ddb_value(lat)
+    if lng:
+        item['longitude'] = _to_ddb_value(lng)
+    if alt:
+        item['altitude'] = _to_ddb_value(alt)
+    if anomaly_zscore is not None:
+        item['anomaly'] = _to_ddb_value(anomaly_zscore)
+    return item
+
+
+class DynamoDBHistoryWriter(object):
+    def __init__(self, client, table_name, batch_size=DYNAMODB_MAX_ITEMS_PER_BATCH,
+                 max_retries=DYNAMODB_MAX_RETRIES):
+        self.client = client
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self._pending = []
+        self._lock = threading.Lock()
+        self.items_written = 0
+        self.items_failed = 0
+        self.retries = 0
+
+    def is_enabled(self):
+        return bool(self.client and self.table_name)
+
+    def pending(self):
+        return len(self._pending)
+
+    def add(self, item):
+        if not self.is_enabled():
+            return
+        self._pending.append(item)
+
+    #
+    # Returns the buffered items in batches that can each be written with write_batch.
+    #
+    def pop_batches(self):
+        pending = self._pending
+        self._pending = []
+        return [pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size)]
+
+    def flush(self):
+        for batch in self.pop_batches():
+            self.write_batch(batch)
+
+    def write_batch(self, items):
+        # A batch can't have two items with the same key, so if the same value was sent
+        # more than once with the same timestamp, only the last one is kept.
+        #
+        by_key = {}
+        for item in items:
+            by_key[(item['id'], item['recorded_at'])] = item
+
+        requests = []
+        for item in by_key.values():
+            try:
+                requests.append({'PutRequest': {'Item': {k: _serializer.serialize(v) for k, v in item.items()}}})
+            except (TypeError, ValueError) as e:
+                lerror(f"Can not write history item {item.get('id', '')}: {str(e)}")
+                with self._lock:
+                    self.items_failed += 1
+        attempt = 0
+        while requests:
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+                unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            except Exception as e:
+                lerror(f"Error writing {len(requests)} history items to DynamoDB: {str(e)}")
+                unprocessed = requests
+
+            with self._lock:
+                self.items_written += len(requests) - len(unprocessed)
+            requests = unprocessed
+            if not requests:
+                break
+
+            attempt += 1
+            if attempt > self.max_retries:
+                lerror(f"Giving up on {len(requests)} history items after {self.max_retries} retries")
+                with self._lock:
+                    self.items_failed += len(requests)
+                break
+
+            with self._lock:
+                self.retries += 1
+            delay = min(DYNAMODB_RETRY_MAX_SECS, DYNAMODB_RETRY_BASE_SECS * (2 ** attempt))
+            time.sleep(random.uniform(0, delay))
+
+    def stats(self):
+        return {
+            "written": self.items_written,
+            "failed": self.items_failed,
+            "retries": self.retries,
+            "pending": self.pending()
+        }
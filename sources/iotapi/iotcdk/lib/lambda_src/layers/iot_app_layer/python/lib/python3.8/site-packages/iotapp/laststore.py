@@ -0,0 +1,330 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Last-value Store
+# laststore.py
+#
+# The current value of every Data record for a device, kept in a single item in the
+# DynamoDB data table so dashboards polling for current values don't have to go to the
+# database. The item has the id:
+#
+#   lastvalue:{project}:{serial}
+#
+# with a recorded_at of 0, and one map attribute per value, named 'v:{name}':
+#
+#   {"id": "{Data id}", "type_id": "{DataType id}", "value": "...", "position": "...",
+#    "dimension": "...", "ts": {timestamp in nanoseconds}}
+#
+# The database is still the system of record. Values are written to the item after they've
+# been committed, with one UpdateItem per device that only touches the values that changed.
+# Invocations for the same device can finish out of order, so each value is only written if
+# the one in the item isn't newer (by 'ts'). If that check fails for any value in the update,
+# the values are written again one at a time, each with its own check, and the older ones
+# are skipped.
+#
+# Values stored before this item existed aren't in it, so until it has been filled in from the
+# database (see fill_last_values) it is marked incomplete and a value missing from it could
+# still be in the database. Filling in only sets values that aren't already there, so it can't
+# overwrite a newer value written at the same time.
+#
+import uuid
+import time
+import random
+import threading
+from datetime import datetime
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from .datastore import DataRecord
+from .historywriter import format_nanosec
+from .logger import *
+
+
+LAST_VALUE_KEY_PREFIX = "lastvalue"
+LAST_VALUE_ATTR_PREFIX = "v:"
+
+# Keeps each UpdateExpression well under the 4KB expression limit.
+#
+LAST_VALUE_MAX_PER_UPDATE = 100
+DYNAMODB_MAX_KEYS_PER_BATCH_GET = 100
+DYNAMODB_MAX_BATCH_GET_RETRIES = 5
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def _is_conditional_check_failure(e):
+    return getattr(e, "response", {}).get("Error", {}).get("Code", "") == "ConditionalCheckFailedException"
+
+
+def last_value_key(project_name, serial):
+    return f"{LAST_VALUE_KEY_PREFIX}:{project_name}:{serial}"
+
+
+def _item_key(key):
+    return {"id": {"S": key}, "recorded_at": {"N": "0"}}
+
+
+def _to_nanosec(timestamp):
+    # Data timestamps are naive UTC datetimes.
+    return int((timestamp - datetime(1970, 1, 1)).total_seconds() * 1e6) * 1000
+
+
+def make_last_value_entry(data, type_id, timestamp_nano=None):
+    """
+    Makes the entry stored for one value from a Data record (or DataRecord).
+    """
+    if timestamp_nano is None:
+        timestamp_nano = _to_nanosec(data.timestamp)
+    return {
+        "id": data.id.hex,
+        "type_id": type_id.hex,
+        "value": data.value or "",
+        "position": data.position or "",
+        "dimension": data.dimension or "",
+        "ts": timestamp_nano
+    }
+
+
+def _to_record(entry):
+    return DataRecord(uuid.UUID(entry["id"]),
+                      uuid.UUID(entry["type_id"]),
+                      entry.get("value", ""),
+                      entry.get("position", ""),
+                      entry.get("dimension", ""),
+                      datetime.utcfromtimestamp(int(entry["ts"]) / 1e9))
+
+
+def _parse_item(item):
+    values = {}
+    for attr, value in item.items():
+        if attr.startswith(LAST_VALUE_ATTR_PREFIX):
+            values[attr[len(LAST_VALUE_ATTR_PREFIX):]] = _to_record(_deserializer.deserialize(value))
+    return values
+
+
+class LastValues(object):
+    """
+    Current values of a device, as DataRecords keyed by DataType name.
+    If 'complete' is False, values that are missing may still be in the database.
+    """
+    def __init__(self, values, complete):
+        self.values = values
+        self.complete = complete
+
+    def get(self, name, type=None):
+        # If the DataType was deleted and re-created, or renamed, the old value is ignored.
+        record = self.values.get(name, None)
+        if record and type and record.type_id != type.id:
+            return None
+        return record
+
+
+class LastValueWriter(object):
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+        self._updates = {}
+        self._lock = threading.Lock()
+        self.items_written = 0
+        self.items_skipped = 0
+        self.items_failed = 0
+
+    def is_enabled(self):
+        return bool(self.client and self.table_name)
+
+    def pending(self):
+        return len(self._updates)
+
+    def add(self, project_name, serial, name, entry):
+        if not self.is_enabled():
+            return
+        entries = self._updates.setdefault(last_value_key(project_name, serial), {})
+        current = entries.get(name, None)
+        if not current or entry["ts"] >= current["ts"]:
+            entries[name] = entry
+
+    #
+    # Returns the updates since the last call as (key, entries) tuples. Each one can be
+    # written with write_device, on any thread.
+    #
+    def pop_updates(self):
+        updates = self._updates
+        self._updates = {}
+        return list(updates.items())
+
+    def flush(self):
+        for key, entries in self.pop_updates():
+            self.write_device(key, entries)
+
+    def _update(self, key, sets, attr_names, attr_values, conditions=None):
+        kwargs = {}
+        if conditions:
+            kwargs["ConditionExpression"] = " AND ".join(conditions)
+        self.client.update_item(TableName=self.table_name,
+                                Key=_item_key(key),
+                                UpdateExpression="SET " + ", ".join(sets),
+                                ExpressionAttributeNames=attr_names,
+                                ExpressionAttributeValues=attr_values,
+                                **kwargs)
+
+    def write_device(self, key, entries, only_if_missing=False, complete=False):
+        names = list(entries.keys())
+        for start in range(0, len(names), LAST_VALUE_MAX_PER_UPDATE):
+            chunk = names[start:start + LAST_VALUE_MAX_PER_UPDATE]
+            attr_names = {"#ts": "timestamp"}
+            attr_values = {":ts": {"S": format_nanosec(max([entries[n]["ts"] for n in chunk]))}}
+            sets = ["#ts = :ts"]
+            conditions = []
+            for i, name in enumerate(chunk):
+                attr_names[f"#v{i}"] = f"{LAST_VALUE_ATTR_PREFIX}{name}"
+                attr_values[f":v{i}"] = _serializer.serialize(entries[name])
+                if only_if_missing:
+                    sets.append(f"#v{i} = if_not_exists(#v{i}, :v{i})")
+                else:
+                    sets.append(f"#v{i} = :v{i}")
+                    attr_names["#vts"] = "ts"
+                    attr_values[f":ts{i}"] = {"N": str(entries[name]["ts"])}
+                    conditions.append(f"(attribute_not_exists(#v{i}) OR #v{i}.#vts <= :ts{i})")
+            if complete and start + LAST_VALUE_MAX_PER_UPDATE >= len(names):
+                attr_names["#complete"] = "complete"
+                attr_values[":complete"] = {"BOOL": True}
+                sets.append("#complete = :complete")
+            try:
+                self._update(key, sets, attr_names, attr_values, conditions)
+                with self._lock:
+                    self.items_written += len(chunk)
+            except Exception as e:
+                if _is_conditional_check_failure(e):
+                    self._write_each(key, {name: entries[name] for name in chunk})
+                    continue
+                lerror(f"Error writing {len(chunk)} last values for {key}: {str(e)}")
+                with self._lock:
+                    self.items_failed += len(chunk)
+
+    #
+    # Writes values one at a time, each only if the one in the item isn't newer. Called when
+    # a value in a combined update was older than the stored one.
+    #
+    def _write_each(self, key, entries):
+        for name, entry in entries.items():
+            attr_names = {"#ts": "timestamp", "#v": f"{LAST_VALUE_ATTR_PREFIX}{name}", "#vts": "ts"}
+            attr_values = {":ts": {"S": format_nanosec(entry["ts"])},
+                           ":v": _serializer.serialize(entry),
+                           ":vts": {"N": str(entry["ts"])}}
+            try:
+                self._update(key, ["#ts = :ts", "#v = :v"], attr_names, attr_values,
+                             ["(attribute_not_exists(#v) OR #v.#vts <= :vts)"])
+                with self._lock:
+                    self.items_written += 1
+            except Exception as e:
+                if _is_conditional_check_failure(e):
+                    with self._lock:
+                        self.items_skipped += 1
+                    continue
+                lerror(f"Error writing last value {name} for {key}: {str(e)}")
+                with self._lock:
+                    self.items_failed += 1
+
+    def remove_value(self, project_name, serial, name):
+        if not self.is_enabled():
+            return
+        self.client.update_item(TableName=self.table_name,
+                                Key=_item_key(last_value_key(project_name, serial)),
+                                UpdateExpression="REMOVE #v",
+                                ExpressionAttributeNames={"#v": f"{LAST_VALUE_ATTR_PREFIX}{name}"})
+
+    def stats(self):
+        return {
+            "written": self.items_written,
+            "skipped": self.items_skipped,
+            "failed": self.items_failed,
+            "pending": self.pending()
+        }
+
+
+def fill_last_values(client, table_name, project_name, serial, data_records, types_by_id=None):
+    """
+    Fills in the last-value item for a device from all its Data records in the database and
+    marks it complete. Values already in the item are left alone.
+
+    :param data_records: list of Data entities for the device, or DataRecords if types_by_id
+    (DataTypes keyed by id) is passed in
+    """
+    if not client or not table_name:
+        return
+    entries = {}
+    for data in data_records:
+        if types_by_id is not None:
+            type = types_by_id.get(data.type_id, None)
+            if type:
+                entries[type.name] = make_last_value_entry(data, type.id)
+        else:
+            entries[data.type.name] = make_last_value_entry(data, data.type.id)
+    if not entries:
+        # Nothing stored yet, but there's no need to check the database again.
+        try:
+            client.update_item(TableName=table_name,
+                               Key=_item_key(last_value_key(project_name, serial)),
+                               UpdateExpression="SET #complete = :complete",
+                               ExpressionAttributeNames={"#complete": "complete"},
+                               ExpressionAttributeValues={":complete": {"BOOL": True}})
+        except Exception as e:
+            lerror(f"Error marking last values complete for {serial}: {str(e)}")
+        return
+    LastValueWriter(client, table_name).write_device(last_value_key(project_name, serial), entries,
+                                                     only_if_missing=True, complete=True)
+
+
+def get_device_last_values(client, table_name, project_name, serial):
+    """
+    Reads the current values of a device with a single GetItem.
+
+    :return: LastValues, or None if there's no item for the device.
+    """
+    if not client or not table_name:
+        return None
+    try:
+        response = client.get_item(TableName=table_name, Key=_item_key(last_value_key(project_name, serial)))
+    except Exception as e:
+        lerror(f"Error reading last values for {serial}: {str(e)}")
+        return None
+
+    item = response.get("Item", None)
+    if not item:
+        return None
+    return LastValues(_parse_item(item), item.get("complete", {}).get("BOOL", False))
+
+
+def batch_get_device_last_values(client, table_name, project_name, serials):
+    """
+    Reads the current values of a list of devices with BatchGetItem, 100 at a time.
+
+    :return: dict of LastValues, keyed by serial number. Devices with no item are left out.
+    """
+    result = {}
+    if not client or not table_name or not serials:
+        return result
+
+    serials_by_key = {last_value_key(project_name, s): s for s in serials}
+    all_keys = list(serials_by_key.keys())
+    for start in range(0, len(all_keys), DYNAMODB_MAX_KEYS_PER_BATCH_GET):
+        keys = [_item_key(k) for k in all_keys[start:start + DYNAMODB_MAX_KEYS_PER_BATCH_GET]]
+        request = {table_name: {"Keys": keys}}
+        attempt = 0
+        while request:
+            try:
+                response = client.batch_get_item(RequestItems=request)
+            except Exception as e:
+                lerror(f"Error reading last values for {len(keys)} devices: {str(e)}")
+                break
+            for item in response.get("Responses", {}).get(table_name, []):
+                result[serials_by_key[item["id"]["S"]]] = LastValues(_parse_item(item), item.get("complete", {}).get("BOOL", False))
+            request = response.get("UnprocessedKeys", None)
+            attempt += 1
+            if request and attempt > DYNAMODB_MAX_BATCH_GET_RETRIES:
+                lerror(f"Giving up reading last values after {DYNAMODB_MAX_BATCH_GET_RETRIES} retries")
+                break
+            if request:
+                time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+    return result
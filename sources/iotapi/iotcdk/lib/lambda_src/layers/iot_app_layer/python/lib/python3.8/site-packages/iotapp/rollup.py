@@ -0,0 +1,264 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: History Rollups
+# rollup.py
+#
+# For numeric values, we keep 1-minute and 1-hour rollups (count, sum, min, max, and last
+# value) next to the raw history in the DynamoDB data table, so long-range queries can
+# read a few hundred rollup items instead of hundreds of thousands of raw points.
+#
+# Rollups are kept as items with the id:
+#
+#   rollup:{period}:{project}:{serial}:{name}
+#
+# and the start of the bucket (in nanoseconds) as recorded_at.
+#
+# They're updated as values come in. All the values for the same bucket in an invocation
+# are combined first, then each bucket is sent with a single atomic UpdateItem that adds to
+# the count and sum, and sets min, max, and last if they're not there yet. The item as it was
+# before the update is returned, so only if the new min, max, or last beats what was there
+# is a second (conditional) update needed. The conditions make sure concurrent updates
+# can only move min and max outward and last forward in time.
+#
+# Rollups can also be rebuilt from the raw history (see rebuild_rollups). The rebuilt items
+# replace the ones that were there.
+#
+import threading
+from decimal import Decimal
+from botocore.exceptions import ClientError
+from .history import history_key, iter_history_pages
+from .historywriter import format_nanosec
+from .aggregate import bucket_partials
+from .logger import *
+
+
+ROLLUP_KEY_PREFIX = "rollup"
+
+# Rollup period names and their length in seconds.
+#
+ROLLUP_PERIODS = {
+    "1m": 60,
+    "1h": 3600
+}
+
+NANOSECS_PER_SEC = 1000000000
+
+
+def rollup_key(period, project_name, serial, name):
+    return f"{ROLLUP_KEY_PREFIX}:{period}:{history_key(project_name, serial, name)}"
+
+
+def rollup_bucket_start(period, timestamp_ns):
+    bucket_ns = ROLLUP_PERIODS[period] * NANOSECS_PER_SEC
+    return timestamp_ns - (timestamp_ns % bucket_ns)
+
+
+def make_rollup_item(key, bucket_start, count, total, min_value, max_value, last, last_at):
+    """
+    Makes a whole rollup item, to be written with DynamoDBHistoryWriter. DynamoDB doesn't
+    accept floats, so the values are stored as Decimals.
+    """
+    return {
+        "id": key,
+        "recorded_at": int(bucket_start),
+        "timestamp": format_nanosec(int(bucket_start)),
+        "count": int(count),
+        "sum": Decimal(repr(float(total))),
+        "min": Decimal(repr(float(min_value))),
+        "max": Decimal(repr(float(max_value))),
+        "last": Decimal(repr(float(last))),
+        "last_at": int(last_at)
+    }
+
+
+def _n(value):
+    return {"N": repr(value) if isinstance(value, float) else str(value)}
+
+
+class RollupUpdater(object):
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.buckets_written = 0
+        self.extra_updates = 0
+
+    def is_enabled(self):
+        return bool(self.client and self.table_name)
+
+    def pending(self):
+        return len(self._buckets)
+
+    def add(self, project_name, serial, name, timestamp_ns, value):
+        if not self.is_enabled():
+            return
+        for period in ROLLUP_PERIODS.keys():
+            bucket_key = (rollup_key(period, project_name, serial, name), rollup_bucket_start(period, timestamp_ns))
+            agg = self._buckets.get(bucket_key, None)
+            if not agg:
+                self._buckets[bucket_key] = {"count": 1, "sum": value, "min": value, "max": value,
+                                             "last": value, "last_at": timestamp_ns}
+            else:
+                agg["count"] += 1
+                agg["sum"] += value
+                agg["min"] = min(agg["min"], value)
+                agg["max"] = max(agg["max"], value)
+                if timestamp_ns >= agg["last_at"]:
+                    agg["last"] = value
+                    agg["last_at"] = timestamp_ns
+
+    #
+    # Returns the buckets updated since the last call, as (key, bucket_start, aggregate) tuples.
+    # Each one can be written with write_bucket, on any thread.
+    #
+    def pop_buckets(self):
+        buckets = self._buckets
+        self._buckets = {}
+        return [(key, start, agg) for (key, start), agg in buckets.items()]
+
+    def flush(self):
+        for key, start, agg in self.pop_buckets():
+            self.write_bucket(key, start, agg)
+
+    def write_bucket(self, key, bucket_start, agg):
+        item_key = {"id": {"S": key}, "recorded_at": {"N": str(bucket_start)}}
+        response = self.client.update_item(
+            TableName=self.table_name,
+            Key=item_key,
+            UpdateExpression="ADD #count :count, #sum :sum "
+                             "SET #ts = if_not_exists(#ts, :ts), #min = if_not_exists(#min, :min), "
+                             "#max = if_not_exists(#max, :max), #last = if_not_exists(#last, :last), "
+                             "#last_at = if_not_exists(#last_at, :last_at)",
+            ExpressionAttributeNames={"#count": "count", "#sum": "sum", "#ts": "timestamp", "#min": "min",
+                                      "#max": "max", "#last": "last", "#last_at": "last_at"},
+            ExpressionAttributeValues={":count": _n(agg["count"]), ":sum": _n(agg["sum"]),
+                                       ":ts": {"S": format_nanosec(bucket_start)},
+                                       ":min": _n(agg["min"]), ":max": _n(agg["max"]),
+                                       ":last": _n(agg["last"]), ":last_at": _n(agg["last_at"])},
+            ReturnValues="ALL_OLD"
+        )
+        old = response.get("Attributes", {})
+        with self._lock:
+            self.buckets_written += 1
+
+        if "min" in old and agg["min"] < float(old["min"]["N"]):
+            self._conditional_set(item_key, "min", agg["min"], "#v > :v")
+        if "max" in old and agg["max"] > float(old["max"]["N"]):
+            self._conditional_set(item_key, "max", agg["max"], "#v < :v")
+        if "last_at" in old and agg["last_at"] >= int(old["last_at"]["N"]):
+            self._conditional_set(item_key, "last", agg["last"], "#at <= :at", agg["last_at"])
+
+    def _conditional_set(self, item_key, attr, value, condition, last_at=None):
+        names = {"#v": attr}
+        values = {":v": _n(value)}
+        update = "SET #v = :v"
+        if last_at is not None:
+            names["#at"] = "last_at"
+            values[":at"] = _n(last_at)
+            update += ", #at = :at"
+        try:
+            self.client.update_item(TableName=self.table_name,
+                                    Key=item_key,
+                                    UpdateExpression=update,
+                                    ConditionExpression=condition,
+                                    ExpressionAttributeNames=names,
+                                    ExpressionAttributeValues=values)
+            with self._lock:
+                self.extra_updates += 1
+        except ClientError as e:
+            # Someone else got there first with a better value.
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    def stats(self):
+        return {
+            "buckets": self.buckets_written,
+            "extra_updates": self.extra_updates,
+            "pending": self.pending()
+        }
+
+
+def rebuild_rollups(client, table_name, writer, key, start_ns=None, end_ns=None):
+    """
+    Recomputes the rollups of one history key over a time range from the raw history. Whole
+    buckets are rebuilt, so the range is widened to the bucket boundaries.
+
+    :param writer: DynamoDBHistoryWriter the rollup items are written with
+    :return: number of rollup items written
+    """
+    project_name, serial, name = key.split(":", 2)
+    written = 0
+    for period, secs in ROLLUP_PERIODS.items():
+        bucket_ns = secs * NANOSECS_PER_SEC
+        range_start = rollup_bucket_start(period, start_ns) if start_ns is not None else None
+        range_end = rollup_bucket_start(period, end_ns) + bucket_ns - 1 if end_ns is not None else None
+
+        pages = iter_history_pages(client, table_name, key, start_ns=range_start, end_ns=range_end)
+        result = bucket_partials(pages, 0, bucket_ns)
+        if result is None:
+            continue
+
+        period_key = rollup_key(period, project_name, serial, name)
+        for i in range(len(result["bucket"])):
+            writer.add(make_rollup_item(period_key,
+                                        int(result["bucket"][i]) * bucket_ns,
+                                        result["count"][i],
+                                        result["sum"][i],
+                                        result["min"][i],
+                                        result["max"][i],
+                                        result["last"][i],
+                                        result["last_at"][i]))
+            written += 1
+    writer.flush()
+    return written
+
+
+def iter_rollup_pages(client, table_name, period, key, start_ns=None, end_ns=None):
+    """
+    Streams the rollup items for a key over a time range, oldest first, one DynamoDB
+    page at a time.
+
+    :return: generator of dicts of lists (bucket start, count, sum, min, max, last, last_at)
+    for each page.
+    """
+    query = {
+        "TableName": table_name,
+        "KeyConditionExpression": "#id = :id",
+        "ExpressionAttributeNames": {"#id": "id", "#ra": "recorded_at", "#count": "count", "#sum": "sum",
+                                     "#min": "min", "#max": "max", "#last": "last", "#last_at": "last_at"},
+        "ExpressionAttributeValues": {":id": {"S": key}},
+        "ProjectionExpression": "#ra, #count, #sum, #min, #max, #last, #last_at"
+    }
+    if start_ns is not None:
+        # The bucket holding the start time starts before it.
+        start_ns = rollup_bucket_start(period, start_ns)
+    if start_ns is not None and end_ns is not None:
+        query["KeyConditionExpression"] += " AND #ra BETWEEN :start AND :end"
+        query["ExpressionAttributeValues"].update({":start": _n(start_ns), ":end": _n(end_ns)})
+    elif start_ns is not None:
+        query["KeyConditionExpression"] += " AND #ra >= :start"
+        query["ExpressionAttributeValues"][":start"] = _n(start_ns)
+    elif end_ns is not None:
+        query["KeyConditionExpression"] += " AND #ra <= :end"
+        query["ExpressionAttributeValues"][":end"] = _n(end_ns)
+
+    while True:
+        response = client.query(**query)
+        page = {"start": [], "count": [], "sum": [], "min": [], "max": [], "last": [], "last_at": []}
+        for item in response.get("Items", []):
+            page["start"].append(int(item["recorded_at"]["N"]))
+            page["count"].append(int(item["count"]["N"]))
+            page["last_at"].append(int(item["last_at"]["N"]))
+            for field in ["sum", "min", "max", "last"]:
+                page[field].append(float(item[field]["N"]))
+        if page["start"]:
+            yield page
+
+        last_key = response.get("LastEvaluatedKey", None)
+        if not last_key:
+            break
+        query["ExclusiveStartKey"] = last_key
@@ -0,0 +1,88 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Streaming Series Statistics
+# seriesstats.py
+#
+# Running statistics for each numeric value of a device, updated as each reading comes in:
+#
+# - count, mean, and variance, with Welford's algorithm, which is numerically stable and
+#   only needs the previous count, mean, and sum of squared differences (m2).
+# - an exponentially weighted moving average (EWMA), which follows recent changes.
+#
+# These are kept in four columns of the Data record for the device and DataType, so they
+# come back with the last value and are written with it, without any extra queries.
+#
+# A reading is flagged as an anomaly if it's more than ANOMALY_SIGMA standard deviations
+# from the mean of the readings before it. No readings are flagged until there have been
+# at least ANOMALY_MIN_COUNT of them. The standard deviation is never taken to be less than
+# ANOMALY_MIN_STDDEV, so a series that has been flat until now flags any value that moves off
+# it, and the z-score stays a finite number that can be stored and sent as JSON.
+#
+import os
+import math
+
+
+ANOMALY_SIGMA = float(os.environ.get("ANOMALY_SIGMA", "3.0"))
+ANOMALY_MIN_COUNT = int(os.environ.get("ANOMALY_MIN_COUNT", "30"))
+ANOMALY_MIN_STDDEV = float(os.environ.get("ANOMALY_MIN_STDDEV", "1e-9"))
+EWMA_ALPHA = float(os.environ.get("EWMA_ALPHA", "0.1"))
+
+
+class SeriesStats(object):
+    def __init__(self, count=0, mean=0.0, m2=0.0, ewma=None):
+        self.count = count or 0
+        self.mean = mean or 0.0
+        self.m2 = m2 or 0.0
+        self.ewma = ewma
+
+    def update(self, value, alpha=EWMA_ALPHA):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.ewma = value if self.ewma is None else alpha * value + (1.0 - alpha) * self.ewma
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+
+    def zscore(self, value, min_stddev=ANOMALY_MIN_STDDEV):
+        return (value - self.mean) / max(self.stddev, min_stddev)
+
+    def check(self, value, sigma=ANOMALY_SIGMA, min_count=ANOMALY_MIN_COUNT):
+        """
+        Checks a value against the readings seen so far (call before update).
+
+        :return: dict with 'zscore', 'mean', and 'stddev' if the value is an anomaly, else None.
+        """
+        if self.count < max(min_count, 2) or sigma <= 0:
+            return None
+        z = self.zscore(value)
+        if abs(z) <= sigma:
+            return None
+        return {"zscore": round(z, 3), "mean": self.mean, "stddev": self.stddev}
+
+    def to_row(self):
+        return {
+            "stats_count": self.count,
+            "stats_mean": self.mean,
+            "stats_m2": self.m2,
+            "stats_ewma": self.ewma
+        }
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "stddev": self.stddev,
+            "ewma": self.ewma
+        }
@@ -0,0 +1,155 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# SimpleIOT: App Layer: Timestream Writer
+# tswriter.py
+#
+# Buffers records going to Timestream so they can be sent with as few write_records
+# calls as possible. Records are grouped by (project, model, serial) so each group shares
+# one set of CommonAttributes. A group is sent out as soon as it reaches the API limit of
+# 100 records. Whatever is left should be sent out with flush() at the end of each
+# invocation.
+#
+# If Timestream rejects some of the records in a call, the others are still written. The
+# rejected ones are logged one at a time, with the reason, and counted in the stats.
+#
+import time
+from .logger import *
+
+
+TIMESTREAM_MAX_RECORDS_PER_WRITE = 100
+
+
+def get_timestream_value_type(type):
+    data_type_value = 'DOUBLE'
+    data_type = type.data_type
+    if data_type:
+        data_type_str = data_type.lower()
+        if data_type_str == 'str' or data_type_str == 'string':
+            data_type_value = 'VARCHAR'
+        elif data_type_str == 'num' or \
+                data_type_str == 'number' or \
+                data_type_str == 'float' or \
+                data_type_str == 'double':
+            data_type_value = 'DOUBLE'
+    return data_type_value
+
+
+def _make_common_attributes(project_name, model_name, serial):
+    return {
+        'Dimensions': [
+            {
+                'Name': "Project",
+                'Value': project_name,
+                'DimensionValueType': 'VARCHAR'
+            },
+            {
+                'Name': "Model",
+                'Value': model_name,
+                'DimensionValueType': 'VARCHAR'
+            },
+            {
+                'Name': "Serial",
+                'Value': serial,
+                'DimensionValueType': 'VARCHAR'
+            }
+        ],
+        'TimeUnit': "NANOSECONDS"
+    }
+
+
+class TimestreamWriter(object):
+    def __init__(self, client, database, table, max_records=TIMESTREAM_MAX_RECORDS_PER_WRITE):
+        self.client = client
+        self.database = database
+        self.table = table
+        self.max_records = max_records
+        self._groups = {}
+        self.reset_stats()
+
+    def is_enabled(self):
+        return bool(self.client and self.database and self.table)
+
+    def reset_stats(self):
+        self.records_written = 0
+        self.records_rejected = 0
+        self.write_calls = 0
+        self.write_secs = 0.0
+
+    #
+    # Adds one record for a device. The record has the same format as the Records passed to
+    # write_records, minus the Project/Model/Serial dimensions and TimeUnit, which are sent
+    # as CommonAttributes.
+    #
+    def add(self, project_name, model_name, serial, record):
+        if not self.is_enabled():
+            return
+        key = (project_name, model_name, serial)
+        records = self._groups.setdefault(key, [])
+        records.append(record)
+        if len(records) >= self.max_records:
+            self._write(key, records[:self.max_records])
+            del records[:self.max_records]
+
+    def add_reading(self, device, type, value, timestamp_nano, dimensions=None):
+        record = {
+            'Time': str(timestamp_nano),
+            'MeasureName': type.name,
+            'MeasureValue': str(value),
+            'MeasureValueType': get_timestream_value_type(type)
+        }
+        if dimensions:
+            record['Dimensions'] = dimensions
+        self.add(device.device_project.name, device.model.name, device.serial_number, record)
+
+    def pending(self):
+        return sum(len(records) for records in self._groups.values())
+
+    def flush(self):
+        groups = self._groups
+        self._groups = {}
+        for key, records in groups.items():
+            for start in range(0, len(records), self.max_records):
+                self._write(key, records[start:start + self.max_records])
+
+    def _write(self, key, records):
+        if not records:
+            return
+        started = time.monotonic()
+        try:
+            response = self.client.write_records(
+                CommonAttributes=_make_common_attributes(*key),
+                DatabaseName=self.database,
+                TableName=self.table,
+                Records=records
+            )
+            self.records_written += len(records)
+            ldebug(f"Timestream write status: {response['ResponseMetadata']['HTTPStatusCode']}")
+        except self.client.exceptions.RejectedRecordsException as e:
+            rejected = e.response.get("RejectedRecords", [])
+            for reject in rejected:
+                index = reject.get("RecordIndex", -1)
+                record = records[index] if 0 <= index < len(records) else None
+                lerror(f"Timestream rejected record for {key}: {reject.get('Reason', '')} - {record}")
+            self.records_rejected += len(rejected)
+            self.records_written += len(records) - len(rejected)
+        except Exception as e:
+            lerror(f"Timestream error writing {len(records)} records for {key}: {str(e)}")
+            self.records_rejected += len(records)
+        finally:
+            self.write_calls += 1
+            self.write_secs += time.monotonic() - started
+
+    def stats(self):
+        records_per_sec = 0
+        if self.write_secs > 0:
+            records_per_sec = round(self.records_written / self.write_secs, 1)
+        return {
+            "written": self.records_written,
+            "rejected": self.records_rejected,
+            "calls": self.write_calls,
+            "pending": self.pending(),
+            "records_per_sec": records_per_sec
+        }
@@ -13,6 +13,8 @@ import uuid
 import datetime
 from .logger import *
 from .dbschema import *
+from .cache import metadata_cache, bump_metadata_version, EntitySnapshot
+from .dbconnect import *
 import os
 import enum
 import boto3
@@ -24,52 +26,8 @@ MAX_CHARACTERS_IN_SANITIZED_NAME = 100
 
 
 # NOTE: 'db' is an app singleton and is globally defined in dbschema.py.
+# Connecting to it (connect_database, ensure_database, disconnect_db) is in dbconnect.py.
 #
-########################################################################
-# Most of the settings come from environment variables in the lambda.
-# We only get the password out of secretsmanager to ensure
-# security compliance.
-#
-def connect_database_with_secretsmanager():
-    #ldebug("Connecting to DB with SecretsManager")
-    try:
-        db_type, db_host, db_port, db_user, db_pass, db_name = get_db_login_data()
-        if not db_type:
-            lerror("ERROR: can not get DB login data")
-            return
-
-        # The DB_PASS_KEY is the key used to get the password out of secrets manager
-        # It's defined in the installer bootstrap and is passed down to us during
-        # lambda creation.
-        #
-        db.bind(db_type,
-                user=db_user,
-                password=db_pass,
-                host=db_host,
-                database=db_name,
-                port=str(db_port))
-    except BindingError:
-        lerror("Error connective to database with bind")
-        pass
-
-    try:
-        #ldebug("Generating DB mapping")
-        db.generate_mapping(check_tables=True, create_tables=False)
-    except BindingError:
-        pass
-
-
-def connect_database():
-    #ldebug("Connecting to database")
-    db.disconnect()  # clean up old connections
-    connect_database_with_secretsmanager()
-    #ldebug("DB Connected")
-
-
-def disconnect_db():
-    #ldebug("Disconnecting from database")
-    db.disconnect()
-
 
 def json_serial_as_string(obj):
     """JSON serializer for objects not serializable by default json code"""
@@ -191,6 +149,151 @@ def find_device(params, project):
                 device = Device.select(lambda d: d.device_project == project and d.serial_number == serial).first()
     return device
 
+#
+# These are cached versions of the lookups above, used by the data ingest path where the
+# same Project, Device, and DataTypes are looked up on every value. They return read-only
+# snapshots (see cache.py) with the same attribute names as the entities. They can be used
+# to read attributes, or their 'id' can be passed in place of the entity when creating
+# records or in queries. If you need to modify the record, load it with its id.
+#
+PROJECT_SNAPSHOT_ATTRS = ["name", "desc"]
+MODEL_SNAPSHOT_ATTRS = ["name", "model_type", "has_location_tracking", "tracker_name", "data_log"]
+DEVICE_SNAPSHOT_ATTRS = ["serial_number", "name", "is_gateway"]
+DATATYPE_SNAPSHOT_ATTRS = ["name", "desc", "udi", "data_type", "units", "allow_modify", "show_on_twin",
+                           "data_position", "data_normal", "label_template", "ranges",
+                           "deadband", "deadband_percent", "min_report_secs"]
+
+
+def _project_cache_key(params):
+    if params:
+        proj_id = params.get("project_id", None)
+        if proj_id:
+            return "project", "id", proj_id
+        project_name = params.get("project", None)
+        if not project_name:
+            project_name = params.get("project_name", None)
+        if project_name:
+            return "project", "name", project_name
+    return None
+
+
+def find_project_cached(params):
+    key = _project_cache_key(params)
+    if not key:
+        return None
+
+    def load():
+        project = find_project(params)
+        if project:
+            return EntitySnapshot(project, PROJECT_SNAPSHOT_ATTRS)
+        return None
+
+    return metadata_cache.get_or_load(key, load)
+
+
+def snapshot_model(model, project):
+    return EntitySnapshot(model, MODEL_SNAPSHOT_ATTRS, model_project=project)
+
+
+def find_model_cached(params, project):
+    if not params or not project:
+        return None
+    model_name = params.get("model_name", None)
+    if not model_name:
+        model_name = params.get("model", None)
+    if model_name:
+        key = ("model", project.id, "name", model_name)
+    else:
+        model_id = params.get("model_id", None)
+        if not model_id:
+            return None
+        key = ("model", project.id, "id", model_id)
+
+    def load():
+        model = find_model(params, Project[project.id])
+        if model:
+            return snapshot_model(model, project)
+        return None
+
+    return metadata_cache.get_or_load(key, load)
+
+
+def find_device_cached(params, project):
+    if not params or not project:
+        return None
+    device_id = params.get("device_id", None)
+    if device_id:
+        key = ("device", project.id, "id", device_id)
+    else:
+        serial = params.get("serial", None)
+        if not serial:
+            serial = params.get("device", None)
+        if not serial:
+            return None
+        key = ("device", project.id, "serial", serial)
+
+    def load():
+        device = find_device(params, Project[project.id])
+        if device:
+            model = snapshot_model(device.model, project)
+            return EntitySnapshot(device, DEVICE_SNAPSHOT_ATTRS, model=model, device_project=project)
+        return None
+
+    return metadata_cache.get_or_load(key, load)
+
+
+def find_data_types_cached(model):
+    """
+    Returns a dict of all the DataTypes for a model, keyed by name. They're all loaded
+    with a single query the first time a model is seen.
+    """
+    model_id = model.id
+
+    def load():
+        data_types = {}
+        for dt in DataType.select(lambda dt: dt.model.id == model_id):
+            data_types[dt.name] = EntitySnapshot(dt, DATATYPE_SNAPSHOT_ATTRS)
+        return data_types
+
+    return metadata_cache.get_or_load(("datatypes", model_id), load)
+
+
+#
+# Compact (binary) payloads refer to DataTypes by number instead of by name. Each DataType
+# gets the next number from its model when it's created (its short_key), starting at 0. The
+# numbers are kept in the database and never reused, so adding or deleting a DataType doesn't
+# change the keys of the others, and the firmware generator emits the same ones.
+#
+def assign_data_type_short_key(model):
+    model = Model.get_for_update(id=model.id)
+    short_key = model.next_short_key or 0
+    model.next_short_key = short_key + 1
+    return short_key
+
+
+def get_data_type_key_order(data_types):
+    """
+    Returns the DataTypes that have a short key, ordered by it.
+    """
+    return sorted([dt for dt in data_types if dt.short_key is not None], key=lambda dt: dt.short_key)
+
+
+def find_data_type_keys_cached(model):
+    """
+    Returns the list of DataType names for a model, indexed by their short key. Keys of
+    deleted DataTypes are None.
+    """
+    model_id = model.id
+
+    def load():
+        data_types = get_data_type_key_order(DataType.select(lambda dt: dt.model.id == model_id)[:])
+        key_names = [None] * (data_types[-1].short_key + 1 if data_types else 0)
+        for dt in data_types:
+            key_names[dt.short_key] = dt.name
+        return key_names
+
+    return metadata_cache.get_or_load(("datatype_keys", model_id), load)
+
 #
 # Utility routine to get count of devices of type model in the database. If it's zero, no such devices exist.
 #
@@ -209,9 +312,91 @@ def get_count_of_devices_by_model(model):
     return device_count
 
 
+#
+# These load what's needed to format a list of models or devices with one query each,
+# instead of one (or more) per model or device. The results are keyed by the id of the
+# model or device, and the ones with nothing are left out. DataType.ranges is lazy, so it's
+# loaded with the DataTypes.
+#
+def get_count_of_devices_by_models(models):
+    model_ids = [m.id for m in models]
+    if not model_ids:
+        return {}
+    return dict(select((d.model.id, count(d)) for d in Device if d.model.id in model_ids))
+
+
+def get_data_types_by_models(models):
+    model_ids = [m.id for m in models]
+    result = {}
+    if model_ids:
+        for data_type in select(t for t in DataType if t.model.id in model_ids).prefetch(DataType.ranges):
+            result.setdefault(data_type.model.id, []).append(data_type)
+    return result
+
+
+def get_data_by_devices(devices):
+    device_ids = [d.id for d in devices]
+    result = {}
+    if device_ids:
+        for data in select(d for d in Data if d.device.id in device_ids).prefetch(Data.type, DataType.ranges):
+            result.setdefault(data.device.id, []).append(data)
+    return result
+
+
+#
+# Stores the AWS IOT settings and certificates of a Device, Model, or Project in its
+# Credential record, creating one if needed (see Credential in dbschema.py).
+#
+def set_credential(owner, iot_config_data, ca_data, cert_data, public_key_data, private_key_data):
+    credential = owner.credential
+    if not credential:
+        credential = Credential()
+        owner.credential = credential
+    credential.iot_config_data = iot_config_data or ""
+    credential.ca_data = ca_data or ""
+    credential.cert_data = cert_data or ""
+    credential.public_key_data = public_key_data or ""
+    credential.private_key_data = private_key_data or ""
+    credential.last_modified = datetime.utcnow()
+    return credential
+
+
 def str2bool(v):
   return v.lower() in ("yes", "true", "t", "1")
 
+#
+# Devices may send timestamps as epoch seconds, milliseconds, microseconds, or nanoseconds,
+# or as ISO-8601 strings. We can tell the numeric ones apart by their magnitude. This returns
+# nanoseconds since the epoch, or None if the value can't be parsed, so callers can fall back
+# to the server time.
+#
+def parse_timestamp_nanosec(value):
+    if value is None or value == "":
+        return None
+    try:
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+                return int(dt.timestamp() * 1e6) * 1000
+
+        value = float(value)
+        if value < 1e11:
+            return int(value * 1e9)
+        elif value < 1e14:
+            return int(value * 1e6)
+        elif value < 1e17:
+            return int(value * 1e3)
+        return int(value)
+    except Exception as e:
+        lerror(f"Invalid timestamp {value}: {str(e)}")
+        return None
+
+
+def nanosec_to_datetime(nanosec):
+    return datetime.utcfromtimestamp(nanosec / 1e9)
+
 ##############################################################################
 # This allows looking up a string from elements of an Enum.
 # Used to lookup device model fields. The lookup is case-insensitive.
@@ -338,24 +523,6 @@ def get_secret(secret_name):
         else:
             return None
 
-def get_db_login_data():
-    try:
-        DB_PASS_KEY = os.environ['DB_PASS_KEY']
-        password_data = get_secret(DB_PASS_KEY)
-        if password_data:
-            dbtype = password_data["engine"]
-            dbhost = password_data["host"]
-            port = password_data["port"]
-            username = password_data["username"]
-            password = password_data["password"]
-            dbname = password_data["dbname"]
-            return dbtype, dbhost, port, username, password, dbname
-    except Exception as e:
-        pass
-
-    lerror(f"ERROR: could not obtain DB credentials from SecretsManager.")
-    return None, None, None, None, None, None
-
 #
 # This is where we return the response headers returned by API calls. Method is passed
 # down in case we need to return a different value per method.
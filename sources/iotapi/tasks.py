@@ -59,6 +59,12 @@ ROLLBACK_ON_FAIL = True
 #
 DATABASE_USE_AURORA = False
 
+#
+# If True, an RDS Proxy is created in front of the database and the lambdas connect through it.
+# Check in cdk_database.ts and iotapp/dbpooler.py for details.
+#
+DATABASE_USE_PROXY = False
+
 
 def load_defaults():
     config = None
@@ -233,6 +239,7 @@ def bootstrap(c, team=None):
                     export POSTGRES_FULL_VERSION='{engine_version}'; \
                     export POSTGRES_MAJOR_VERSION='{engine_major}'; \
                     export DATABASE_USE_AURORA='{DATABASE_USE_AURORA}'; \
+                    export DATABASE_USE_PROXY='{DATABASE_USE_PROXY}'; \
                     {cdk_bootstrap}; \
                     if [ $? -eq 0 ]; then \
                       cd iotcdk; \
@@ -320,6 +327,7 @@ def deploy(c, team=None, rollback=True):
                     export POSTGRES_FULL_VERSION='{engine_version}'; \
                     export POSTGRES_MAJOR_VERSION='{engine_major}'; \
                     export DATABASE_USE_AURORA='{DATABASE_USE_AURORA}'; \
+                    export DATABASE_USE_PROXY='{DATABASE_USE_PROXY}'; \
                     cd iotcdk; \
                     npm run build; \
                     mkdir {tmp_dir} && export TMP=$PWD/{tmp_dir} && cdk deploy {stack_config} \
@@ -430,9 +438,13 @@ def apitest(c, team):
 # IT WILL DESTROY YOUR EXISTING DATA IRREVERSIBLY.
 # IT SHOULD ONLY BE USED IN DEVELOPMENT ENVIRONMENTS MORE THAN ONCE.
 #
+# To upgrade the schema of a database that's already in use, run it with --migrate
+# instead. That only adds the columns, tables, and indexes that are missing, and keeps
+# all the data (see db/schema/dbmigrate.py).
+#
 
 @task()
-def dbsetup(c, team=None):
+def dbsetup(c, team=None, migrate=False):
     defaults = load_defaults()
     if not team:
         team_file_name = defaults.get("saved_team_file_name")
@@ -453,11 +465,18 @@ def dbsetup(c, team=None):
     if os.path.exists(venv_path):
         command = "source venv/bin/activate; "
     command += f"cd ./db; python3 dbloader.py {team}"
+    if migrate:
+        command += " --migrate"
 
     if config:
         result = c.run(command, pty=True, warn=True)
 
-        if result.exited == 0:
+        if migrate:
+            if result.exited == 0:
+                print("DONE: Database schema migrated.")
+            else:
+                print("ERROR: Database schema could not be fully migrated. See messages above.")
+        elif result.exited == 0:
             print("DONE: Database loaded. You should be able to login with the 'iot' CLI.")
             print("Run 'iot --help' for a list of available commands.")
 
@@ -470,6 +489,37 @@ def dbsetup(c, team=None):
     else:
         print(f"ERROR: Could not retrieve Team data for {team}")
 
+#
+# Rebuilds the 1-minute and 1-hour history rollups from the raw history in DynamoDB.
+# Only needed for history recorded before rollups were kept at ingest time.
+#
+@task()
+def rollupbackfill(c, team=None, project=None, serial=None, name=None, start=None, end=None):
+    defaults = load_defaults()
+    if not team:
+        team_file_name = defaults.get("saved_team_file_name")
+        _, team = load_from_tempfile(team_file_name)
+        if not team:
+            print("Parameter 'team' has to be specified. Exiting.")
+            exit(1)
+
+    venv_path = "venv/bin/activate"
+    print(f"Rebuilding history rollups for Team: {team}")
+    config = load_config(team)
+    if not config:
+        print(f"ERROR: Could not retrieve Team data for {team}")
+        exit(1)
+
+    command = ""
+    if os.path.exists(venv_path):
+        command = "source venv/bin/activate; "
+    command += f"cd ./db; python3 rollupbackfill.py {team}"
+    for option, value in [("project", project), ("serial", serial), ("name", name), ("start", start), ("end", end)]:
+        if value:
+            command += f" --{option} '{value}'"
+
+    c.run(command, pty=True, warn=True)
+
 #
 # Install is a one-shot call to bootstrap, then deploy, then dbsetup then post-install cleanup.
 #
@@ -807,6 +857,7 @@ namespace = Collection(
     bootstrap,
     deploy,
     dbsetup,
+    rollupbackfill,
     upload,
     cdkupdate,
     nodeupdate,
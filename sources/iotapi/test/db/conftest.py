@@ -0,0 +1,40 @@
+# © 2022 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#
+# SimpleIOT project.
+# Author: Ramin Firoozye (framin@amazon.com)
+#
+# Fixtures for tests that run against the database schema directly instead of
+# the deployed REST API. They bind the schema to an in-memory SQLite database.
+#
+import os
+import sys
+import pytest
+
+DB_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "db"))
+if DB_DIR not in sys.path:
+    sys.path.append(DB_DIR)
+
+os.environ.setdefault("AWS_REGION", "us-west-2")
+os.environ.setdefault("AWS_DEFAULT_REGION", os.environ["AWS_REGION"])
+
+from pony.orm import db_session, commit
+from iotapp.dbschema import *
+
+
+@pytest.fixture(scope="session")
+def sqlite_db():
+    db.bind(provider="sqlite", filename=":memory:")
+    db.generate_mapping(create_tables=True)
+    return db
+
+
+@pytest.fixture(scope="session")
+def sample_device(sqlite_db):
+    with db_session:
+        project = Project(name="TestProject")
+        model = Model(model_project=project, name="TestModel")
+        for name in ["temperature", "humidity", "pressure"]:
+            DataType(model=model, name=name, data_type="float", show_on_twin=True)
+        device = Device(device_project=project, model=model, serial_number="TEST-0001")
+        commit()
+        return device.id
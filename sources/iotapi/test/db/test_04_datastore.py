@@ -0,0 +1,143 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import pytest
+from pony.orm import db_session, count, select
+from iotapp.dbschema import *
+from iotapp.datastore import upsert_device_data, select_device_data, select_devices_by_value, \
+    get_typed_values, is_within_deadband
+
+
+def get_type_ids(device_id):
+    device = Device[device_id]
+    return {dt.name: dt.id for dt in device.model.data_types}
+
+
+def test_upsert_creates_records(sample_device):
+    with db_session:
+        type_ids = get_type_ids(sample_device)
+        rows = [
+            {"type_id": type_ids["temperature"], "value": "21.5", "position": "1,2", "timestamp": datetime.utcnow()},
+            {"type_id": type_ids["humidity"], "value": "40", "timestamp": datetime.utcnow()}
+        ]
+        records = upsert_device_data(sample_device, rows)
+        assert len(records) == 2
+        assert records[type_ids["temperature"]].value == "21.5"
+        assert count(d for d in Data if d.device.id == sample_device) == 2
+
+
+def test_upsert_updates_existing_records(sample_device):
+    with db_session:
+        type_ids = get_type_ids(sample_device)
+        first = upsert_device_data(sample_device, [
+            {"type_id": type_ids["pressure"], "value": "1000", "position": "1,2", "timestamp": datetime.utcnow()}
+        ])
+        second = upsert_device_data(sample_device, [
+            {"type_id": type_ids["pressure"], "value": "1013", "timestamp": datetime.utcnow()}
+        ])
+        assert first[type_ids["pressure"]].id == second[type_ids["pressure"]].id
+        assert second[type_ids["pressure"]].position == "1,2", 'Empty position should keep the old value'
+
+        values = select(d.value for d in Data if d.device.id == sample_device and d.type.id == type_ids["pressure"])[:]
+        assert values == ["1013"]
+
+
+def test_upsert_keeps_newer_value(sample_device):
+    with db_session:
+        type_ids = get_type_ids(sample_device)
+        now = datetime.utcnow()
+        newer = upsert_device_data(sample_device, [
+            {"type_id": type_ids["pressure"], "value": "1013", "timestamp": now}
+        ])
+        older = upsert_device_data(sample_device, [
+            {"type_id": type_ids["pressure"], "value": "990", "timestamp": now - timedelta(minutes=5)},
+            {"type_id": type_ids["humidity"], "value": "45", "timestamp": now}
+        ])
+        assert older[type_ids["pressure"]].stale, 'Older value should not be written'
+        assert older[type_ids["pressure"]].id == newer[type_ids["pressure"]].id
+        assert not older[type_ids["humidity"]].stale
+
+        values = select(d.value for d in Data if d.device.id == sample_device and d.type.id == type_ids["pressure"])[:]
+        assert values == ["1013"]
+
+
+def test_duplicate_data_record_is_rejected(sample_device):
+    with pytest.raises(Exception):
+        with db_session:
+            type_ids = get_type_ids(sample_device)
+            upsert_device_data(sample_device, [
+                {"type_id": type_ids["temperature"], "value": "1", "timestamp": datetime.utcnow()}
+            ])
+            Data(device=sample_device, type=type_ids["temperature"], value="2")
+
+
+def test_select_device_data(sample_device):
+    with db_session:
+        type_ids = get_type_ids(sample_device)
+        upsert_device_data(sample_device, [
+            {"type_id": type_ids["temperature"], "value": "22", "timestamp": datetime.utcnow()},
+            {"type_id": type_ids["humidity"], "value": "41", "timestamp": datetime.utcnow()}
+        ])
+        device = Device[sample_device]
+        project_id = device.device_project.id
+        model_id = device.model.id
+
+    with db_session:
+        rows = select_device_data(project_id, device_id=sample_device)
+        assert set(r.type_id for _, r in rows) >= {type_ids["temperature"], type_ids["humidity"]}
+
+        rows = select_device_data(project_id, model_id=model_id, type_ids=[type_ids["humidity"]])
+        assert [(serial, r.value) for serial, r in rows] == [("TEST-0001", "41")]
+
+
+def test_typed_values_and_fleet_filter(sample_device):
+    with db_session:
+        device = Device[sample_device]
+        project_id = device.device_project.id
+        model_id = device.model.id
+        pressure = DataType.get(model=device.model, name="pressure")
+        pressure_id = pressure.id
+        assert get_typed_values(pressure, "12.5") == (12.5, None)
+        assert get_typed_values(pressure, "high") == (None, None)
+
+        other = Device(device_project=device.device_project, model=device.model, serial_number="TEST-0002")
+        commit()
+        for device_id, value in [(sample_device, "35.5"), (other.id, "42.25")]:
+            number, flag = get_typed_values(pressure, value)
+            upsert_device_data(device_id, [{"type_id": pressure_id, "value": value, "timestamp": datetime.utcnow(),
+                                            "number_value": number, "bool_value": flag}])
+
+    with db_session:
+        total, rows = select_devices_by_value(project_id, model_id, pressure_id, "gt", 40)
+        assert total == 1
+        assert [(serial, rec.number_value) for serial, _, rec in rows] == [("TEST-0002", 42.25)]
+
+        total, rows = select_devices_by_value(project_id, model_id, pressure_id, "lte", 42.25, pagesize=1)
+        assert total == 2
+        assert len(rows) == 1
+
+
+def test_deadband():
+    now = datetime.utcnow()
+    absolute = SimpleNamespace(deadband=0.5, deadband_percent=False, min_report_secs=60)
+    percent = SimpleNamespace(deadband=10, deadband_percent=True, min_report_secs=0)
+    off = SimpleNamespace(deadband=0, deadband_percent=False, min_report_secs=0)
+
+    assert is_within_deadband(absolute, "20.3", now, "20.0", now - timedelta(seconds=10))
+    assert not is_within_deadband(absolute, "20.6", now, "20.0", now - timedelta(seconds=10))
+    assert not is_within_deadband(absolute, "20.3", now, "20.0", now - timedelta(seconds=61)), \
+        'Values in the deadband should still be reported every min_report_secs'
+    assert is_within_deadband(percent, "105", now, "100", now - timedelta(days=1))
+    assert not is_within_deadband(percent, "111", now, "100", now)
+    assert not is_within_deadband(off, "20", now, "20", now)
+    assert not is_within_deadband(absolute, "on", now, "on", now), 'Non-numeric values are never dropped'
+    assert not is_within_deadband(absolute, "20", now, None, None)
+
+
+def test_report_interval_without_deadband():
+    now = datetime.utcnow()
+    interval = SimpleNamespace(deadband=0, deadband_percent=False, min_report_secs=60)
+    assert is_within_deadband(interval, "20", now, "20", now - timedelta(seconds=10)), \
+        'Unchanged values are only stored once per min_report_secs'
+    assert not is_within_deadband(interval, "20", now, "20", now - timedelta(seconds=60))
+    assert not is_within_deadband(interval, "20.1", now, "20", now - timedelta(seconds=10)), \
+        'Changed values are always stored'
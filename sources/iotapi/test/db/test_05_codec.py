@@ -0,0 +1,31 @@
+import cbor2
+from iotapp.codec import decode_cbor, is_short_key_payload, expand_short_keys
+
+KEY_NAMES = ["temperature", "humidity", "pressure", "switch"]
+
+
+def test_short_key_map():
+    raw = cbor2.dumps({0: 21.5, 1: 40, 3: True, -1: 1650000000, -2: 37.5, -3: -122.1})
+    payload = decode_cbor(raw)
+    assert is_short_key_payload(payload)
+
+    params, errors = expand_short_keys(payload, KEY_NAMES)
+    assert not errors
+    assert params["geo_lat"] == 37.5
+    assert params["geo_lng"] == -122.1
+    values = {r["name"]: r["value"] for r in params["data"]}
+    assert values == {"temperature": 21.5, "humidity": 40, "switch": "true"}
+    assert all(r["timestamp"] == 1650000000 for r in params["data"])
+
+
+def test_short_key_array_and_invalid_keys():
+    params, errors = expand_short_keys(decode_cbor(cbor2.dumps([20, None, 1013])), KEY_NAMES)
+    assert [r["name"] for r in params["data"]] == ["temperature", "pressure"]
+
+    params, errors = expand_short_keys({0: 1, 9: 2}, KEY_NAMES)
+    assert len(params["data"]) == 1
+    assert errors[0]["key"] == 9
+
+
+def test_string_keys_are_not_short_keys():
+    assert not is_short_key_payload(decode_cbor(cbor2.dumps({"name": "temperature", "value": 1})))
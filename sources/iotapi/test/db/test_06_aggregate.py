@@ -0,0 +1,49 @@
+import numpy as np
+from iotapp.aggregate import bucket_aggregate, lttb_downsample, merge_rollup_pages
+
+SEC = 1000000000
+
+
+def test_bucket_aggregate_across_pages():
+    # Bucket 1 (10-19s) is split across the two pages. The non-numeric value is skipped.
+    pages = [
+        ([1 * SEC, 5 * SEC, 11 * SEC], [1.0, 3.0, 10.0]),
+        ([15 * SEC, 16 * SEC, 25 * SEC], [20.0, None, 7.0])
+    ]
+    result = bucket_aggregate(pages, 0, 10 * SEC)
+    assert result["timestamps"] == [0, 10 * SEC, 20 * SEC]
+    assert result["min"] == [1.0, 10.0, 7.0]
+    assert result["max"] == [3.0, 20.0, 7.0]
+    assert result["avg"] == [2.0, 15.0, 7.0]
+    assert result["count"] == [2, 2, 1]
+    assert result["last"] == [3.0, 20.0, 7.0]
+
+
+def test_lttb_keeps_endpoints_and_peaks():
+    t = np.arange(10000) * SEC
+    v = np.sin(np.arange(10000) / 500.0)
+    v[4321] = 50.0
+    pages = [(t[:6000].tolist(), v[:6000].tolist()), (t[6000:].tolist(), v[6000:].tolist())]
+
+    result = lttb_downsample(pages, 200)
+    assert len(result["timestamps"]) == 200
+    assert result["timestamps"][0] == 0
+    assert result["timestamps"][-1] == 9999 * SEC
+    assert 50.0 in result["values"], 'The spike should survive downsampling'
+
+
+def test_merge_rollup_pages():
+    # Four 1-minute rollups combined into 2-minute buckets.
+    pages = [
+        {"start": [0, 60 * SEC], "count": [2, 3], "sum": [4.0, 9.0], "min": [1.0, 2.0],
+         "max": [3.0, 4.0], "last": [3.0, 2.0], "last_at": [50 * SEC, 110 * SEC]},
+        {"start": [120 * SEC, 180 * SEC], "count": [1, 1], "sum": [5.0, 7.0], "min": [5.0, 7.0],
+         "max": [5.0, 7.0], "last": [5.0, 7.0], "last_at": [130 * SEC, 190 * SEC]}
+    ]
+    result = merge_rollup_pages(pages, 120 * SEC)
+    assert result["timestamps"] == [0, 120 * SEC]
+    assert result["min"] == [1.0, 5.0]
+    assert result["max"] == [4.0, 7.0]
+    assert result["avg"] == [13.0 / 5, 6.0]
+    assert result["count"] == [5, 2]
+    assert result["last"] == [2.0, 7.0]
@@ -0,0 +1,97 @@
+import uuid
+from datetime import datetime
+from botocore.exceptions import ClientError
+from iotapp.datastore import DataRecord
+from iotapp.laststore import LastValueWriter, LastValues, make_last_value_entry, _parse_item, _serializer, \
+    _deserializer
+
+
+class RecordingClient(object):
+    def __init__(self):
+        self.updates = []
+
+    def update_item(self, **kwargs):
+        self.updates.append(kwargs)
+
+
+class ConditionalClient(object):
+    """
+    Keeps a single item, and applies the 'stored ts is not newer' check to every value set
+    in a conditional update.
+    """
+    def __init__(self):
+        self.item = {}
+        self.updates = 0
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues, ConditionExpression=None):
+        self.updates += 1
+        values = {}
+        for part in UpdateExpression[len("SET "):].split(", "):
+            name, value = part.split(" = ")
+            if name.startswith("#v"):
+                values[ExpressionAttributeNames[name]] = _deserializer.deserialize(ExpressionAttributeValues[value])
+        if ConditionExpression:
+            for attr, entry in values.items():
+                if attr in self.item and self.item[attr]["ts"] > entry["ts"]:
+                    raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+        self.item.update(values)
+
+
+def test_writer_keeps_latest_value_per_name():
+    type_id = uuid.uuid4()
+    older = DataRecord(uuid.uuid4(), type_id, "20", "", "", datetime(2022, 1, 1))
+    newer = DataRecord(older.id, type_id, "21", "", "", datetime(2022, 1, 1, 0, 0, 5))
+
+    client = RecordingClient()
+    writer = LastValueWriter(client, "table")
+    writer.add("proj", "dev1", "temperature", make_last_value_entry(newer, type_id))
+    writer.add("proj", "dev1", "temperature", make_last_value_entry(older, type_id))
+    writer.flush()
+
+    assert len(client.updates) == 1
+    update = client.updates[0]
+    assert update["Key"]["id"]["S"] == "lastvalue:proj:dev1"
+    assert update["ExpressionAttributeNames"]["#v0"] == "v:temperature"
+    assert update["ExpressionAttributeValues"][":v0"]["M"]["value"]["S"] == "21"
+
+
+def test_values_read_back_and_stale_types_ignored():
+    type_id = uuid.uuid4()
+    rec = DataRecord(uuid.uuid4(), type_id, "on", "1,2,3", "", datetime(2022, 3, 4, 5, 6, 7))
+    item = {"v:switch": _serializer.serialize(make_last_value_entry(rec, type_id))}
+    values = LastValues(_parse_item(item), True)
+
+    class Type(object):
+        def __init__(self, id):
+            self.id = id
+
+    read = values.get("switch", Type(type_id))
+    assert read.id == rec.id
+    assert read.value == "on"
+    assert read.position == "1,2,3"
+    assert read.timestamp == rec.timestamp
+    assert values.get("switch", Type(uuid.uuid4())) is None, "Value of a re-created DataType is ignored"
+
+
+def test_older_values_from_another_writer_are_skipped():
+    temp_type, humidity_type = uuid.uuid4(), uuid.uuid4()
+    newer = DataRecord(uuid.uuid4(), temp_type, "21", "", "", datetime(2022, 1, 1, 0, 0, 5))
+    older = DataRecord(newer.id, temp_type, "20", "", "", datetime(2022, 1, 1))
+    humidity = DataRecord(uuid.uuid4(), humidity_type, "40", "", "", datetime(2022, 1, 1))
+
+    client = ConditionalClient()
+    first = LastValueWriter(client, "table")
+    first.add("proj", "dev1", "temperature", make_last_value_entry(newer, temp_type))
+    first.flush()
+
+    # A slower invocation with older values finishes after the first one.
+    second = LastValueWriter(client, "table")
+    second.add("proj", "dev1", "temperature", make_last_value_entry(older, temp_type))
+    second.add("proj", "dev1", "humidity", make_last_value_entry(humidity, humidity_type))
+    second.flush()
+
+    assert client.item["v:temperature"]["value"] == "21", "Older value must not replace a newer one"
+    assert client.item["v:humidity"]["value"] == "40", "Values that aren't older are still written"
+    assert second.stats()["skipped"] == 1
+    assert client.updates == 4, "One failed combined update, then one update per value"
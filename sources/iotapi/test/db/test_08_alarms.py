@@ -0,0 +1,34 @@
+import json
+from iotapp.alarms import compile_ranges, find_transitions
+
+RANGES = json.dumps([
+    {"name": "Good", "low": 50, "high": 100, "color": "green", "when_in": "good_in"},
+    {"name": "Warning", "low": 10, "high": 49, "color": "yellow", "when_below": "warning_below"},
+    {"name": "Error", "high": 9, "color": "red", "when_in": "error_in"}
+])
+
+
+def test_events_only_on_transitions():
+    compiled = compile_ranges(RANGES)
+    transitions = find_transitions(compiled, 60, [70, 80, 40, 45, 5, 6, 200])
+    assert [i for i, _ in transitions] == [2, 4, 6]
+
+    _, warning = transitions[0]
+    assert (warning["previous"], warning["range"], warning["color"]) == ("Good", "Warning", "yellow")
+
+    _, error = transitions[1]
+    assert error["actions"] == ["warning_below", "error_in"]
+
+    _, out_of_range = transitions[2]
+    assert (out_of_range["previous"], out_of_range["range"]) == ("Error", "")
+
+
+def test_first_value_and_invalid_ranges():
+    compiled = compile_ranges(RANGES)
+    transitions = find_transitions(compiled, None, [75])
+    assert transitions[0][1]["range"] == "Good", 'With no previous value, the first range entered is an event'
+    assert find_transitions(compiled, 75, [80, 90]) == []
+
+    assert compile_ranges("") is None
+    assert compile_ranges("not json") is None
+    assert compile_ranges("{}") is None
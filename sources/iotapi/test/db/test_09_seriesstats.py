@@ -0,0 +1,56 @@
+import math
+import statistics
+from datetime import datetime
+from pony.orm import db_session
+from iotapp.dbschema import *
+from iotapp.datastore import upsert_device_data, get_last_values_and_stats
+from iotapp.seriesstats import SeriesStats
+
+
+def test_running_stats_match_batch():
+    values = [20.1, 20.4, 19.8, 21.0, 20.7, 20.2, 19.9]
+    stats = SeriesStats()
+    for v in values:
+        stats.update(v, alpha=0.5)
+    assert stats.count == len(values)
+    assert abs(stats.mean - statistics.mean(values)) < 1e-9
+    assert abs(stats.stddev - statistics.stdev(values)) < 1e-9
+
+    ewma = values[0]
+    for v in values[1:]:
+        ewma = 0.5 * v + 0.5 * ewma
+    assert abs(stats.ewma - ewma) < 1e-9
+
+
+def test_anomaly_check():
+    stats = SeriesStats()
+    for i in range(40):
+        stats.update(20.0 + (i % 5) * 0.1)
+    assert stats.check(20.2) is None
+    anomaly = stats.check(35.0)
+    assert anomaly and anomaly["zscore"] > 3
+    assert SeriesStats(5, 20.0, 1.0).check(35.0) is None, "Too few readings to flag anything"
+
+    flat = SeriesStats()
+    for i in range(40):
+        flat.update(1.0)
+    assert flat.check(1.0) is None
+    anomaly = flat.check(1.5)
+    assert anomaly and anomaly["zscore"] > 3 and math.isfinite(anomaly["zscore"]), \
+        "Any change in a flat series is flagged"
+
+
+def test_stats_stored_with_data(sample_device):
+    with db_session:
+        type_id = Device[sample_device].model.data_types.select(lambda t: t.name == "temperature").first().id
+        stats = SeriesStats()
+        stats.update(20.0)
+        stats.update(22.0)
+        upsert_device_data(sample_device, [{"type_id": type_id, "value": "22.0", "timestamp": datetime.utcnow(),
+                                            "stats": stats}])
+        upsert_device_data(sample_device, [{"type_id": type_id, "value": "22.5", "timestamp": datetime.utcnow()}])
+
+        last_values, loaded = get_last_values_and_stats(sample_device, [type_id])
+        assert last_values[type_id][0] == "22.5"
+        assert loaded[type_id].count == 2, "Rows without stats keep the stored ones"
+        assert loaded[type_id].mean == 21.0
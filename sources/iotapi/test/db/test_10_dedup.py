@@ -0,0 +1,79 @@
+from botocore.exceptions import ClientError
+from iotapp.dedup import DedupStore, get_message_id
+
+
+class ConditionalClient(object):
+    def __init__(self):
+        self.items = {}
+        self.puts = 0
+
+    def put_item(self, TableName, Item, ConditionExpression, ExpressionAttributeValues):
+        self.puts += 1
+        key = Item["id"]["S"]
+        now = int(ExpressionAttributeValues[":now"]["N"])
+        if key in self.items and int(self.items[key]["expires_at"]["N"]) >= now:
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem")
+        self.items[key] = Item
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        item = self.items[Key["id"]["S"]]
+        item["state"] = ExpressionAttributeValues[":state"]
+        item["expires_at"] = ExpressionAttributeValues[":expires_at"]
+
+    def delete_item(self, TableName, Key):
+        self.items.pop(Key["id"]["S"], None)
+
+
+def test_message_id_params():
+    assert get_message_id({"message_id": "abc", "seq": 5}) == "abc"
+    assert get_message_id({"seq": 0}) == "0"
+    assert get_message_id({"name": "temperature"}) is None
+
+
+def test_duplicates_dropped_across_containers():
+    client = ConditionalClient()
+    first = DedupStore(client, "table")
+    second = DedupStore(client, "table")
+
+    assert first.claim("proj", "dev1", "42")
+    assert not first.claim("proj", "dev1", "42")
+    assert client.puts == 1, "Repeat on the same container is caught by the LRU"
+    assert not second.claim("proj", "dev1", "42"), "Repeat on another container is caught by DynamoDB"
+    assert second.claim("proj", "dev2", "42")
+
+
+def test_released_message_can_be_retried():
+    client = ConditionalClient()
+    store = DedupStore(client, "table", max_size=1)
+    assert store.claim("proj", "dev1", "1")
+    store.release("proj", "dev1", "1")
+    assert store.claim("proj", "dev1", "1")
+    assert store.claim("proj", "dev1", "2")
+    assert len(store._recent) == 1
+
+
+
+def test_pending_claims_marked_done_or_released():
+    client = ConditionalClient()
+    store = DedupStore(client, "table", pending_secs=60)
+
+    assert store.claim("proj", "dev1", "1")
+    assert client.items["dedup:proj:dev1:1"]["state"]["S"] == "pending"
+    store.finish(True)
+    assert client.items["dedup:proj:dev1:1"]["state"]["S"] == "done"
+
+    assert store.claim("proj", "dev1", "2")
+    store.finish(False)
+    assert "dedup:proj:dev1:2" not in client.items, "Failed invocation drops its claim"
+    assert store.claim("proj", "dev1", "2")
+
+
+def test_stale_pending_claim_can_be_taken_again():
+    client = ConditionalClient()
+    assert DedupStore(client, "table", pending_secs=60).claim("proj", "dev1", "1")
+    assert not DedupStore(client, "table").claim("proj", "dev1", "1"), "Claim still in progress"
+
+    # The invocation that claimed it timed out without finishing.
+    item = client.items["dedup:proj:dev1:1"]
+    item["expires_at"] = {"N": str(int(item["claimed_at"]["N"]) - 1)}
+    assert DedupStore(client, "table").claim("proj", "dev1", "1")
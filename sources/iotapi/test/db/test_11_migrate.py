@@ -0,0 +1,87 @@
+import uuid
+from pony.orm import db_session, commit, select
+from iotapp.dbschema import *
+from schema.dbmigrate import migrate_schema
+
+
+def query_plan(query):
+    sql, args, _, _ = query._construct_sql_and_arguments()
+    with db_session:
+        cursor = db.get_connection().cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?"))
+        return " ".join(str(row[-1]) for row in cursor.fetchall())
+
+
+def test_lookups_use_composite_indexes(sample_device):
+    with db_session:
+        project_id = Device[sample_device].device_project.id
+        model_id = Device[sample_device].model.id
+        device_id = sample_device
+
+        plans = {
+            "(device_project=? AND serial_number=?)":
+                query_plan(select(d for d in Device if d.device_project.id == project_id and
+                                  d.serial_number == "TEST-0001")),
+            "(model=? AND name=?)":
+                query_plan(select(t for t in DataType if t.model.id == model_id and t.name == "temperature")),
+            "(device=? AND type=?)":
+                query_plan(select(d for d in Data if d.device.id == device_id and d.type.id == uuid.uuid4())),
+            "(device=? AND state=?)":
+                query_plan(select(t for t in UpdateTarget if t.device.id == device_id and t.state == 1)),
+            "(model=? AND version=?)":
+                query_plan(select(f for f in Firmware if f.model.id == model_id and f.version == "1.0.0"))
+        }
+    for columns, plan in plans.items():
+        assert "USING INDEX" in plan and columns in plan, f"Expected an index on {columns} in query plan: {plan}"
+
+
+def test_migration_adds_missing_schema(sqlite_db):
+    with db_session(ddl=True):
+        db.execute('DROP INDEX "idx_device__device_project_serial_number"')
+        db.execute('DROP INDEX "idx_updatetarget__device_state"')
+        db.execute('ALTER TABLE "DataType" DROP COLUMN "min_report_secs"')
+        db.execute('DROP TABLE "Alarm"')
+
+    report, problems = migrate_schema(sqlite_db)
+    assert not problems
+    assert "Add column DataType.min_report_secs" in report
+    assert "Create table Alarm" in report
+    assert "Create index idx_device__device_project_serial_number" in report
+    assert "Create index idx_updatetarget__device_state" in report
+    with db_session:
+        assert set(db.select('SELECT "min_report_secs" FROM "DataType"')) == {0}, "New column set to its default"
+
+    report, problems = migrate_schema(sqlite_db)
+    assert report == [] and problems == [], "Nothing left to do on an up-to-date database"
+
+
+def test_short_keys_assigned_and_never_reused(sqlite_db, sample_device):
+    from iotapp.utils import assign_data_type_short_key, find_data_type_keys_cached, bump_metadata_version
+
+    with db_session:
+        model_id = Device[sample_device].model.id
+        db.execute('UPDATE "DataType" SET "short_key" = NULL')
+        db.execute('UPDATE "Model" SET "next_short_key" = 0')
+
+    report, problems = migrate_schema(sqlite_db)
+    assert "Assign short keys to 3 DataTypes" in report
+    with db_session:
+        keys = {dt.name: dt.short_key for dt in Model[model_id].data_types}
+        assert sorted(keys.values()) == [0, 1, 2]
+        assert Model[model_id].next_short_key == 3
+
+    with db_session:
+        model = Model[model_id]
+        first = DataType(model=model, name="extra1", short_key=assign_data_type_short_key(model))
+        second = DataType(model=model, name="extra2", short_key=assign_data_type_short_key(model))
+        commit()
+        assert (first.short_key, second.short_key) == (3, 4)
+        first.delete()
+        commit()
+        bump_metadata_version()
+
+        key_names = find_data_type_keys_cached(model)
+        assert key_names[3] is None, "Key of a deleted DataType is not given to another one"
+        assert key_names[4] == "extra2"
+        assert assign_data_type_short_key(model) == 5
+        second.delete()
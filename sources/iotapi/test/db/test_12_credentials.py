@@ -0,0 +1,46 @@
+from pony.orm import db_session, commit, select
+from iotapp.dbschema import *
+from iotapp.utils import set_credential
+from schema.dbmigrate import migrate_schema
+
+
+def test_credentials_loaded_separately(sample_device):
+    with db_session:
+        device = Device[sample_device]
+        set_credential(device, "", "CA", "CERT", "PUBLIC", "PRIVATE")
+        commit()
+
+    with db_session:
+        sql = select(d for d in Device if d.serial_number == "TEST-0001").get_sql()
+        assert "cert_data" not in sql and "iot_config_data" not in sql
+        assert Device[sample_device].credential.cert_data == "CERT"
+
+
+def test_credential_deleted_with_device(sample_device):
+    with db_session:
+        device = Device[sample_device]
+        other = Device(device_project=device.device_project, model=device.model, serial_number="TEST-CRED")
+        credential_id = set_credential(other, "", "CA", "CERT", "PUBLIC", "PRIVATE").id
+        commit()
+        other.delete()
+        commit()
+        assert not Credential.exists(id=credential_id)
+
+
+def test_migration_moves_credentials(sample_device):
+    with db_session(ddl=True):
+        Device[sample_device].credential.delete()
+        for column in ["iot_config_data", "device_ca_data", "device_cert_data",
+                       "device_public_key_data", "device_private_key_data"]:
+            db.execute(f'ALTER TABLE "Device" ADD COLUMN "{column}" TEXT')
+        db.execute('UPDATE "Device" SET "device_cert_data" = \'OLD CERT\'')
+
+    report, problems = migrate_schema(db)
+    assert not problems
+    assert "Move Device certificates to Credential" in report
+    assert "Drop column Device.device_cert_data" in report
+
+    with db_session:
+        credential = Device[sample_device].credential
+        assert credential.cert_data == "OLD CERT"
+        assert credential.ca_data == ""
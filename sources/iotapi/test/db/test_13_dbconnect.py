@@ -0,0 +1,54 @@
+import os
+import json
+from iotapp import dbconnect
+from iotapp.dbconnect import SecretCache
+
+
+class SecretsClient(object):
+    def __init__(self, password):
+        self.password = password
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        return {"SecretString": json.dumps({"username": "iotadmin", "password": self.password})}
+
+
+def make_cache(client, **kwargs):
+    cache = SecretCache(**kwargs)
+    cache._client = client
+    return cache
+
+
+def test_secret_cached_until_ttl():
+    client = SecretsClient("first")
+    cache = make_cache(client, ttl_secs=900, cache_file="")
+    assert cache.get("db")["password"] == "first"
+    client.password = "second"
+    assert cache.get("db")["password"] == "first"
+    assert client.calls == 1
+    assert cache.get("db", refresh=True)["password"] == "second", "Rotated password is picked up on refresh"
+
+    expired = make_cache(client, ttl_secs=0, cache_file="")
+    expired.get("db")
+    expired.get("db")
+    assert client.calls == 4
+
+
+def test_secret_cache_file(tmp_path):
+    path = str(tmp_path / "secret.json")
+    client = SecretsClient("first")
+    make_cache(client, ttl_secs=900, cache_file=path).get("db")
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    restarted = make_cache(client, ttl_secs=900, cache_file=path)
+    assert restarted.get("db")["password"] == "first"
+    assert client.calls == 1, "A new process in the same environment re-uses the saved secret"
+    assert make_cache(client, ttl_secs=900, cache_file=path).get("other")["password"] == "first"
+    assert client.calls == 2
+
+
+def test_ensure_database_probes_connection():
+    dbconnect._last_probe_at = None
+    dbconnect.ensure_database()
+    assert dbconnect._last_probe_at is not None
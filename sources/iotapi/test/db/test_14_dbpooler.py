@@ -0,0 +1,58 @@
+import os
+import time
+import threading
+import pytest
+from pony.orm import Database, db_session
+from iotapp import dbpooler
+from iotapp.dbpooler import ConnectionLimiter, get_pooler_bind_args
+
+
+def test_connection_cap():
+    limiter = ConnectionLimiter(max_connections=2, wait_secs=0.05)
+    assert limiter.acquire()
+    assert limiter.acquire()
+    assert not limiter.acquire(), "Third connection times out"
+
+    waiter = threading.Thread(target=limiter.acquire)
+    limiter.wait_secs = 5
+    waiter.start()
+    while limiter.waits < 2:
+        time.sleep(0.01)
+    limiter.release()
+    waiter.join(timeout=5)
+    stats = limiter.stats()
+    assert stats["in_use"] == 2
+    assert stats["max_in_use"] == 2
+    assert stats["waits"] == 2
+    assert stats["timeouts"] == 1
+
+
+def test_direct_connection_without_pooler():
+    assert get_pooler_bind_args("postgres", "db.host", 5432, mode="") == ("postgres", "db.host", 5432, {})
+    assert get_pooler_bind_args("postgres", "db.host", 5432, mode="bogus")[1] == "db.host"
+
+
+#
+# Runs against a local PgBouncer in transaction pooling mode, i.e.:
+#
+#   docker run -d --name pg -e POSTGRES_PASSWORD=iot -p 5432:5432 postgres
+#   docker run -d --name pgbouncer --link pg -e DATABASE_URL=postgres://postgres:iot@pg/postgres \
+#       -e POOL_MODE=transaction -e AUTH_TYPE=scram-sha-256 -p 6432:5432 edoburu/pgbouncer
+#   SIMPLEIOT_TEST_PGBOUNCER=localhost:6432 python -m pytest test_14_dbpooler.py
+#
+@pytest.mark.skipif(not os.environ.get("SIMPLEIOT_TEST_PGBOUNCER"), reason="No PgBouncer to test against")
+def test_pgbouncer_transaction_pooling(monkeypatch):
+    host, port = os.environ["SIMPLEIOT_TEST_PGBOUNCER"].split(":")
+    monkeypatch.setattr(dbpooler, "DB_POOLER_HOST", host)
+    limiter = ConnectionLimiter(max_connections=1, wait_secs=1)
+    monkeypatch.setattr(dbpooler, "connection_limiter", limiter)
+
+    provider, host, port, extra = get_pooler_bind_args("postgres", "unused", port, mode="pgbouncer")
+    pooled = Database()
+    pooled.bind(provider, user="postgres", password="iot", host=host, port=port, database="postgres", **extra)
+    for _ in range(3):
+        with db_session:
+            assert pooled.select("SELECT 1") == [1]
+    assert limiter.stats()["opened"] == 1, "Connection is kept between db_sessions"
+    pooled.disconnect()
+    assert limiter.stats()["in_use"] == 0
@@ -0,0 +1,122 @@
+from pony.orm import db_session
+from iotapp import dbreplica
+from iotapp.dbreplica import ReplicaRouter, replica_session
+
+
+class FakeCursor(object):
+    def __init__(self, con):
+        self.con = con
+
+    def execute(self, sql):
+        if self.con.broken:
+            raise Exception("server closed the connection unexpectedly")
+
+    def fetchone(self):
+        return (self.con.lag,)
+
+
+class FakeConnection(object):
+    def __init__(self, lag=0, broken=False):
+        self.lag = lag
+        self.broken = broken
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+
+class FakePool(object):
+    def __init__(self, name, lag=0, fail=False):
+        self.name = name
+        self.lag = lag
+        self.fail = fail
+        self.con = None
+        self.kwargs = {"host": name, "password": "pw"}
+
+    def connect(self):
+        if self.fail:
+            raise Exception(f"could not connect to {self.name}")
+        if self.con is None:
+            self.con = FakeConnection(self.lag)
+            return self.con, True
+        return self.con, False
+
+    def release(self, con):
+        assert con is self.con
+
+    def drop(self, con):
+        self.con = None
+
+    def disconnect(self):
+        self.con = None
+
+
+def make_router(lag=0, fail=False):
+    primary = FakePool("primary")
+    replica = FakePool("replica", lag=lag, fail=fail)
+    return primary, replica, ReplicaRouter(primary, replica, retry_secs=60, lag_check_secs=0)
+
+
+def test_reads_routed_to_replica():
+    primary, replica, router = make_router(lag=1)
+    router.route_to_replica(5)
+    con, _ = router.connect()
+    assert con is replica.con
+    router.release(con)
+
+    router.route_to_replica(0)
+    con, _ = router.connect()
+    assert con is primary.con, "A lag bound of 0 reads from the primary"
+
+    router.route_to_primary()
+    assert router.connect()[0] is primary.con
+    assert router.stats()["replica_reads"] == 1
+
+
+def test_stale_replica_skipped():
+    primary, replica, router = make_router(lag=30)
+    router.route_to_replica(5)
+    assert router.connect()[0] is primary.con
+    replica.con.lag = None
+    assert router.connect()[0] is primary.con, "Unknown lag is treated as stale"
+    assert router.stats()["stale_skips"] == 2
+    assert not router.is_down()
+
+
+def test_falls_back_to_primary():
+    primary, replica, router = make_router(fail=True)
+    router.route_to_replica(5)
+    assert router.connect()[0] is primary.con
+    assert router.is_down()
+    replica.fail = False
+    assert router.connect()[0] is primary.con, "Replica isn't retried until retry_secs"
+
+    primary, replica, router = make_router()
+    router.route_to_replica(5)
+    con, _ = router.connect()
+    router.drop(con)
+    assert router.is_down(), "A dropped replica connection takes the replica out"
+
+    primary, replica, router = make_router()
+    router.route_to_replica(5)
+    replica.connect()
+    replica.con.broken = True
+    assert router.connect()[0] is primary.con
+    assert replica.con is None
+
+
+def test_replica_session_routing(monkeypatch):
+    primary, replica, router = make_router()
+    monkeypatch.setattr(dbreplica, "get_replica_router", lambda: router)
+
+    @replica_session(max_lag_secs=2)
+    def read():
+        return router._local.max_lag_secs
+
+    assert read() == 2
+    assert router._local.max_lag_secs is None
+
+    with db_session:
+        assert read() is None, "Nested inside a db_session, reads stay on the primary"
@@ -0,0 +1,72 @@
+import os
+import importlib.util
+import pytest
+from pony.orm import db_session, commit
+from iotapp.dbschema import *
+from iotapp.utils import get_data_by_devices
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..",
+                          "iotcdk", "lib", "lambda_src", "api", "ui")
+
+
+@pytest.fixture(scope="module")
+def ui_model(sqlite_db):
+    spec = importlib.util.spec_from_file_location("iot_ui_api_model_main",
+                                                  os.path.join(LAMBDA_DIR, "iot_ui_api_model", "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_project(name, model_count):
+    with db_session:
+        project = Project(name=name)
+        for m in range(model_count):
+            model = Model(model_project=project, name=f"Model{m}")
+            types = [DataType(model=model, name=n, data_type="float") for n in ["temperature", "humidity"]]
+            for d in range(3):
+                device = Device(device_project=project, model=model, serial_number=f"{name}-{m}-{d}")
+                for type in types:
+                    Data(device=device, type=type, value="1.0")
+        commit()
+        return project.id
+
+
+def count_statements(func):
+    with db_session:
+        db.local_stats.clear()
+        result = func()
+        return sum(stat.db_count for sql, stat in db.local_stats.items() if sql), result
+
+
+def format_project(ui_model, project_id):
+    project = Project[project_id]
+    models = Model.select(lambda m: m.model_project == project)
+    return ui_model.format_all(project, models)
+
+
+def test_model_list_query_count(ui_model):
+    small = make_project("Small", 2)
+    large = make_project("Large", 8)
+
+    small_count, small_result = count_statements(lambda: format_project(ui_model, small))
+    large_count, large_result = count_statements(lambda: format_project(ui_model, large))
+
+    assert large_result["model_count"] == 8
+    assert all(m["device_count"] == 3 and m["type_count"] == 2 for m in large_result["models"])
+    assert small_count == large_count, "Number of queries doesn't depend on the number of models"
+    assert large_count <= 4
+
+
+def test_device_details_query_count(ui_model):
+    project_id = make_project("Details", 4)
+
+    def format_devices():
+        devices = Device.select(lambda d: d.device_project.id == project_id)[:]
+        data = get_data_by_devices(devices)
+        return [ui_model.format_device(dev, True, data.get(dev.id, [])) for dev in devices]
+
+    statements, result = count_statements(format_devices)
+    assert len(result) == 12
+    assert all(d["data_count"] == 2 and d["data"][0]["units"] is not None for d in result)
+    assert statements <= 3
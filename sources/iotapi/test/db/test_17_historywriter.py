@@ -0,0 +1,26 @@
+from iotapp.historywriter import DynamoDBHistoryWriter, make_history_item
+
+
+class BatchClient(object):
+    def __init__(self):
+        self.batches = []
+
+    def batch_write_item(self, RequestItems):
+        self.batches.append(RequestItems["table"])
+        return {}
+
+
+def test_items_buffered_until_batches_written():
+    client = BatchClient()
+    writer = DynamoDBHistoryWriter(client, "table")
+    for i in range(60):
+        writer.add(make_history_item("proj", "model", "dev1", "temperature", str(i), 1000000000 + i))
+    assert client.batches == [], "Nothing is written while adding"
+
+    batches = writer.pop_batches()
+    assert [len(b) for b in batches] == [25, 25, 10]
+    assert writer.pending() == 0
+    for batch in batches:
+        writer.write_batch(batch)
+    assert len(client.batches) == 3
+    assert writer.stats()["written"] == 60
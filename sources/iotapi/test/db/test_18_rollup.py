@@ -0,0 +1,96 @@
+from decimal import Decimal
+from boto3.dynamodb.types import TypeSerializer
+from iotapp.historywriter import DynamoDBHistoryWriter
+from iotapp.rollup import RollupUpdater, rebuild_rollups, NANOSECS_PER_SEC
+
+_serializer = TypeSerializer()
+
+
+class HistoryClient(object):
+    """
+    Returns the same raw history for any query, and keeps the items written with
+    batch_write_item.
+    """
+    def __init__(self, points):
+        self.points = points
+        self.written = []
+
+    def query(self, **kwargs):
+        return {"Items": [{"recorded_at": {"N": str(ts)}, "value": _serializer.serialize(value)}
+                          for ts, value in self.points]}
+
+    def batch_write_item(self, RequestItems):
+        for request in RequestItems["table"]:
+            self.written.append(request["PutRequest"]["Item"])
+        return {}
+
+
+def test_rebuild_rollups_from_history():
+    points = [(60 * NANOSECS_PER_SEC + i * NANOSECS_PER_SEC, str(v)) for i, v in enumerate([1.5, 0.5, 2.0])]
+    points.append((125 * NANOSECS_PER_SEC, "4"))
+    client = HistoryClient(points)
+    writer = DynamoDBHistoryWriter(client, "table")
+
+    written = rebuild_rollups(client, "table", writer, "proj:dev1:temperature")
+    assert written == 3, "Two 1-minute buckets and one 1-hour bucket"
+    assert writer.stats()["failed"] == 0
+
+    items = {(i["id"]["S"], int(i["recorded_at"]["N"])): i for i in client.written}
+    minute = items[("rollup:1m:proj:dev1:temperature", 60 * NANOSECS_PER_SEC)]
+    assert minute["count"]["N"] == "3"
+    assert Decimal(minute["sum"]["N"]) == Decimal("4.0")
+    assert Decimal(minute["min"]["N"]) == Decimal("0.5")
+    assert Decimal(minute["last"]["N"]) == Decimal("2.0")
+    hour = items[("rollup:1h:proj:dev1:temperature", 0)]
+    assert hour["count"]["N"] == "4" and Decimal(hour["max"]["N"]) == Decimal("4.0")
+
+
+class RollupClient(object):
+    """
+    Applies the rollup updates to items kept in memory.
+    """
+    def __init__(self):
+        self.items = {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues, ReturnValues=None, ConditionExpression=None):
+        item_key = (Key["id"]["S"], Key["recorded_at"]["N"])
+        item = self.items.setdefault(item_key, {})
+        old = dict(item)
+        values = {k: v.get("N", v.get("S")) for k, v in ExpressionAttributeValues.items()}
+        if UpdateExpression.startswith("ADD"):
+            for attr in ["count", "sum"]:
+                item[attr] = float(item.get(attr, 0)) + float(values[f":{attr}"])
+            for attr in ["min", "max", "last", "last_at"]:
+                item.setdefault(attr, values[f":{attr}"])
+        else:
+            item[ExpressionAttributeNames["#v"]] = values[":v"]
+            if ":at" in values:
+                item["last_at"] = values[":at"]
+        return {"Attributes": {k: {"N": str(v)} for k, v in old.items()}}
+
+
+def test_rollup_updater_combines_and_writes_buckets():
+    client = RollupClient()
+    updater = RollupUpdater(client, "table")
+    base = 3600 * NANOSECS_PER_SEC
+    for i, value in enumerate([5.0, 3.0, 8.0]):
+        updater.add("proj", "dev1", "pressure", base + i * NANOSECS_PER_SEC, value)
+
+    buckets = updater.pop_buckets()
+    assert len(buckets) == 2, "One bucket per rollup period"
+    assert updater.pending() == 0
+    for key, start, agg in buckets:
+        updater.write_bucket(key, start, agg)
+
+    minute = client.items[("rollup:1m:proj:dev1:pressure", str(base))]
+    assert minute["count"] == 3 and minute["sum"] == 16.0
+    assert (float(minute["min"]), float(minute["max"]), float(minute["last"])) == (3.0, 8.0, 8.0)
+
+    # A later invocation with a new minimum and a newer last value.
+    updater.add("proj", "dev1", "pressure", base + 10 * NANOSECS_PER_SEC, 1.0)
+    for key, start, agg in updater.pop_buckets():
+        updater.write_bucket(key, start, agg)
+    assert minute["count"] == 4
+    assert (float(minute["min"]), float(minute["last"])) == (1.0, 1.0)
+    assert updater.stats()["extra_updates"] == 4, "min and last updated in both buckets"
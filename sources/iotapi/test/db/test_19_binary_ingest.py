@@ -0,0 +1,35 @@
+import os
+import json
+import base64
+import importlib.util
+import cbor2
+import pytest
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..",
+                          "iotcdk", "lib", "lambda_src", "api")
+
+
+@pytest.fixture(scope="module")
+def data_api(sqlite_db):
+    spec = importlib.util.spec_from_file_location("iot_api_data_main",
+                                                  os.path.join(LAMBDA_DIR, "iot_api_data", "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_string_keyed_cbor_uses_topic_device(data_api, monkeypatch):
+    received = []
+    monkeypatch.setattr(data_api, "process_as_iot_request",
+                        lambda params: received.append(params) or (200, json.dumps({"status": "ok"})))
+
+    payload = cbor2.dumps({"project": "Other", "serial": "SPOOFED", "name": "temperature", "value": 21.5})
+    event = {"project": "TestProject", "serial": "TEST-0001",
+             "payload": base64.b64encode(payload).decode("ascii")}
+    code, _ = data_api.process_binary_iot_request(event)
+
+    assert code == 200
+    assert received[0]["project"] == "TestProject"
+    assert received[0]["serial"] == "TEST-0001", "Device comes from the topic, not the payload"
+    assert received[0]["action"] == "set"
+    assert received[0]["value"] == 21.5
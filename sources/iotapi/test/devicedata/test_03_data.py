@@ -0,0 +1,86 @@
+import time
+import requests
+import common
+
+# These use the sample project and device loaded by 'invoke dbsetup' from db/dbdata.json.
+#
+TEST_PROJECT = "Sunshine"
+TEST_SERIAL = "SWR-01"
+
+
+def test_set_single_value():
+    payload = {
+        "project": TEST_PROJECT,
+        "serial": TEST_SERIAL,
+        "name": "temperature",
+        "value": "21.5"
+    }
+    data = common.make_api_request("POST", "data", json=payload)
+    assert data.status_code == requests.codes.ok, 'REST API request status is not 200'
+    result = data.json()
+    assert result["status"] == "ok"
+    assert result["data"][0]["value"] == "21.5"
+
+
+def test_set_batch_values():
+    now = int(time.time())
+    payload = {
+        "project": TEST_PROJECT,
+        "serial": TEST_SERIAL,
+        "data": [
+            {"name": "temperature", "value": 22.5, "timestamp": now},
+            {"name": "humidity", "value": 40, "timestamp": now},
+            {"name": "avg_windspeed", "value": 3.2}
+        ]
+    }
+    data = common.make_api_request("POST", "data", json=payload)
+    assert data.status_code == requests.codes.ok, 'REST API request status is not 200'
+    result = data.json()
+    assert result["status"] == "ok"
+    assert len(result["data"]) == 3, 'All batch values should have been set'
+    assert "errors" not in result
+
+
+def test_set_batch_with_invalid_name():
+    payload = {
+        "project": TEST_PROJECT,
+        "serial": TEST_SERIAL,
+        "data": [
+            {"name": "temperature", "value": 23.0},
+            {"name": "BADNAME", "value": 1}
+        ]
+    }
+    data = common.make_api_request("POST", "data", json=payload)
+    assert data.status_code == requests.codes.ok, 'Valid values in a batch should still be set'
+    result = data.json()
+    assert len(result["data"]) == 1
+    assert result["errors"][0]["name"] == "BADNAME"
+
+
+def test_set_data_for_invalid_device():
+    payload = {
+        "project": TEST_PROJECT,
+        "serial": "BADSERIAL",
+        "data": [{"name": "temperature", "value": 23.0}]
+    }
+    data = common.make_api_request("POST", "data", json=payload)
+    assert data.status_code == 418, 'REST API request should be NOT FOUND (418)'
+
+
+def test_get_all_device_values():
+    params = {"project": TEST_PROJECT, "serial": TEST_SERIAL, "all": "true"}
+    data = common.make_api_request("GET", "data", params=params)
+    assert data.status_code == requests.codes.ok, 'REST API request status is not 200'
+    result = data.json()
+    assert result["status"] == "ok"
+    assert result["count"] == len(result["data"])
+    assert "temperature" in [d["name"] for d in result["data"]]
+
+
+def test_get_named_device_values():
+    params = {"project": TEST_PROJECT, "serial": TEST_SERIAL, "names": "temperature,humidity,BADNAME"}
+    data = common.make_api_request("GET", "data", params=params)
+    assert data.status_code == requests.codes.ok, 'REST API request status is not 200'
+    result = data.json()
+    assert set([d["name"] for d in result["data"]]) <= {"temperature", "humidity"}
+    assert result["errors"][0]["name"] == "BADNAME"
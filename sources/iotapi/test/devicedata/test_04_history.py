@@ -0,0 +1,51 @@
+import time
+import requests
+import common
+
+TEST_PROJECT = "Sunshine"
+TEST_SERIAL = "SWR-01"
+
+
+def test_history_columnar_and_paging():
+    start = int(time.time()) - 60
+    payload = {
+        "project": TEST_PROJECT,
+        "serial": TEST_SERIAL,
+        "data": [{"name": "humidity", "value": 30 + i, "timestamp": start + i} for i in range(5)]
+    }
+    data = common.make_api_request("POST", "data", json=payload)
+    assert data.status_code == requests.codes.ok, 'REST API request status is not 200'
+
+    params = {
+        "project": TEST_PROJECT,
+        "serial": TEST_SERIAL,
+        "name": "humidity",
+        "from": start,
+        "to": start + 4,
+        "limit": 3
+    }
+    data = common.make_api_request("GET", "data", params=params)
+    assert data.status_code == requests.codes.ok, 'REST API request status is not 200'
+    page = data.json()
+    assert page["count"] == 3
+    assert len(page["timestamps"]) == len(page["values"]) == 3
+    assert page["timestamps"] == sorted(page["timestamps"])
+    assert "next" in page, 'There should be another page'
+
+    params["next"] = page["next"]
+    data = common.make_api_request("GET", "data", params=params)
+    page = data.json()
+    assert page["count"] == 2
+    assert "next" not in page
+
+
+def test_history_invalid_field():
+    params = {
+        "project": TEST_PROJECT,
+        "serial": TEST_SERIAL,
+        "name": "humidity",
+        "history": "true",
+        "fields": "value,BADFIELD"
+    }
+    data = common.make_api_request("GET", "data", params=params)
+    assert data.status_code == 418, 'REST API request should be NOT FOUND (418)'